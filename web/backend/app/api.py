@@ -1,5 +1,5 @@
 import os
-from typing import Optional
+from typing import Literal, Optional
 import fastapi
 from pathlib import Path
 import logging
@@ -8,32 +8,49 @@ import json
 from fastapi import HTTPException, Depends, Request, UploadFile
 from fastapi.params import File
 from fastapi.responses import JSONResponse
-from database import UserRepository, ProjectRepository
+from responses import PydanticJSONResponse
+from metrics import render_metrics
+from ratelimit import rate_limit
+from database import StaleRisksError, UserRepository, ProjectRepository
+from generation import DRAFT_RETENTION_HOURS, SPECULATIVE_GENERATION, STEP_PLANS, STEP_RISKS, STEP_SCORES, GenerationCache, generate_plans, generate_risks, generate_scores, planning_inputs, plans_fingerprint, risks_fingerprint, scores_fingerprint, scoring_inputs, speculate_risk_plans, speculate_risk_scores
 from auth import hash_password, verify_password
-from models import DeleteUserData, Project, ProjectInDB, QualitativeAnalysisData, Risk, RiskInDB, TrackedRisk, TrackedScoredRisk, TrackedManagedRisk, UserData, UserResponse, UserInDB, UserUpdateData
+from pictures import SUPPORTED_CONTENT_TYPES, InvalidPictureError, remove_picture, store_picture
+from quantitative import AnalysisCache, analyze
+from models import DeleteUserData, GenerationDraft, LLMUsage, Project, ProjectInDB, QualitativeAnalysisData, QuantitativeAnalysis, QuantitativeAnalysisRequest, Risk, RiskInDB, RiskSearchPage, RiskUpdate, SavedRisk, SimilarRisk, TrackedScoredRisk, TrackedManagedRisk, UserData, UserResponse, UserUpdateData
 
 from llm import LLM # type: ignore
 
 logger = logging.getLogger(__name__)
 
 FILE_PATH = Path(os.getenv("BACKEND_FILE_PATH", "/data"))
+PICTURES_PATH = FILE_PATH / "pictures"
+# Internal proxy location mapped to PICTURES_PATH
+PICTURE_ACCEL_REDIRECT_PATH = os.getenv("PICTURE_ACCEL_REDIRECT_PATH", "/protected/pictures/")
 ASSETS_PATH = Path("/app/assets")
 
 api = fastapi.APIRouter(prefix="/api")
 
 
 def get_user_repository(request: Request) -> UserRepository:
-    """Dependency to get database connection"""
-    return UserRepository(request.app.state.db)
+    """Dependency to get user database repository"""
+    return UserRepository(request.app.state.db_router)
 
 def get_project_repository(request: Request) -> ProjectRepository:
-    """Dependency to get project database connection"""
-    return ProjectRepository(request.app.state.db)
+    """Dependency to get project database repository"""
+    return ProjectRepository(request.app.state.db_router)
 
 def get_llm_client(request: Request) -> LLM:
     """Dependency to get LLM client"""
     return request.app.state.llm
 
+def get_generation_cache(request: Request) -> GenerationCache:
+    """Dependency to get the speculative generation cache"""
+    return request.app.state.generations
+
+def get_analysis_cache(request: Request) -> AnalysisCache:
+    """Dependency to get the quantitative analysis cache"""
+    return request.app.state.analyses
+
 async def get_current_user(request: Request, db: UserRepository = Depends(get_user_repository)) -> UserResponse:
     """Dependency to get current authenticated user"""
     user_id = request.session.get("user_id")
@@ -55,6 +72,13 @@ async def get_current_user(request: Request, db: UserRepository = Depends(get_us
     return UserResponse(id=user.id, username=user.username, companyDescription=user.companyDescription)
 
 
+@api.get("/metrics", include_in_schema=False)
+def metrics() -> fastapi.responses.Response:
+    """Prometheus metrics of this backend"""
+    content, media_type = render_metrics()
+    return fastapi.responses.Response(content, media_type=media_type)
+
+
 @api.post("/register", response_model=UserResponse)
 async def register(request: Request, user_data: UserData, db: UserRepository = Depends(get_user_repository)):
     """Register a new user"""
@@ -74,7 +98,7 @@ async def register(request: Request, user_data: UserData, db: UserRepository = D
     request.session["user_id"] = user.id
     request.session["username"] = user.username
     
-    logger.info(f"User {user.username} registered successfully")
+    logger.debug(f"User {user.username} registered successfully")
     return UserResponse(id=user.id, username=user.username, companyDescription=user.companyDescription)
 
 
@@ -85,9 +109,7 @@ async def login(
     db: UserRepository = Depends(get_user_repository)
 ) -> JSONResponse:
     """Login user and create session"""
-    logger.info(f"Login attempt for user: {user_data.username}")
-    logger.info(f"Request headers: {dict(request.headers)}")
-    logger.info(f"Request cookies before: {request.cookies}")
+    logger.debug(f"Login attempt for user: {user_data.username}")
     
     # Get user from database
     db_user_data = await db.get_user_by_username(user_data.username)
@@ -112,9 +134,7 @@ async def login(
     # Create session
     request.session["user_id"] = user_id
     request.session["username"] = stored_username
-    logger.info(f"User {user_data.username} logged in successfully")
-    logger.info(f"Session data set: user_id={user_id}, username={stored_username}")
-    logger.info(f"Session after setting: {dict(request.session)}")
+    logger.debug(f"User {user_data.username} logged in successfully")
 
     return JSONResponse({"message": "Logged in"})
 
@@ -124,6 +144,15 @@ async def me(current_user: UserResponse = Depends(get_current_user)):
     """Get current user information"""
     return current_user
 
+@api.get("/me/usage", response_model=list[LLMUsage])
+async def get_usage(
+    current_user: UserResponse = Depends(get_current_user),
+    db: UserRepository = Depends(get_user_repository)
+) -> PydanticJSONResponse:
+    """Get the LLM token usage of the current user, by operation"""
+    usage = await db.get_llm_usage(current_user.id)
+    return PydanticJSONResponse(usage)
+
 @api.delete("/me")
 async def delete_account(
     request: Request,
@@ -167,7 +196,8 @@ async def delete_account(
 @api.post("/me/picture")
 async def upload_profile_picture(
     request: Request,
-    picture: UploadFile = File(..., description="The profile picture file to upload")):
+    picture: UploadFile = File(..., description="The profile picture file to upload"),
+    db: UserRepository = Depends(get_user_repository)):
     """Upload profile picture for current user"""
     if "user_id" not in request.session:
         raise HTTPException(
@@ -179,40 +209,26 @@ async def upload_profile_picture(
     # Validate file type
     if not picture.content_type or not picture.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="File must be an image")
-    
-    # Get file extension from content type
-    content_type_to_ext = {
-        'image/jpeg': '.jpg',
-        'image/jpg': '.jpg',
-        'image/png': '.png',
-        'image/webp': '.webp',
-        'image/gif': '.gif'
-    }
-
-    file_ext = content_type_to_ext.get(picture.content_type)
-    if not file_ext:
+    if picture.content_type not in SUPPORTED_CONTENT_TYPES:
         raise HTTPException(status_code=400, detail="Unsupported image format")
-    
-    file_basename = f"user_{user_id}"
-    file_name = f"{file_basename}{file_ext}"
-    file_path = FILE_PATH / file_name
 
     try:
-        # Delete old photo if exists
-        for existing_file in FILE_PATH.glob(f"{file_basename}.*"):
-            existing_file.unlink()
-        
-        with open(file_path, "wb") as buffer:
-            buffer.write(await picture.read())
-
-        return {"message": "Profile picture uploaded successfully"}
-    
+        # The upload is already spooled by the multipart parser, decode it from there
+        file_name = await store_picture(picture.file, PICTURES_PATH, user_id)
+    except InvalidPictureError:
+        raise HTTPException(status_code=400, detail="Invalid image")
     except Exception as e:
         logger.error(f"Error saving profile picture for user {user_id}: {e}")
         raise HTTPException(status_code=500, detail="Failed to upload profile picture")
+
+    old_file_name = await db.set_profile_picture(user_id, file_name)
+    if old_file_name and old_file_name != file_name:
+        await remove_picture(PICTURES_PATH, old_file_name)
+
+    return {"message": "Profile picture uploaded successfully"}
     
 @api.delete("/me/picture")
-async def delete_profile_picture(request: Request):
+async def delete_profile_picture(request: Request, db: UserRepository = Depends(get_user_repository)):
     """Delete profile picture for current user"""
     if "user_id" not in request.session:
         raise HTTPException(
@@ -221,19 +237,12 @@ async def delete_profile_picture(request: Request):
         )
     user_id = request.session["user_id"]
 
-    file_basename = f"user_{user_id}"
-    deleted = False
-    # Search for existing photo with any supported extension
-    for ext in ['.jpg', '.png', '.webp', '.gif']:
-        file_path = FILE_PATH / f"{file_basename}{ext}"
-        if file_path.exists():
-            file_path.unlink()
-            deleted = True
-            break
-
-    if not deleted:
+    old_file_name = await db.set_profile_picture(user_id, None)
+    if old_file_name is None:
         raise HTTPException(status_code=404, detail="No profile picture to delete")
 
+    await remove_picture(PICTURES_PATH, old_file_name)
+
     return {"message": "Profile picture deleted successfully"}
 
 @api.get("/me/picture", responses={
@@ -241,7 +250,7 @@ async def delete_profile_picture(request: Request):
     401: {"description": "Not logged in"},
     404: {"description": "Profile picture not found"}
 })
-async def get_profile_picture(request: Request):
+async def get_profile_picture(request: Request, db: UserRepository = Depends(get_user_repository)):
     """Get profile picture for current user"""
     if "user_id" not in request.session:
         raise HTTPException(
@@ -250,19 +259,12 @@ async def get_profile_picture(request: Request):
         )
     user_id = request.session["user_id"]
 
-    file_basename = f"user_{user_id}"
-    ret = None
-    # Search for existing photo with any supported extension
-    for ext in ['.jpg', '.png', '.webp', '.gif']:
-        file_path = FILE_PATH / f"{file_basename}{ext}"
-        if file_path.exists():
-            ret = file_path
-            break
-
-    if ret is None:
+    file_name = await db.get_profile_picture(user_id)
+    if file_name is None:
         raise HTTPException(status_code=404, detail="Profile picture not found")
 
-    return fastapi.responses.FileResponse(ret, media_type=f"image/{ret.suffix.lstrip('.')}")
+    # The proxy serves the file itself from the internal location, along with its ETag and cache headers
+    return fastapi.responses.Response(headers={"X-Accel-Redirect": f"{PICTURE_ACCEL_REDIRECT_PATH}{file_name}"})
 
 @api.post("/me", response_model=UserResponse, responses={
     200: {"description": "User profile updated successfully"},
@@ -332,7 +334,7 @@ def logout(request: Request) -> JSONResponse:
     """Logout user and clear session"""
     username = request.session.get("username")
     if username:
-        logger.info(f"User {username} logged out")
+        logger.debug(f"User {username} logged out")
 
     request.session.clear()
     response = JSONResponse({"message": "Logged out"})
@@ -362,12 +364,12 @@ async def create_project(
 
     return {"message": "Project created", "id": project.id}
 
-@api.get("/projects/{project_id}")
+@api.get("/projects/{project_id}", response_model=ProjectInDB)
 async def get_project(
     request: Request,
     project_id: int,
     db: ProjectRepository = Depends(get_project_repository),
-) -> ProjectInDB:
+) -> PydanticJSONResponse:
     if "user_id" not in request.session:
         raise HTTPException(
             status_code=401,
@@ -381,7 +383,7 @@ async def get_project(
             status_code=404,
             detail="Project not found"
         )
-    return project
+    return PydanticJSONResponse(project)
 
 @api.delete("/projects/{project_id}")
 async def delete_project(
@@ -404,11 +406,11 @@ async def delete_project(
         )
     return {"message": "Project deleted"}
 
-@api.get("/projects")
+@api.get("/projects", response_model=list[ProjectInDB])
 async def list_projects(
     request: Request,
     db: ProjectRepository = Depends(get_project_repository),
-) -> list[ProjectInDB]:
+) -> PydanticJSONResponse:
     if "user_id" not in request.session:
         raise HTTPException(
             status_code=401,
@@ -417,41 +419,84 @@ async def list_projects(
     user_id = request.session["user_id"]
 
     projects = await db.get_projects_by_user_id(user_id)
-    return projects
+    return PydanticJSONResponse(projects)
 
-@api.get("/projects/{project_id}/gen/risks")
+@api.get("/projects/{project_id}/gen/risks", response_model=list[Risk], dependencies=[Depends(rate_limit("generation"))])
 async def generate_project_risks(
     request: Request,
     project_id: int,
-    user_db: UserRepository = Depends(get_user_repository),
     project_db: ProjectRepository = Depends(get_project_repository),
     llm: LLM = Depends(get_llm_client),
-) -> list[Risk]:
+    seed: bool = False,
+) -> PydanticJSONResponse:
+    """Generate risks for a project, with `seed` the risks of similar past projects are given to the LLM as a starting point"""
     if "user_id" not in request.session:
         raise HTTPException(
             status_code=401,
             detail="Not logged in"
         )
     user_id = request.session["user_id"]
-    user_in_db: UserInDB = await user_db.get_user_by_id(user_id)
 
-    project = await project_db.get_project_by_id(project_id, user_id)
-    if project is None:
+    if seed:
+        context, seed_risks = await project_db.get_project_context_with_similar_risks(project_id, user_id)
+    else:
+        context, seed_risks = await project_db.get_project_context(project_id, user_id), None
+    if context is None:
         raise HTTPException(
             status_code=404,
             detail="Project not found"
         )
 
-    generated_risks = await llm.generate_risks(user_in_db.companyDescription, project)
+    generated_risks = await generate_risks(llm, project_db, user_id, context.companyDescription, context.project, seed_risks)
 
-    return generated_risks
+    return PydanticJSONResponse(generated_risks)
 
-@api.get("/projects/{project_id}/risks")
-async def get_project_risks(
+@api.get("/projects/{project_id}/drafts/{step}", response_model=GenerationDraft)
+async def get_draft(
+    request: Request,
+    project_id: int,
+    step: Literal['risks', 'scores', 'plans'],
+    project_db: ProjectRepository = Depends(get_project_repository),
+) -> PydanticJSONResponse:
+    """Latest unsaved generation result of a step, as long as its inputs did not change since"""
+    if "user_id" not in request.session:
+        raise HTTPException(
+            status_code=401,
+            detail="Not logged in"
+        )
+    user_id = request.session["user_id"]
+
+    context = await project_db.get_project_context(project_id, user_id)
+    if context is None:
+        raise HTTPException(
+            status_code=404,
+            detail="Project not found"
+        )
+
+    company_description, project = context.companyDescription, context.project
+    if step == STEP_RISKS:
+        key = risks_fingerprint(company_description, project)
+    elif step == STEP_SCORES:
+        key = scores_fingerprint(company_description, project, scoring_inputs(context.risks))
+    else:
+        key = plans_fingerprint(company_description, project, *planning_inputs(context.risks, project.riskScoreThreshold))
+
+    draft = await project_db.get_latest_generation(project_id, user_id, step, key, DRAFT_RETENTION_HOURS * 3600)
+    if draft is None:
+        raise HTTPException(
+            status_code=404,
+            detail="No draft found"
+        )
+    return PydanticJSONResponse(draft)
+
+@api.get("/projects/{project_id}/similar-risks", response_model=list[SimilarRisk])
+async def get_similar_risks(
     request: Request,
     project_id: int,
     db: ProjectRepository = Depends(get_project_repository),
-) -> Optional[list[RiskInDB]]:
+    limit: int = fastapi.Query(3, ge=1, le=10, description="Number of similar projects to take risks from"),
+) -> PydanticJSONResponse:
+    """Fast discovery: risks of the most similar past projects, available without waiting for the LLM"""
     if "user_id" not in request.session:
         raise HTTPException(
             status_code=401,
@@ -459,24 +504,95 @@ async def get_project_risks(
         )
     user_id = request.session["user_id"]
 
-    project = await db.get_project_by_id(project_id, user_id)
-    if project is None:
+    similar_risks = await db.get_similar_project_risks(project_id, user_id, limit)
+    if similar_risks is None:
         raise HTTPException(
             status_code=404,
             detail="Project not found"
         )
 
+    return PydanticJSONResponse(similar_risks)
+
+@api.get("/projects/{project_id}/risks", response_model=Optional[list[RiskInDB]])
+async def get_project_risks(
+    request: Request,
+    project_id: int,
+    db: ProjectRepository = Depends(get_project_repository),
+) -> PydanticJSONResponse:
+    if "user_id" not in request.session:
+        raise HTTPException(
+            status_code=401,
+            detail="Not logged in"
+        )
+    user_id = request.session["user_id"]
+
     risks = await db.get_project_risks(project_id, user_id)
+    if risks is None:
+        raise HTTPException(
+            status_code=404,
+            detail="Project not found"
+        )
+
+    return PydanticJSONResponse(risks)
+
+@api.get("/risks/search", response_model=RiskSearchPage)
+async def search_risks(
+    request: Request,
+    q: str = fastapi.Query(min_length=1, max_length=200, description="Search text, supports quoted phrases, OR and -word"),
+    kind: Optional[Literal['threat', 'opportunity']] = None,
+    limit: int = fastapi.Query(20, ge=1, le=100),
+    cursor: Optional[str] = fastapi.Query(None, description="nextCursor of the previous page"),
+    db: ProjectRepository = Depends(get_project_repository),
+) -> PydanticJSONResponse:
+    """Search the risks and plans of all the user's projects"""
+    if "user_id" not in request.session:
+        raise HTTPException(
+            status_code=401,
+            detail="Not logged in"
+        )
+    user_id = request.session["user_id"]
+
+    after = None
+    if cursor is not None:
+        rank, _, risk_id = cursor.partition(":")
+        try:
+            float(rank)
+            after = (rank, int(risk_id))
+        except ValueError:
+            raise HTTPException(
+                status_code=400,
+                detail="Invalid cursor"
+            )
+
+    page = await db.search_risks(user_id, q, kind, limit, after)
+    return PydanticJSONResponse(page)
+
+@api.get("/projects/{project_id}/usage", response_model=list[LLMUsage])
+async def get_project_usage(
+    request: Request,
+    project_id: int,
+    db: ProjectRepository = Depends(get_project_repository),
+) -> PydanticJSONResponse:
+    if "user_id" not in request.session:
+        raise HTTPException(
+            status_code=401,
+            detail="Not logged in"
+        )
+    user_id = request.session["user_id"]
 
-    return risks
+    usage = await db.get_project_llm_usage(project_id, user_id)
+    return PydanticJSONResponse(usage)
 
 @api.post("/projects/{project_id}/risks")
 async def add_project_risk(
     request: Request,
     project_id: int,
-    risks_data: list[Risk],
+    risks_data: list[SavedRisk],
     db: ProjectRepository = Depends(get_project_repository),
-) -> dict:
+    llm: LLM = Depends(get_llm_client),
+    generations: GenerationCache = Depends(get_generation_cache),
+) -> PydanticJSONResponse:
+    """Save the risk register, only the risks that were added, changed or removed are written"""
     if "user_id" not in request.session:
         raise HTTPException(
             status_code=401,
@@ -484,58 +600,141 @@ async def add_project_risk(
         )
     user_id = request.session["user_id"]
 
-    project = await db.get_project_by_id(project_id, user_id)
-    if project is None:
+    ids = [risk.id for risk in risks_data if risk.id is not None]
+    if len(ids) != len(set(ids)):
+        raise HTTPException(
+            status_code=422,
+            detail="Duplicate risk ids"
+        )
+
+    try:
+        added_risks = await db.save_project_risks(project_id, user_id, risks_data)
+    except StaleRisksError:
+        raise HTTPException(
+            status_code=409,
+            detail="Some of the risks were deleted meanwhile, reload the project"
+        )
+    if added_risks is None:
         raise HTTPException(
             status_code=404,
             detail="Project not found"
         )
-
-    added_risks = await db.add_project_risks(project_id, user_id, risks_data)
     if not added_risks:
         raise HTTPException(
             status_code=409,
             detail="Failed to add risks"
         )
 
-    return {"message": "Risks added", "risks": added_risks}
+    if SPECULATIVE_GENERATION:
+        await speculate_risk_scores(generations, llm, db, user_id, project_id)
 
+    return PydanticJSONResponse({"message": "Risks added", "risks": added_risks})
 
-@api.get("/projects/{project_id}/gen/risks/scores")
+@api.post("/projects/{project_id}/risks/new", response_model=RiskInDB)
+async def add_single_project_risk(
+    request: Request,
+    project_id: int,
+    risk: Risk,
+    db: ProjectRepository = Depends(get_project_repository),
+) -> PydanticJSONResponse:
+    if "user_id" not in request.session:
+        raise HTTPException(
+            status_code=401,
+            detail="Not logged in"
+        )
+    user_id = request.session["user_id"]
+
+    added_risk = await db.add_project_risk(project_id, user_id, risk)
+    if added_risk is None:
+        raise HTTPException(
+            status_code=404,
+            detail="Project not found"
+        )
+    return PydanticJSONResponse(added_risk)
+
+@api.patch("/projects/{project_id}/risks/{risk_id}", response_model=RiskInDB)
+async def update_project_risk(
+    request: Request,
+    project_id: int,
+    risk_id: int,
+    changes: RiskUpdate,
+    db: ProjectRepository = Depends(get_project_repository),
+) -> PydanticJSONResponse:
+    """Change some fields of a risk, the fields left out of the request keep their value"""
+    if "user_id" not in request.session:
+        raise HTTPException(
+            status_code=401,
+            detail="Not logged in"
+        )
+    user_id = request.session["user_id"]
+
+    updated_risk = await db.update_project_risk(project_id, user_id, risk_id, changes)
+    if updated_risk is None:
+        raise HTTPException(
+            status_code=404,
+            detail="Risk not found"
+        )
+    return PydanticJSONResponse(updated_risk)
+
+@api.delete("/projects/{project_id}/risks/{risk_id}")
+async def delete_project_risk(
+    request: Request,
+    project_id: int,
+    risk_id: int,
+    db: ProjectRepository = Depends(get_project_repository),
+) -> dict:
+    if "user_id" not in request.session:
+        raise HTTPException(
+            status_code=401,
+            detail="Not logged in"
+        )
+    user_id = request.session["user_id"]
+
+    if not await db.delete_project_risk(project_id, user_id, risk_id):
+        raise HTTPException(
+            status_code=404,
+            detail="Risk not found"
+        )
+    return {"message": "Risk deleted"}
+
+
+@api.get("/projects/{project_id}/gen/risks/scores", response_model=list[TrackedScoredRisk], dependencies=[Depends(rate_limit("generation"))])
 async def generate_risk_scores(
     request: Request,
     project_id: int,
-    user_db: UserRepository = Depends(get_user_repository),
     project_db: ProjectRepository = Depends(get_project_repository),
     llm: LLM = Depends(get_llm_client),
-) -> list[TrackedScoredRisk]:
+    generations: GenerationCache = Depends(get_generation_cache),
+) -> PydanticJSONResponse:
     if "user_id" not in request.session:
         raise HTTPException(
             status_code=401,
             detail="Not logged in"
         )
     user_id = request.session["user_id"]
-    user_in_db: UserInDB = await user_db.get_user_by_id(user_id)
 
-    project = await project_db.get_project_by_id(project_id, user_id)
-    if project is None:
+    context = await project_db.get_project_context(project_id, user_id)
+    if context is None:
         raise HTTPException(
             status_code=404,
             detail="Project not found"
         )
-
-    risks = await project_db.get_project_risks(project_id, user_id)
-    if not risks:
+    if not context.risks:
         raise HTTPException(
             status_code=404,
             detail="No risks found for the project"
         )
-    
-    risks = list(map(lambda r: TrackedRisk(**r.model_dump()), risks))
+    company_description, project = context.companyDescription, context.project
 
-    scored_risks = await llm.generate_risk_scores(user_in_db.companyDescription, project, risks)
+    risks = scoring_inputs(context.risks)
 
-    return scored_risks
+    # Use the result of a speculative generation started when the risks were saved, if the inputs did not change since
+    key = scores_fingerprint(company_description, project, risks)
+    scored_risks = await generations.take(project_id, STEP_SCORES, key)
+    if scored_risks is None:
+        scored_risks = await generate_scores(llm, project_db, user_id, company_description, project, risks)
+
+    return PydanticJSONResponse(scored_risks)
 
 @api.post("/projects/{project_id}/risks/scores")
 async def add_risk_scores(
@@ -543,7 +742,9 @@ async def add_risk_scores(
     project_id: int,
     qualitative_analysis_data: QualitativeAnalysisData,
     db: ProjectRepository = Depends(get_project_repository),
-) -> dict:
+    llm: LLM = Depends(get_llm_client),
+    generations: GenerationCache = Depends(get_generation_cache),
+) -> PydanticJSONResponse:
     if "user_id" not in request.session:
         raise HTTPException(
             status_code=401,
@@ -551,77 +752,62 @@ async def add_risk_scores(
         )
     user_id = request.session["user_id"]
 
-    project = await db.get_project_by_id(project_id, user_id)
-    if project is None:
+    scored_risks = qualitative_analysis_data.risks
+    riskScoreThreshold = qualitative_analysis_data.riskScoreThreshold
+    updated_risks = await db.add_project_risks_scores(project_id, user_id, scored_risks, riskScoreThreshold)
+    if updated_risks is None:
         raise HTTPException(
             status_code=404,
             detail="Project not found"
         )
-    scored_risks = qualitative_analysis_data.risks
-    riskScoreThreshold = qualitative_analysis_data.riskScoreThreshold
-    updated_risks = await db.add_project_risks_scores(project_id, user_id, scored_risks, riskScoreThreshold)
     if not updated_risks:
         raise HTTPException(
             status_code=409,
             detail="Failed to add risk scores"
         )
-    return {"message": "Risk scores added", "risks": updated_risks}
 
-@api.get("/projects/{project_id}/gen/risks/plans")
+    if SPECULATIVE_GENERATION:
+        await speculate_risk_plans(generations, llm, db, user_id, project_id)
+
+    return PydanticJSONResponse({"message": "Risk scores added", "risks": updated_risks})
+
+@api.get("/projects/{project_id}/gen/risks/plans", response_model=list[TrackedManagedRisk], dependencies=[Depends(rate_limit("generation"))])
 async def generate_risk_plans(
     request: Request,
     project_id: int,
-    user_db: UserRepository = Depends(get_user_repository),
     project_db: ProjectRepository = Depends(get_project_repository),
     llm: LLM = Depends(get_llm_client),
-) -> list[TrackedManagedRisk]:
+    generations: GenerationCache = Depends(get_generation_cache),
+) -> PydanticJSONResponse:
     if "user_id" not in request.session:
         raise HTTPException(
             status_code=401,
             detail="Not logged in"
         )
     user_id = request.session["user_id"]
-    user_in_db: UserInDB = await user_db.get_user_by_id(user_id)
 
-    project = await project_db.get_project_by_id(project_id, user_id)
-    if project is None:
+    context = await project_db.get_project_context(project_id, user_id)
+    if context is None:
         raise HTTPException(
             status_code=404,
             detail="Project not found"
         )
-
-    risks = await project_db.get_project_risks(project_id, user_id)
-    if not risks:
+    if not context.risks:
         raise HTTPException(
             status_code=404,
             detail="No risks found for the project"
         )
+    company_description, project = context.companyDescription, context.project
 
-    # Filter the risks to only those that have impact*probability > project.risk_score_threshold*100
-    significant_risks = []
-    insignificant_risks = []
-    for risk in risks:
-        tracked_risk = TrackedScoredRisk(
-            id=risk.id,
-            title=risk.title,
-            kind=risk.kind,
-            description=risk.description,
-            impact=risk.impact or 1,
-            probability=risk.probability or 1
-        )
-        risk_score = tracked_risk.impact * tracked_risk.probability
-        threshold_score = (project.riskScoreThreshold or 0) * 100
-
-        if risk_score > threshold_score:
-            significant_risks.append(tracked_risk)
-        else:
-            insignificant_risks.append(tracked_risk)
-
-    significant_risks = list(map(lambda r: TrackedScoredRisk(**r.model_dump()), significant_risks))
+    significant_risks, insignificant_risks = planning_inputs(context.risks, project.riskScoreThreshold)
 
-    managed_risks = await llm.generate_risk_mitigation_plan(user_in_db.companyDescription, project, significant_risks)
+    # Use the result of a speculative generation started when the scores were saved, if the inputs did not change since
+    key = plans_fingerprint(company_description, project, significant_risks, insignificant_risks)
+    managed_risks = await generations.take(project_id, STEP_PLANS, key)
+    if managed_risks is None:
+        managed_risks = await generate_plans(llm, project_db, user_id, company_description, project, significant_risks, insignificant_risks)
 
-    return managed_risks + [TrackedManagedRisk(**r.model_dump(), contingency=None, fallback=None) for r in insignificant_risks]
+    return PydanticJSONResponse(managed_risks)
 
 @api.post("/projects/{project_id}/risks/plans")
 async def add_risk_plans(
@@ -629,7 +815,7 @@ async def add_risk_plans(
     project_id: int,
     managed_risks: list[TrackedManagedRisk],
     db: ProjectRepository = Depends(get_project_repository),
-) -> dict:
+) -> PydanticJSONResponse:
     if "user_id" not in request.session:
         raise HTTPException(
             status_code=401,
@@ -637,19 +823,56 @@ async def add_risk_plans(
         )
     user_id = request.session["user_id"]
 
-    project = await db.get_project_by_id(project_id, user_id)
-    if project is None:
+    updated_risks = await db.add_project_risks_plans(project_id, user_id, managed_risks)
+    if updated_risks is None:
         raise HTTPException(
             status_code=404,
             detail="Project not found"
         )
-    updated_risks = await db.add_project_risks_plans(project_id, user_id, managed_risks)
     if not updated_risks:
         raise HTTPException(
             status_code=409,
             detail="Failed to add risk plans"
         )
-    return {"message": "Risk plans added", "risks": updated_risks}
+    return PydanticJSONResponse({"message": "Risk plans added", "risks": updated_risks})
+
+@api.post("/projects/{project_id}/analysis", response_model=QuantitativeAnalysis, dependencies=[Depends(rate_limit("analysis"))])
+async def quantitative_analysis(
+    request: Request,
+    project_id: int,
+    analysis_data: QuantitativeAnalysisRequest,
+    db: ProjectRepository = Depends(get_project_repository),
+    analyses: AnalysisCache = Depends(get_analysis_cache),
+) -> PydanticJSONResponse:
+    """Monte Carlo simulation of the scored risks: expected monetary value, percentiles of the outcome and of the
+    threat exposure, and tornado sensitivity. Risks get monetary ranges from `ranges`, the others from their impact score"""
+    if "user_id" not in request.session:
+        raise HTTPException(
+            status_code=401,
+            detail="Not logged in"
+        )
+    user_id = request.session["user_id"]
+
+    context = await db.get_project_context(project_id, user_id)
+    if context is None:
+        raise HTTPException(
+            status_code=404,
+            detail="Project not found"
+        )
+    risk_ids = {risk.id for risk in context.risks}
+    if any(r.riskId not in risk_ids for r in analysis_data.ranges):
+        raise HTTPException(
+            status_code=422,
+            detail="Monetary range of an unknown risk"
+        )
+
+    analysis = await analyze(analyses, project_id, context.risks, analysis_data)
+    if analysis is None:
+        raise HTTPException(
+            status_code=404,
+            detail="No scored risks found for the project"
+        )
+    return PydanticJSONResponse(analysis)
 
 @api.get("/projects/{project_id}/download")
 async def download_project_file(
@@ -664,14 +887,13 @@ async def download_project_file(
         )
     user_id = request.session["user_id"]
 
-    project : Optional[ProjectInDB] = await db.get_project_by_id(project_id, user_id)
-    if project is None:
+    context = await db.get_project_context(project_id, user_id)
+    if context is None:
         raise HTTPException(
             status_code=404,
             detail="Project not found"
         )
-
-    risks : list[RiskInDB] = await db.get_project_risks(project_id, user_id)
+    project, risks = context.project, context.risks
     
     # Generate project file json in memory
     
@@ -1,12 +1,26 @@
+import asyncio
 import os
 import fastapi
 from fastapi.concurrency import asynccontextmanager
 from starlette.middleware.sessions import SessionMiddleware
 import logging
-import psycopg
+from psycopg_pool import AsyncConnectionPool
 
 from api import api
-from llm import LLM
+from budget import DB_LISTEN_CONNECTIONS, DB_POOL_BUDGET, DB_POOL_MIN_CONNECTIONS, pool_max_size
+from compression import CompressionMiddleware
+from database import ProjectRepository
+from generation import GenerationCache, cleanup_drafts
+from invalidation import listen, subscribe, unsubscribe
+from jobs import LLM_QUEUE, LLM_QUEUE_CONCURRENCY, JobFailed, LLMQueue, QueuedLLM
+from llm import LLM, LLMOutputTruncated
+from metrics import MetricsMiddleware, mark_worker_dead, monitor_worker
+from migrations import migrate
+from purge import purge_deleted
+from quantitative import AnalysisCache
+from ratelimit import create_rate_limiter
+from replicas import DB_REPLICA_HOSTS, ReadYourWritesMiddleware, RoutingPool
+from tracing import TracingMiddleware
 
 logger = logging.getLogger(__name__)
 
@@ -14,33 +28,127 @@ LLM_HOST = os.getenv("LLM_HOST", "http://localhost:8000")
 LLM_PORT = os.getenv("LLM_PORT", "11434")
 LLM_MODEL = os.getenv("LLM_MODEL", "gemma3:latest")
 LLM_API_KEY = os.getenv("LLM_API_KEY", "")
+# Output token caps per LLM operation (0 means no cap) and maximum length of free-text fields put in prompts
+LLM_MAX_COMPLETION_TOKENS = {
+    "generate_risks": int(os.getenv("LLM_MAX_TOKENS_GENERATE_RISKS", "4096")),
+    "generate_risk_scores": int(os.getenv("LLM_MAX_TOKENS_GENERATE_RISK_SCORES", "2048")),
+    "generate_risk_mitigation_plan": int(os.getenv("LLM_MAX_TOKENS_GENERATE_RISK_MITIGATION_PLAN", "1024")),
+}
+# Added to the cap for every risk of the call, the scores of a whole register come in one answer.
+# The mitigation plans are asked one risk per call, so their cap already holds for any register
+LLM_COMPLETION_TOKENS_PER_RISK = {
+    "generate_risk_scores": int(os.getenv("LLM_TOKENS_PER_RISK_GENERATE_RISK_SCORES", "40")),
+}
+LLM_MAX_FIELD_CHARS = int(os.getenv("LLM_MAX_FIELD_CHARS", "2000"))
 
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = os.getenv("DB_PORT", "5432")
 DB_NAME = os.getenv("DB_NAME", "aira")
 DB_USER = os.getenv("DB_USER", "root")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "password")
+# Set by run.py, the DB connection budget is split between the worker processes
+BACKEND_WORKERS = int(os.getenv("BACKEND_WORKERS", "1"))
+DB_POOL_MAX_SIZE = pool_max_size(BACKEND_WORKERS)
+if DB_POOL_MAX_SIZE < DB_POOL_MIN_CONNECTIONS:
+    raise RuntimeError(
+        f"DB_POOL_BUDGET={DB_POOL_BUDGET} leaves less than {DB_POOL_MIN_CONNECTIONS} pooled connections to each of the {BACKEND_WORKERS} workers "
+        f"besides {DB_LISTEN_CONNECTIONS} for LISTEN, raise it or lower BACKEND_WORKERS"
+    )
+DB_POOL_MIN_SIZE = DB_POOL_MIN_CONNECTIONS
+# Executions of a query on a connection before it is turned into a server-side prepared statement,
+# so it is parsed and planned once per connection. Negative to never prepare, as needed behind PgBouncer in transaction mode
+DB_PREPARE_THRESHOLD = int(os.getenv("DB_PREPARE_THRESHOLD", "0"))
+DB_CONNECTION_KWARGS = {"autocommit": True, "prepare_threshold": DB_PREPARE_THRESHOLD if DB_PREPARE_THRESHOLD >= 0 else None}
 
 SECRET_KEY = os.getenv("SECRET_KEY", "supersecretkey") # In production, use a secure key from environment variables
 
-@asynccontextmanager
-async def lifespan(app: fastapi.FastAPI):
-    app.state.db = await psycopg.AsyncConnection.connect(
-        f"host={DB_HOST} port={DB_PORT} user={DB_USER} password={DB_PASSWORD} dbname={DB_NAME}",
-        autocommit=True
-    )
-    logger.info("Database connection established.")
-    app.state.llm = LLM(
+COMPRESSION_MINIMUM_SIZE = int(os.getenv("COMPRESSION_MINIMUM_SIZE", "1024"))
+
+def create_llm() -> LLM:
+    return LLM(
         url=f"http://{LLM_HOST}:{LLM_PORT}/v1",
         model=LLM_MODEL,
-        api_key=LLM_API_KEY
+        api_key=LLM_API_KEY,
+        max_completion_tokens=LLM_MAX_COMPLETION_TOKENS,
+        max_field_chars=LLM_MAX_FIELD_CHARS,
+        completion_tokens_per_risk=LLM_COMPLETION_TOKENS_PER_RISK
     )
+
+def primary_conninfo() -> str:
+    return f"host={DB_HOST} port={DB_PORT} user={DB_USER} password={DB_PASSWORD} dbname={DB_NAME}"
+
+def replica_conninfo(replica: str) -> str:
+    host, _, port = replica.partition(":")
+    return f"host={host} port={port or DB_PORT} user={DB_USER} password={DB_PASSWORD} dbname={DB_NAME}"
+
+@asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    app.state.db = AsyncConnectionPool(
+        primary_conninfo(),
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        kwargs=DB_CONNECTION_KWARGS,
+        open=False
+    )
+    await app.state.db.open(wait=True)
+    logger.info(f"Database connection pool established ({DB_POOL_MIN_SIZE}-{DB_POOL_MAX_SIZE} connections).")
+    await migrate(app.state.db)
+    replicas = [
+        AsyncConnectionPool(
+            replica_conninfo(replica),
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            kwargs=DB_CONNECTION_KWARGS,
+            open=False
+        ) for replica in DB_REPLICA_HOSTS
+    ]
+    for replica in replicas:
+        # Not waited for, an unavailable replica only sends its reads to the primary
+        await replica.open(wait=False)
+    if replicas:
+        logger.info(f"Reading from {len(replicas)} replicas ({', '.join(DB_REPLICA_HOSTS)}).")
+    app.state.db_router = RoutingPool(app.state.db, replicas)
+    llm = create_llm()
     logger.info("LLM client initialized.")
+    background = []
+    if LLM_QUEUE:
+        # The routes queue their LLM calls, this instance runs its share of the queue
+        llm_queue = LLMQueue(app.state.db, primary_conninfo())
+        app.state.llm = QueuedLLM(llm_queue)
+        background.append(asyncio.create_task(llm_queue.serve(llm if LLM_QUEUE_CONCURRENCY > 0 else None, LLM_QUEUE_CONCURRENCY)))
+        logger.info(f"Queueing the LLM calls, running {LLM_QUEUE_CONCURRENCY} at once.")
+    else:
+        app.state.llm = llm
+    app.state.rate_limiter = create_rate_limiter(app.state.db)
+    app.state.generations = GenerationCache()
+    # Writes of the other workers evict the cached entries through Postgres notifications
+    subscribe(app.state.generations.evict)
+    app.state.analyses = AnalysisCache()
+    subscribe(app.state.analyses.evict)
+    background += [
+        asyncio.create_task(listen(primary_conninfo())),
+        asyncio.create_task(monitor_worker(app.state.db)),
+        asyncio.create_task(cleanup_drafts(ProjectRepository(app.state.db))),
+        asyncio.create_task(purge_deleted(ProjectRepository(app.state.db), primary_conninfo())),
+    ]
     yield
+    for task in background:
+        task.cancel()
+    # Let the cancelled tasks give their connections back before the pool closes
+    await asyncio.gather(*background, return_exceptions=True)
+    unsubscribe(app.state.generations.evict)
+    unsubscribe(app.state.analyses.evict)
+    await app.state.generations.close()
+    for replica in replicas:
+        await replica.close()
     await app.state.db.close()
-    logger.info("Database connection closed.")
+    logger.info("Database connection pool closed.")
+    mark_worker_dead()
 
 app = fastapi.FastAPI(lifespan=lifespan, docs_url="/api/docs", redoc_url="/api/redoc", openapi_url="/api/openapi.json")
+if DB_REPLICA_HOSTS:
+    # Added first so it runs inside SessionMiddleware
+    app.add_middleware(ReadYourWritesMiddleware)
 app.add_middleware(
     SessionMiddleware,
     secret_key=SECRET_KEY,  # In production, use a secure key from environment variables
@@ -50,4 +158,15 @@ app.add_middleware(
     path="/",
     domain=None  # Let the browser determine the domain
 )
+app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MINIMUM_SIZE)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
 app.include_router(api)
+
+
+@app.exception_handler(LLMOutputTruncated)
+@app.exception_handler(JobFailed)
+async def llm_failure(request: fastapi.Request, exc: Exception) -> fastapi.responses.JSONResponse:
+    """A generation the LLM could not complete, rather than an unhandled error"""
+    logger.warning(f"LLM call failed for {request.url.path}: {exc}")
+    return fastapi.responses.JSONResponse(status_code=502, content={"detail": "The LLM could not complete the generation"})
@@ -0,0 +1,191 @@
+"""Per-request database time under network latency.
+
+Connects to the database configured by the usual DB_* environment variables
+through a local TCP proxy delaying every packet by `--latency-ms` in each
+direction, the way a database container on another host adds a network hop,
+and times the repository calls of the hot requests with and without
+server-side prepared statements, and the seeded risk discovery read with its
+two queries sent one after the other or pipelined. A throwaway user owning a
+project with `--risks` risks and a few similar past projects is created and
+deleted at the end.
+
+Usage: python benchmarks/db_latency.py [--latency-ms 1] [--risks 20] [--repeat 200]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from psycopg_pool import AsyncConnectionPool
+
+from database import ProjectRepository
+from models import SavedRisk
+from ratelimit import Limit, PostgresRateLimiter
+
+DB_HOST = os.getenv("DB_HOST", "localhost")
+DB_PORT = os.getenv("DB_PORT", "5432")
+DB_NAME = os.getenv("DB_NAME", "aira")
+DB_USER = os.getenv("DB_USER", "root")
+DB_PASSWORD = os.getenv("DB_PASSWORD", "password")
+
+SIMILAR_PROJECTS = 3
+
+
+class LatencyProxy:
+    """TCP proxy forwarding to the database, every chunk is delivered `latency` seconds after it was received"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.server: asyncio.Server = None
+        self.tasks: set[asyncio.Task] = set()
+
+    async def start(self) -> int:
+        self.server = await asyncio.start_server(self._connect, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def _connect(self, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter):
+        upstream_reader, upstream_writer = await asyncio.open_connection(DB_HOST, int(DB_PORT))
+        for reader, writer in ((client_reader, upstream_writer), (upstream_reader, client_writer)):
+            task = asyncio.create_task(self._pump(reader, writer))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _pump(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Chunks are queued with their delivery time so the delay does not throttle the bandwidth
+        queue: asyncio.Queue[tuple[float, bytes]] = asyncio.Queue()
+
+        async def deliver():
+            while True:
+                deadline, data = await queue.get()
+                await asyncio.sleep(deadline - time.perf_counter())
+                if not data:
+                    writer.close()
+                    return
+                writer.write(data)
+                await writer.drain()
+
+        delivery = asyncio.create_task(deliver())
+        try:
+            while True:
+                data = await reader.read(65536)
+                queue.put_nowait((time.perf_counter() + self.latency, data))
+                if not data:
+                    break
+            await delivery
+        finally:
+            delivery.cancel()
+
+
+async def seed(pool: AsyncConnectionPool, risks: int) -> tuple[int, int]:
+    """Create the user and its projects, returns the user id and the id of the project to query"""
+    async with pool.connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                "INSERT INTO users (username, password_hash) VALUES (%s, '') RETURNING id",
+                (f"bench-latency-{uuid.uuid4().hex[:8]}",)
+            )
+            user_id = (await cursor.fetchone())[0]
+            await cursor.execute(
+                """
+                INSERT INTO projects (user_id, title, description)
+                SELECT %s, 'Online shop ' || i, 'Online shop selling handmade furniture'
+                FROM generate_series(0, %s) i
+                ORDER BY i
+                RETURNING id
+                """,
+                (user_id, SIMILAR_PROJECTS)
+            )
+            project_ids = [row[0] for row in await cursor.fetchall()]
+            await cursor.execute(
+                """
+                INSERT INTO risks (project_id, kind, title, description, impact, probability)
+                SELECT p, 'threat', 'Supplier delay ' || i, 'Furniture supplier delivers late', 1 + i %% 10, 1 + i %% 7
+                FROM unnest(%s::int[]) p, generate_series(1, %s) i
+                """,
+                (project_ids, risks)
+            )
+    return user_id, project_ids[0]
+
+
+async def cleanup(pool: AsyncConnectionPool, user_id: int, bucket_prefix: str):
+    async with pool.connection() as conn:
+        await conn.execute("DELETE FROM users WHERE id = %s", (user_id,))
+        await conn.execute("DELETE FROM rate_limit_buckets WHERE key LIKE %s", (bucket_prefix + "%",))
+
+
+async def measure(call, repeat: int) -> list[float]:
+    # The first call prepares the statements and warms the connection, it is not measured
+    await call()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await call()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def scenarios(repository: ProjectRepository, limiter: PostgresRateLimiter, user_id: int, project_id: int, risks: list[SavedRisk], bucket_prefix: str):
+    async def seeded_context_sequential():
+        await repository.get_project_context(project_id, user_id)
+        await repository.get_similar_project_risks(project_id, user_id)
+
+    limit = Limit(rate=1_000_000, burst=1_000_000)
+    return {
+        "project context": lambda: repository.get_project_context(project_id, user_id),
+        "project risks": lambda: repository.get_project_risks(project_id, user_id),
+        "save risks": lambda: repository.save_project_risks(project_id, user_id, risks),
+        "seeded context, sequential": seeded_context_sequential,
+        "seeded context, pipelined": lambda: repository.get_project_context_with_similar_risks(project_id, user_id),
+        "rate limit, 2 buckets": lambda: limiter.acquire([(f"{bucket_prefix}user", limit), (f"{bucket_prefix}global", limit)]),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency-ms", type=float, default=1.0, help="One-way delay added to every packet")
+    parser.add_argument("--risks", type=int, default=20, help="Risks per project")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    proxy = LatencyProxy(args.latency_ms / 1000)
+    proxy_port = await proxy.start()
+    conninfo = f"host=127.0.0.1 port={proxy_port} dbname={DB_NAME} user={DB_USER} password={DB_PASSWORD}"
+    bucket_prefix = f"bench-latency-{uuid.uuid4().hex[:8]}:"
+    risks = [SavedRisk(kind="threat", title=f"Supplier delay {i}", description="Furniture supplier delivers late") for i in range(args.risks)]
+
+    async with AsyncConnectionPool(conninfo, min_size=1, max_size=1, kwargs={"autocommit": True}, open=False) as pool:
+        user_id, project_id = await seed(pool, args.risks)
+        try:
+            results = {}
+            for mode, prepare_threshold in (("text", None), ("prepared", 0)):
+                kwargs = {"autocommit": True, "prepare_threshold": prepare_threshold}
+                async with AsyncConnectionPool(conninfo, min_size=1, max_size=1, kwargs=kwargs, open=False) as mode_pool:
+                    calls = scenarios(ProjectRepository(mode_pool), PostgresRateLimiter(mode_pool), user_id, project_id, risks, bucket_prefix)
+                    for name, call in calls.items():
+                        results[(name, mode)] = await measure(call, args.repeat)
+        finally:
+            await cleanup(pool, user_id, bucket_prefix)
+    await proxy.close()
+
+    print(f"One-way latency {args.latency_ms} ms, round trip {2 * args.latency_ms} ms")
+    print(f"{'request':>28} {'mode':>9} {'mean ms':>8} {'p95 ms':>8}")
+    for name, mode in sorted(results, key=lambda key: list(results).index((key[0], "text"))):
+        timings = results[(name, mode)]
+        p95 = sorted(timings)[int(len(timings) * 0.95) - 1] if len(timings) > 1 else timings[0]
+        print(f"{name:>28} {mode:>9} {statistics.mean(timings):>8.2f} {p95:>8.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
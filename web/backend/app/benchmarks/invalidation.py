@@ -0,0 +1,81 @@
+"""Latency of the cross-worker cache invalidation and check of its reconnect flush.
+
+Runs the invalidation listener of invalidation.py and plays another worker
+publishing `--count` project changes from its own connection, then reports
+the delay between each notification and its eviction here. The listening
+connection is then terminated from the server side, which must end with a full
+flush once the listener is back. The database settings are read from the
+usual DB_* environment variables.
+
+Usage: python benchmarks/invalidation.py [--count 1000]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import psycopg
+
+import invalidation
+
+DB_HOST = os.getenv("DB_HOST", "localhost")
+DB_PORT = os.getenv("DB_PORT", "5432")
+DB_NAME = os.getenv("DB_NAME", "aira")
+DB_USER = os.getenv("DB_USER", "root")
+DB_PASSWORD = os.getenv("DB_PASSWORD", "password")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=1_000, help="Notifications to send")
+    args = parser.parse_args()
+
+    conninfo = f"host={DB_HOST} port={DB_PORT} dbname={DB_NAME} user={DB_USER} password={DB_PASSWORD}"
+    sent: dict[str, float] = {}
+    delays: list[float] = []
+    flushed = asyncio.Event()
+    received = asyncio.Event()
+
+    def on_evict(key: Optional[str]):
+        if key is None:
+            flushed.set()
+        elif key in sent:
+            delays.append(time.perf_counter() - sent.pop(key))
+            if not sent:
+                received.set()
+
+    invalidation.INVALIDATION_RECONNECT_SECONDS = 0.1
+    invalidation.subscribe(on_evict)
+    listener = asyncio.create_task(invalidation.listen(conninfo))
+    async with await psycopg.AsyncConnection.connect(conninfo, autocommit=True) as conn:
+        # Wait for the listener to be subscribed to the channel
+        while not (await (await conn.execute("SELECT count(*) FROM pg_stat_activity WHERE query = %s", (f"LISTEN {invalidation.INVALIDATION_CHANNEL}",))).fetchone())[0]:
+            await asyncio.sleep(0.05)
+
+        for i in range(args.count):
+            key = f"project:{i}"
+            sent[key] = time.perf_counter()
+            await conn.execute("SELECT pg_notify(%s, %s)", (invalidation.INVALIDATION_CHANNEL, f"other-worker {key}"))
+        await asyncio.wait_for(received.wait(), 10)
+
+        delays.sort()
+        print(f"{args.count} invalidations from another worker")
+        print(f"  eviction delay p50 {statistics.median(delays) * 1000:.2f} ms, p99 {delays[int(len(delays) * 0.99) - 1] * 1000:.2f} ms, max {delays[-1] * 1000:.2f} ms")
+
+        start = time.perf_counter()
+        await conn.execute("SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE query = %s", (f"LISTEN {invalidation.INVALIDATION_CHANNEL}",))
+        await asyncio.wait_for(flushed.wait(), 10)
+        print(f"Listening connection terminated, caches flushed after {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    listener.cancel()
+    await asyncio.gather(listener, return_exceptions=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
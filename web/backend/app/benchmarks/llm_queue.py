@@ -0,0 +1,146 @@
+"""Throughput and fault handling of the Postgres LLM work queue.
+
+Queues `--jobs` risk generations from a requesting instance and has them run by
+1, 2 and 4 worker instances, each with its own connection pool and
+`--concurrency` calls at once, against a stand-in LLM answering in `--call-ms`.
+Then checks that a call claimed by a worker that died is run again once its
+lease ran out, and that failing calls are retried and dead-lettered. The
+database settings are read from the usual DB_* environment variables.
+
+Usage: python benchmarks/llm_queue.py [--jobs 200] [--concurrency 4] [--call-ms 200]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+APP_PATH = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(APP_PATH / "mockups"), str(APP_PATH)]
+
+DB_HOST = os.getenv("DB_HOST", "localhost")
+DB_PORT = os.getenv("DB_PORT", "5432")
+DB_NAME = os.getenv("DB_NAME", "aira")
+DB_USER = os.getenv("DB_USER", "root")
+DB_PASSWORD = os.getenv("DB_PASSWORD", "password")
+
+CONNINFO = f"host={DB_HOST} port={DB_PORT} dbname={DB_NAME} user={DB_USER} password={DB_PASSWORD}"
+
+
+class SlowLLM:
+    """The mockup LLM answering after a delay, failing the first `failures` calls"""
+
+    def __init__(self, delay: float, failures: int = 0):
+        from llm import LLM
+        self.llm = LLM(url="", model="")
+        self.delay = delay
+        self.failures = failures
+
+    async def generate_risks(self, *args, **kwargs):
+        await asyncio.sleep(self.delay)
+        if self.failures > 0:
+            self.failures -= 1
+            raise RuntimeError("LLM server unavailable")
+        return await self.llm.generate_risks(*args, **kwargs)
+
+
+async def instance(llm, concurrency: int):
+    """A backend instance or worker process: its own pool and queue, serving until cancelled"""
+    from psycopg_pool import AsyncConnectionPool
+
+    from jobs import LLMQueue
+
+    async with AsyncConnectionPool(CONNINFO, min_size=1, max_size=concurrency + 2, kwargs={"autocommit": True}, open=False) as pool:
+        await LLMQueue(pool, CONNINFO).serve(llm, concurrency)
+
+
+async def throughput(requester, workers: int, jobs: int, concurrency: int, delay: float) -> float:
+    from models import Project, TokenUsage
+    from jobs import QueuedLLM
+
+    servers = [asyncio.create_task(instance(SlowLLM(delay), concurrency)) for _ in range(workers)]
+    llm = QueuedLLM(requester)
+    project = Project(title="Online shop", description="Selling furniture online")
+    try:
+        start = time.perf_counter()
+        results = await asyncio.gather(*[llm.generate_risks("Furniture maker", project, usage=TokenUsage()) for _ in range(jobs)])
+        elapsed = time.perf_counter() - start
+    finally:
+        for server in servers:
+            server.cancel()
+        await asyncio.gather(*servers, return_exceptions=True)
+    assert all(len(risks) == 5 for risks in results)
+    return jobs / elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4, help="Calls run at once by each worker instance")
+    parser.add_argument("--call-ms", type=float, default=200, help="Latency of the stand-in LLM")
+    args = parser.parse_args()
+
+    # Read when the modules are imported, short so the fault checks finish quickly
+    os.environ.setdefault("LLM_QUEUE_LEASE_SECONDS", "1")
+    os.environ.setdefault("LLM_QUEUE_RETRY_DELAY", "0.1")
+    os.environ.setdefault("LLM_QUEUE_MAX_ATTEMPTS", "3")
+
+    from prometheus_client import REGISTRY
+    from psycopg_pool import AsyncConnectionPool
+
+    from jobs import JobFailed, LLMQueue, QueuedLLM
+    from models import Project
+
+    delay = args.call_ms / 1000
+    async with AsyncConnectionPool(CONNINFO, min_size=1, max_size=20, kwargs={"autocommit": True}, open=False) as pool:
+        requester = LLMQueue(pool, CONNINFO)
+        listener = asyncio.create_task(requester.serve(None, 0))
+        try:
+            print(f"{args.jobs} calls of {args.call_ms:.0f} ms, {args.concurrency} at once per worker instance")
+            print(f"  ideal per instance: {args.concurrency / delay:.1f} calls/s")
+            for workers in (1, 2, 4):
+                rate = await throughput(requester, workers, args.jobs, args.concurrency, delay)
+                print(f"  {workers} instances: {rate:.1f} calls/s")
+
+            # A worker claims a call and dies without a word, the maintenance of a live instance requeues it
+            project = Project(title="Online shop", description="Selling furniture online")
+            call = asyncio.create_task(QueuedLLM(requester).generate_risks("", project))
+            await asyncio.sleep(0.1)
+            dead_worker = LLMQueue(pool, CONNINFO)
+            job = await dead_worker._claim()
+            assert job is not None
+            start = time.perf_counter()
+            server = asyncio.create_task(instance(SlowLLM(delay), 1))
+            risks = await call
+            print(f"Call of a dead worker run again after {time.perf_counter() - start:.1f}s, {len(risks)} risks")
+
+            # A call failing twice then succeeding, and one failing on every attempt
+            server.cancel()
+            await asyncio.gather(server, return_exceptions=True)
+            server = asyncio.create_task(instance(SlowLLM(delay, failures=2), 1))
+            risks = await QueuedLLM(requester).generate_risks("", project)
+            print(f"Call failing twice succeeded on its third attempt, {len(risks)} risks")
+            server.cancel()
+            await asyncio.gather(server, return_exceptions=True)
+            server = asyncio.create_task(instance(SlowLLM(delay, failures=3), 1))
+            try:
+                await QueuedLLM(requester).generate_risks("", project)
+                print("Call failing every time succeeded?")
+            except JobFailed as e:
+                print(f"Call failing every time dead-lettered: {e}")
+            server.cancel()
+            await asyncio.gather(server, return_exceptions=True)
+        finally:
+            listener.cancel()
+            await asyncio.gather(listener, return_exceptions=True)
+            async with pool.connection() as conn:
+                await conn.execute("DELETE FROM llm_jobs WHERE status = 'dead' AND error LIKE '%%LLM server unavailable%%'")
+
+    for outcome in ("done", "retried", "dead", "lost"):
+        value = REGISTRY.get_sample_value("llm_jobs_total", {"operation": "generate_risks", "outcome": outcome}) or 0
+        print(f"{outcome:>8} calls: {int(value)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,168 @@
+"""End-to-end load test of the risk workflow.
+
+Simulates concurrent users going through the whole workflow (register, create
+project, discover, save risks, score, save scores, plan, save plans, download)
+against the FastAPI app, served in-process with the mock LLM (mockups/llm.py)
+and the database configured by the usual DB_* environment variables. Reports
+the throughput, the latency percentiles and the number of database round trips
+of every endpoint as JSON, so runs can be compared to catch regressions.
+
+Usage: python benchmarks/load_test.py [--users 20] [--iterations 5] [--output results.json]
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from pathlib import Path
+
+APP_PATH = Path(__file__).resolve().parent.parent
+# The mock LLM module shadows llm.py
+sys.path[:0] = [str(APP_PATH / "mockups"), str(APP_PATH)]
+os.environ.setdefault("RATE_LIMIT_BACKEND", "off")
+os.environ.setdefault("BACKEND_FILE_PATH", tempfile.mkdtemp(prefix="aira-load-test-"))
+
+import httpx
+import psycopg
+
+from app import app
+
+PASSWORD = "load-test"
+
+_current_endpoint: contextvars.ContextVar[str] = contextvars.ContextVar("current_endpoint", default="other")
+round_trips: dict[str, int] = defaultdict(int)
+latencies: dict[str, list[float]] = defaultdict(list)
+errors: dict[str, int] = defaultdict(int)
+
+
+def count_round_trips():
+    """Count the database round trips, by the endpoint being requested.
+
+    A statement sent on its own is a round trip. The statements of a pipeline only
+    wait for their results together, when it is synced, so the sync is counted instead.
+    """
+    def counted(method):
+        async def wrapper(self, *args, **kwargs):
+            round_trips[_current_endpoint.get()] += 1
+            return await method(self, *args, **kwargs)
+        return wrapper
+
+    def execute(method):
+        async def wrapper(self, *args, **kwargs):
+            if self.connection._pipeline is None:
+                round_trips[_current_endpoint.get()] += 1
+            return await method(self, *args, **kwargs)
+        return wrapper
+
+    psycopg.AsyncCursor.execute = execute(psycopg.AsyncCursor.execute)
+    # executemany runs in a pipeline of its own, counted when it exits
+    psycopg.AsyncPipeline.sync = counted(psycopg.AsyncPipeline.sync)
+    psycopg.AsyncPipeline.__aexit__ = counted(psycopg.AsyncPipeline.__aexit__)
+
+
+async def call(client: httpx.AsyncClient, endpoint: str, method: str, url: str, **kwargs) -> httpx.Response:
+    token = _current_endpoint.set(endpoint)
+    start = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+    finally:
+        latencies[endpoint].append(time.perf_counter() - start)
+        _current_endpoint.reset(token)
+    if response.is_error:
+        errors[endpoint] += 1
+        response.raise_for_status()
+    return response
+
+
+async def workflow(client: httpx.AsyncClient):
+    """One project from creation to download"""
+    project = await call(client, "POST /projects", "POST", "/api/projects", json={"title": "Load test", "description": "Online shop for a load test"})
+    project_id = project.json()["id"]
+    risks = await call(client, "GET /projects/{id}/gen/risks", "GET", f"/api/projects/{project_id}/gen/risks")
+    await call(client, "POST /projects/{id}/risks", "POST", f"/api/projects/{project_id}/risks", json=risks.json())
+    scores = await call(client, "GET /projects/{id}/gen/risks/scores", "GET", f"/api/projects/{project_id}/gen/risks/scores")
+    await call(client, "POST /projects/{id}/risks/scores", "POST", f"/api/projects/{project_id}/risks/scores", json={"risks": scores.json(), "riskScoreThreshold": 0.1})
+    plans = await call(client, "GET /projects/{id}/gen/risks/plans", "GET", f"/api/projects/{project_id}/gen/risks/plans")
+    await call(client, "POST /projects/{id}/risks/plans", "POST", f"/api/projects/{project_id}/risks/plans", json=plans.json())
+    await call(client, "GET /projects/{id}/download", "GET", f"/api/projects/{project_id}/download")
+
+
+async def user(iterations: int) -> tuple[int, int]:
+    """Register a user and run the workflow, returns the completed and failed workflows"""
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://load-test") as client:
+        await call(client, "POST /register", "POST", "/api/register", json={"username": f"load_{uuid.uuid4().hex[:12]}", "password": PASSWORD})
+        completed, failed = 0, 0
+        for _ in range(iterations):
+            try:
+                await workflow(client)
+                completed += 1
+            except httpx.HTTPStatusError:
+                failed += 1
+        # Not part of the measurements
+        await client.request("DELETE", "/api/me", json={"password": PASSWORD})
+        return completed, failed
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def report(args, elapsed: float, completed: int, failed: int) -> dict:
+    endpoints = {}
+    for endpoint, values in latencies.items():
+        endpoints[endpoint] = {
+            "requests": len(values),
+            "errors": errors[endpoint],
+            "mean_ms": round(statistics.mean(values) * 1000, 3),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+            "db_round_trips": round_trips[endpoint],
+            "db_round_trips_per_request": round(round_trips[endpoint] / len(values), 2),
+        }
+    requests = sum(len(values) for values in latencies.values())
+    return {
+        "users": args.users,
+        "iterations": args.iterations,
+        "duration_s": round(elapsed, 3),
+        "workflows_completed": completed,
+        "workflows_failed": failed,
+        "workflows_per_s": round(completed / elapsed, 2),
+        "requests": requests,
+        "requests_per_s": round(requests / elapsed, 2),
+        "db_round_trips": sum(round_trips.values()),
+        "endpoints": endpoints,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20, help="Concurrent users")
+    parser.add_argument("--iterations", type=int, default=5, help="Workflows per user")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    count_round_trips()
+    async with app.router.lifespan_context(app):
+        start = time.perf_counter()
+        results = await asyncio.gather(*[user(args.iterations) for _ in range(args.users)])
+        elapsed = time.perf_counter() - start
+
+    result = report(args, elapsed, sum(r[0] for r in results), sum(r[1] for r in results))
+    output = json.dumps(result, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
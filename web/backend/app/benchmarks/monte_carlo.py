@@ -0,0 +1,80 @@
+"""Timing of the Monte Carlo quantitative analysis.
+
+Runs quantitative.simulate over made-up scored risks for a few sizes, taking
+the best of `--repeat` runs, next to a plain Python loop drawing the same
+distributions one risk and iteration at a time for a few thousand iterations,
+scaled to the same work. No database is needed.
+
+Usage: python benchmarks/monte_carlo.py [--repeat 5]
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from models import QuantitativeAnalysisRequest, RiskInDB
+from quantitative import simulate
+
+
+def make_risks(count: int) -> list[RiskInDB]:
+    rng = random.Random(count)
+    return [
+        RiskInDB(
+            id=i,
+            projectId=1,
+            kind=rng.choice(["threat", "threat", "opportunity"]),
+            title=f"Risk {i}",
+            description="",
+            impact=rng.randint(1, 10),
+            probability=rng.randint(1, 10),
+            contingency=None,
+            fallback=None
+        ) for i in range(count)
+    ]
+
+
+def python_loop(risks: list[RiskInDB], iterations: int) -> list[float]:
+    """The simulation as a loop over iterations and risks, for comparison"""
+    outcomes = []
+    for _ in range(iterations):
+        outcome = 0.0
+        for risk in risks:
+            if random.random() < risk.probability / 10:
+                amount = random.triangular(risk.impact - 1, risk.impact + 1, risk.impact)
+                outcome += -amount if risk.kind == "threat" else amount
+        outcomes.append(outcome)
+    outcomes.sort()
+    return outcomes
+
+
+def best_of(repeat: int, function) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for count, iterations in ((10, 100_000), (100, 100_000), (500, 100_000), (100, 1_000_000)):
+        risks = make_risks(count)
+        request = QuantitativeAnalysisRequest(iterations=iterations)
+        elapsed = best_of(args.repeat, lambda: simulate(risks, request, seed=1))
+        print(f"{count:>4} risks x {iterations:>9,} iterations: {elapsed * 1000:7.1f} ms")
+
+    risks = make_risks(100)
+    sample = 2_000
+    elapsed = best_of(1, lambda: python_loop(risks, sample)) * 100_000 / sample
+    print(f"Python loop, 100 risks x 100,000 iterations: {elapsed * 1000:7.0f} ms (from {sample:,} iterations)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""Throughput of the offline onboarding and check of its resume.
+
+Seeds a throwaway account with `--projects` projects and onboards them with
+onboard.py against a stand-in LLM answering each call in `--call-ms`, once per
+worker pool size, reporting the projects/hour. Then interrupts an onboarding
+halfway and runs it again with the same checkpoint, which must finish the
+remaining projects and save every project exactly once. The database settings
+are read from the usual DB_* environment variables.
+
+Usage: python benchmarks/onboard.py [--projects 200] [--call-ms 100] [--batch-size 20]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+APP_PATH = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(APP_PATH / "mockups"), str(APP_PATH)]
+
+from psycopg_pool import AsyncConnectionPool
+
+from database import ProjectRepository
+from onboard import Checkpoint, Onboarding
+
+DB_HOST = os.getenv("DB_HOST", "localhost")
+DB_PORT = os.getenv("DB_PORT", "5432")
+DB_NAME = os.getenv("DB_NAME", "aira")
+DB_USER = os.getenv("DB_USER", "root")
+DB_PASSWORD = os.getenv("DB_PASSWORD", "password")
+
+
+class SlowLLM:
+    """The mockup LLM answering after a delay, with a made-up token usage"""
+
+    def __init__(self, delay: float):
+        from llm import LLM
+        self.llm = LLM(url="", model="")
+        self.delay = delay
+
+    async def _call(self, operation: str, usage, *args, **kwargs):
+        await asyncio.sleep(self.delay)
+        usage.add(operation, 1500, 400)
+        return await getattr(self.llm, operation)(*args, **kwargs)
+
+    async def generate_risks(self, company_description, project, usage, seed_risks=None):
+        return await self._call("generate_risks", usage, company_description, project)
+
+    async def generate_risk_scores(self, company_description, project, risks, usage):
+        return await self._call("generate_risk_scores", usage, company_description, project, risks)
+
+    async def generate_risk_mitigation_plan(self, company_description, project, risks, usage):
+        return await self._call("generate_risk_mitigation_plan", usage, company_description, project, risks)
+
+
+async def seed(pool: AsyncConnectionPool, projects: int) -> tuple[int, list]:
+    """Create the account and its projects, returns the user id and the projects"""
+    async with pool.connection() as conn:
+        cursor = await conn.execute(
+            "INSERT INTO users (username, password_hash, company_description) VALUES (%s, '', 'Furniture maker') RETURNING id",
+            (f"bench-onboard-{uuid.uuid4().hex[:8]}",)
+        )
+        user_id = (await cursor.fetchone())[0]
+        await conn.execute(
+            """
+            INSERT INTO projects (user_id, title, description)
+            SELECT %s, 'Shop ' || i, 'Opening a furniture shop in city ' || i
+            FROM generate_series(1, %s) i
+            """,
+            (user_id, projects)
+        )
+    return user_id, await ProjectRepository(pool).get_projects_by_user_id(user_id)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--projects", type=int, default=200)
+    parser.add_argument("--call-ms", type=float, default=100, help="Latency of the stand-in LLM")
+    parser.add_argument("--batch-size", type=int, default=20, help="Generated projects saved together")
+    args = parser.parse_args()
+
+    conninfo = f"host={DB_HOST} port={DB_PORT} dbname={DB_NAME} user={DB_USER} password={DB_PASSWORD}"
+    llm = SlowLLM(args.call_ms / 1000)
+    user_ids = []
+    async with AsyncConnectionPool(conninfo, min_size=1, max_size=4, kwargs={"autocommit": True}, open=False) as pool:
+        project_db = ProjectRepository(pool)
+        with tempfile.TemporaryDirectory() as directory:
+            try:
+                print(f"{args.projects} projects, 3 LLM calls of {args.call_ms:.0f} ms each")
+                for concurrency in (1, 8, 32):
+                    user_id, projects = await seed(pool, args.projects)
+                    user_ids.append(user_id)
+                    checkpoint = Checkpoint(f"{directory}/{user_id}", str(user_id), None)
+                    onboarding = Onboarding(llm, project_db, user_id, "Furniture maker", checkpoint, args.batch_size)
+                    start = time.perf_counter()
+                    await onboarding.run(projects, concurrency)
+                    elapsed = time.perf_counter() - start
+                    checkpoint.close()
+                    assert onboarding.saved == args.projects
+                    print(f"  {concurrency:>2} at once: {onboarding.saved / elapsed * 3600:,.0f} projects/hour")
+
+                # Interrupted once half of the projects were generated, then run again with the same checkpoint
+                user_id, projects = await seed(pool, args.projects)
+                user_ids.append(user_id)
+                path = f"{directory}/{user_id}"
+                checkpoint = Checkpoint(path, str(user_id), None)
+                onboarding = Onboarding(llm, project_db, user_id, "Furniture maker", checkpoint, args.batch_size)
+                run = asyncio.create_task(onboarding.run(projects, 8))
+                await asyncio.sleep(args.projects / 2 / 8 * 3 * args.call_ms / 1000)
+                run.cancel()
+                await asyncio.gather(run, return_exceptions=True)
+                checkpoint.close()
+                first = onboarding.saved
+
+                checkpoint = Checkpoint(path, str(user_id), None)
+                remaining = [project for project in projects if project.id not in checkpoint.done]
+                onboarding = Onboarding(llm, project_db, user_id, "Furniture maker", checkpoint, args.batch_size)
+                await onboarding.run(remaining, 8)
+                checkpoint.close()
+                async with pool.connection() as conn:
+                    cursor = await conn.execute(
+                        """
+                        SELECT count(*) FILTER (WHERE current_step = 3),
+                               (SELECT count(*) FROM risks r JOIN projects p ON r.project_id = p.id WHERE p.user_id = %s)
+                        FROM projects WHERE user_id = %s
+                        """,
+                        (user_id, user_id)
+                    )
+                    complete, risks = await cursor.fetchone()
+                print(f"Interrupted after saving {first} projects, resumed with {len(remaining)} left")
+                print(f"  {complete}/{args.projects} projects complete, {risks} risks ({risks / complete:.0f} per project)")
+                usage = onboarding.usage.records()
+                print(f"  resumed run: {sum(u.calls for u in usage)} LLM calls, {sum(u.promptTokens + u.completionTokens for u in usage)} tokens")
+            finally:
+                async with pool.connection() as conn:
+                    await conn.execute("DELETE FROM users WHERE id = ANY(%s)", (user_ids,))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,117 @@
+"""Time-to-first-token benchmark of the mitigation prompt layout.
+
+Runs the per-risk mitigation requests of one project against the mock model
+server (mockups/llm_server.py, which simulates per-slot prefix caching) with
+two layouts:
+- legacy: kind-specific system prompt followed by the project context and the
+  risk, dispatched in register order (threats and opportunities interleaved)
+- shared-prefix: the layout built by LLM, common system text and project
+  context first, dispatched grouped by kind
+
+Usage: python benchmarks/prefix_cache.py [--risks 12] [--parallel 4]
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import openai
+
+from llm import LLM
+from mockups.llm_server import serve
+from models import Project, TrackedScoredRisk
+from prompts import GENERATE_RISK_MITIGATION_PLAN, RISK_MITIGATION_STRATEGIES_OPPORTUNITY, RISK_MITIGATION_STRATEGIES_THREAT
+
+BASE_PORT = 18434
+
+COMPANY_DESCRIPTION = (
+    "A mid-sized logistics company operating a fleet of delivery vans across three regions, "
+    "with a small in-house software team, a legacy ERP system and strict contractual delivery windows. "
+) * 8
+PROJECT = Project(
+    title="Warehouse routing platform",
+    description="Replace the manual dispatching process with an automated routing platform integrated with the ERP. " * 6
+)
+
+
+def make_risks(count: int) -> list[TrackedScoredRisk]:
+    return [
+        TrackedScoredRisk(
+            id=i,
+            kind="threat" if i % 2 else "opportunity",
+            title=f"Risk {i}",
+            description=f"Risk number {i} could affect the delivery schedule and the integration with the ERP.",
+            impact=(i % 10) + 1,
+            probability=((i * 3) % 10) + 1
+        ) for i in range(count)
+    ]
+
+
+def legacy_messages(llm: LLM, risk: TrackedScoredRisk) -> list[dict]:
+    strategies = RISK_MITIGATION_STRATEGIES_OPPORTUNITY if risk.kind == "opportunity" else RISK_MITIGATION_STRATEGIES_THREAT
+    return [
+        {"role": "system", "content": f"{GENERATE_RISK_MITIGATION_PLAN}\n{strategies}"},
+        {
+            "role": "user",
+            "content": f"{llm._get_project_string(PROJECT)}{llm._get_company_string(COMPANY_DESCRIPTION)}{risk.kind.capitalize()} Title: \"{risk.title}\"\n{risk.kind.capitalize()} Description: \"{risk.description}\"\nImpact Score: {risk.impact}\nProbability Score: {risk.probability}"
+        }
+    ]
+
+
+def shared_prefix_messages(llm: LLM, risk: TrackedScoredRisk) -> list[dict]:
+    return llm._get_mitigation_plan_messages(COMPANY_DESCRIPTION, PROJECT, risk)
+
+
+async def time_to_first_token(client: openai.AsyncClient, messages: list[dict]) -> float:
+    start = time.perf_counter()
+    stream = await client.chat.completions.create(model="mock", messages=messages, stream=True)
+    ttft = None
+    async for chunk in stream:
+        if ttft is None and chunk.choices and chunk.choices[0].delta.content:
+            ttft = time.perf_counter() - start
+    return ttft
+
+
+async def run_layout(name: str, port: int, risks: list[TrackedScoredRisk], args) -> None:
+    server = serve(port, args.parallel, args.prefill_ms, args.decode_ms)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f"http://127.0.0.1:{port}/v1"
+        llm = LLM(url=url, model="mock", api_key="mock")
+        client = openai.AsyncClient(base_url=url, api_key="mock", max_retries=0)
+        if name == "legacy":
+            ordered = risks
+            build = legacy_messages
+        else:
+            ordered = sorted(risks, key=lambda r: r.kind)
+            build = shared_prefix_messages
+
+        start = time.perf_counter()
+        ttfts = await asyncio.gather(*[time_to_first_token(client, build(llm, risk)) for risk in ordered])
+        total = time.perf_counter() - start
+        print(f"{name:>14} {statistics.mean(ttfts) * 1000:>10.1f} {statistics.median(ttfts) * 1000:>10.1f} {max(ttfts) * 1000:>10.1f} {total * 1000:>10.1f}")
+    finally:
+        server.shutdown()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--risks", type=int, default=12)
+    parser.add_argument("--parallel", type=int, default=4, help="Mock server slots")
+    parser.add_argument("--prefill-ms", type=float, default=0.5, help="Prefill time per uncached prompt token")
+    parser.add_argument("--decode-ms", type=float, default=2, help="Generation time per output token")
+    args = parser.parse_args()
+
+    risks = make_risks(args.risks)
+    print(f"{'layout':>14} {'mean TTFT':>10} {'p50 TTFT':>10} {'max TTFT':>10} {'total ms':>10}")
+    await run_layout("legacy", BASE_PORT, risks, args)
+    await run_layout("shared-prefix", BASE_PORT + 1, risks, args)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,126 @@
+"""Timing of account deletion and of its background purge.
+
+Seeds a throwaway account owning `--projects` projects with `--risks` risks
+each, deletes it with UserRepository.delete_user_by_id (what DELETE /api/me
+does) and times the call, then runs the purge batches until the account is
+gone, printing the progress. With `--cascade`, a second identical account is
+deleted with a plain cascading DELETE for comparison. The database settings
+are read from the usual DB_* environment variables.
+
+Usage: python benchmarks/purge.py [--projects 1000] [--risks 200] [--batch-size 1000] [--cascade]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import psycopg
+from psycopg_pool import AsyncConnectionPool
+
+from database import ProjectRepository, UserRepository
+
+DB_HOST = os.getenv("DB_HOST", "localhost")
+DB_PORT = os.getenv("DB_PORT", "5432")
+DB_NAME = os.getenv("DB_NAME", "aira")
+DB_USER = os.getenv("DB_USER", "root")
+DB_PASSWORD = os.getenv("DB_PASSWORD", "password")
+
+
+async def seed(pool: AsyncConnectionPool, projects: int, risks: int) -> int:
+    """Create the account, its projects and risks, returns the user id"""
+    async with pool.connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                "INSERT INTO users (username, password_hash) VALUES (%s, '') RETURNING id",
+                (f"bench-purge-{uuid.uuid4().hex[:8]}",)
+            )
+            user_id = (await cursor.fetchone())[0]
+            await cursor.execute(
+                """
+                INSERT INTO projects (user_id, title, description)
+                SELECT %s, 'Benchmark project ' || i, 'Seeded for the purge benchmark'
+                FROM generate_series(1, %s) i
+                RETURNING id
+                """,
+                (user_id, projects)
+            )
+            project_ids = [row[0] for row in await cursor.fetchall()]
+            await cursor.execute(
+                """
+                INSERT INTO risks (project_id, kind, title, description, impact, probability)
+                SELECT p, 'threat', 'Supplier delay ' || i, 'The supplier delivers late', 1 + i %% 10, 1 + i %% 7
+                FROM unnest(%s::int[]) p, generate_series(1, %s) i
+                """,
+                (project_ids, risks)
+            )
+            await cursor.execute(
+                """
+                INSERT INTO llm_usage (user_id, project_id, operation, calls, prompt_tokens, completion_tokens)
+                SELECT %s, p, 'generate_risks', 1, 1000, 200 FROM unnest(%s::int[]) p
+                """,
+                (user_id, project_ids)
+            )
+    return user_id
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--projects", type=int, default=1_000)
+    parser.add_argument("--risks", type=int, default=200, help="Risks per project")
+    parser.add_argument("--batch-size", type=int, default=1_000)
+    parser.add_argument("--cascade", action="store_true", help="Also time a cascading DELETE of the same data")
+    args = parser.parse_args()
+
+    conninfo = f"host={DB_HOST} port={DB_PORT} dbname={DB_NAME} user={DB_USER} password={DB_PASSWORD}"
+    async with AsyncConnectionPool(conninfo, min_size=1, max_size=2, kwargs={"autocommit": True}, open=False) as pool:
+        rows = args.projects * (args.risks + 2) + 1
+        start = time.perf_counter()
+        user_id = await seed(pool, args.projects, args.risks)
+        print(f"Seeded an account with {rows} rows in {time.perf_counter() - start:.1f}s")
+
+        start = time.perf_counter()
+        await UserRepository(pool).delete_user_by_id(user_id)
+        print(f"delete_user_by_id: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        project_db = ProjectRepository(pool)
+        # The claim is held outside the pool, as purge_deleted does
+        async with await psycopg.AsyncConnection.connect(conninfo, autocommit=True) as claims:
+            while True:
+                async with project_db.claim_pending_purge(claims) as purge:
+                    if purge.userId != user_id:
+                        # Older deletions are purged first, as the background task would
+                        while await project_db.purge_batch(purge, args.batch_size):
+                            pass
+                        continue
+
+                    start = time.perf_counter()
+                    batches, purged, slowest = 0, 0, 0.0
+                    while True:
+                        batch_start = time.perf_counter()
+                        deleted = await project_db.purge_batch(purge, args.batch_size)
+                        slowest = max(slowest, time.perf_counter() - batch_start)
+                        if not deleted:
+                            break
+                        batches += 1
+                        purged += deleted
+                        if batches % 100 == 0:
+                            print(f"  {purged}/{rows} rows purged")
+                    elapsed = time.perf_counter() - start
+                    break
+        print(f"Purged {purged} rows in {batches} batches, {elapsed:.1f}s, slowest batch {slowest * 1000:.1f} ms")
+
+        if args.cascade:
+            user_id = await seed(pool, args.projects, args.risks)
+            start = time.perf_counter()
+            async with pool.connection() as conn:
+                await conn.execute("DELETE FROM users WHERE id = %s", (user_id,))
+            print(f"Cascading DELETE: {(time.perf_counter() - start) * 1000:.1f} ms in one transaction")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,90 @@
+"""Check of the read replica routing against a primary and its replicas.
+
+Serves the app in-process, like load_test.py, with the replicas given by
+`--replicas` (or DB_REPLICA_HOSTS). Every simulated user saves risks, reads
+them back right away (read-your-writes, expected from the primary), then reads
+them again once the sticky window is over (expected from a replica). Reports
+where the reads went and how many returned stale data. A replica address where
+nothing listens shows the fallback to the primary.
+
+A local replica of the database on port 5432 can be made with:
+
+    pg_basebackup -h localhost -p 5432 -D /tmp/replica -R -X stream
+    pg_ctl -D /tmp/replica -o "-p 5433" start
+
+Usage: python benchmarks/read_replicas.py [--replicas localhost:5433] [--users 10] [--sticky 1]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import uuid
+from pathlib import Path
+
+APP_PATH = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(APP_PATH / "mockups"), str(APP_PATH)]
+
+PASSWORD = "replica-check"
+RISKS = [
+    {"kind": "threat", "title": "Supplier delay", "description": "The furniture supplier delivers late"},
+    {"kind": "opportunity", "title": "New market", "description": "Selling abroad increases the revenue"},
+]
+
+
+async def user(client, sticky: float) -> tuple[int, int]:
+    """Returns the stale reads right after the write and after the sticky window"""
+    project = await client.post("/api/projects", json={"title": "Replica check", "description": "Online shop"})
+    project_id = project.json()["id"]
+    saved = await client.post(f"/api/projects/{project_id}/risks", json=RISKS)
+    saved.raise_for_status()
+    expected = saved.json()["risks"]
+
+    own_write = await client.get(f"/api/projects/{project_id}/risks")
+    await asyncio.sleep(sticky + 0.5)
+    later = await client.get(f"/api/projects/{project_id}/risks")
+    return int(own_write.json() != expected), int(later.json() != expected)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--replicas", default=os.getenv("DB_REPLICA_HOSTS", "localhost:5433"), help="Comma separated host:port of the replicas")
+    parser.add_argument("--users", type=int, default=10, help="Concurrent users")
+    parser.add_argument("--sticky", type=float, default=1.0, help="Read-your-writes window in seconds")
+    args = parser.parse_args()
+
+    # Read when the modules are imported
+    os.environ["DB_REPLICA_HOSTS"] = args.replicas
+    os.environ["DB_REPLICA_STICKY_SECONDS"] = str(args.sticky)
+    os.environ.setdefault("RATE_LIMIT_BACKEND", "off")
+    os.environ.setdefault("BACKEND_FILE_PATH", tempfile.mkdtemp(prefix="aira-replica-check-"))
+
+    import httpx
+    from prometheus_client import REGISTRY
+
+    from app import app
+
+    async with app.router.lifespan_context(app):
+        # Let the replica pools connect
+        await asyncio.sleep(1)
+        clients = [httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://replica-check") for _ in range(args.users)]
+        try:
+            # One at a time: password hashing blocks the event loop, which would make the replica connections time out
+            for client in clients:
+                await client.post("/api/register", json={"username": f"replica_{uuid.uuid4().hex[:12]}", "password": PASSWORD})
+            results = await asyncio.gather(*[user(client, args.sticky) for client in clients])
+        finally:
+            for client in clients:
+                await client.request("DELETE", "/api/me", json={"password": PASSWORD})
+                await client.aclose()
+
+    print(f"Replicas: {args.replicas}, sticky window {args.sticky}s, {args.users} users")
+    for target in ("replica", "primary", "fallback"):
+        value = REGISTRY.get_sample_value("db_read_routes_total", {"target": target}) or 0
+        print(f"{target:>10} reads: {int(value)}")
+    print(f"stale reads right after the write: {sum(r[0] for r in results)}")
+    print(f"stale reads after the sticky window: {sum(r[1] for r in results)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
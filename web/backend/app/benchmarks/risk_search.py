@@ -0,0 +1,135 @@
+"""Latency benchmark of the full-text risk search.
+
+Seeds throwaway users owning `--risks` risks in total (generated in the database
+from a small vocabulary), then times ProjectRepository.search_risks for a few
+queries, first page and the page after it, for the busiest user. The users and
+their data are deleted at the end. The database settings are read from the usual
+DB_* environment variables.
+
+Usage: python benchmarks/risk_search.py [--risks 1000000] [--users 20] [--repeat 50]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from psycopg_pool import AsyncConnectionPool
+
+from database import ProjectRepository
+
+DB_HOST = os.getenv("DB_HOST", "localhost")
+DB_PORT = os.getenv("DB_PORT", "5432")
+DB_NAME = os.getenv("DB_NAME", "aira")
+DB_USER = os.getenv("DB_USER", "root")
+DB_PASSWORD = os.getenv("DB_PASSWORD", "password")
+
+WORDS = [
+    "data", "breach", "supplier", "delay", "budget", "overrun", "server", "outage", "regulation", "change",
+    "staff", "turnover", "customer", "churn", "market", "growth", "partner", "grant", "security", "audit",
+    "integration", "failure", "vendor", "lock", "currency", "exchange", "weather", "damage", "scope", "creep",
+]
+QUERIES = ["data breach", "supplier delay", "\"budget overrun\"", "security -audit", "grant or subsidy"]
+PROJECTS_PER_USER = 50
+
+
+async def seed(pool: AsyncConnectionPool, users: int, risks: int) -> list[int]:
+    """Create the users, their projects and risks, returns the user ids"""
+    async with pool.connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                """
+                INSERT INTO users (username, password_hash)
+                SELECT 'bench-search-' || %s || '-' || i, '' FROM generate_series(1, %s) i
+                RETURNING id
+                """,
+                (uuid.uuid4().hex[:8], users)
+            )
+            user_ids = [row[0] for row in await cursor.fetchall()]
+            await cursor.execute(
+                """
+                INSERT INTO projects (user_id, title, description)
+                SELECT u, 'Benchmark project ' || i, 'Seeded for the risk search benchmark'
+                FROM unnest(%s::int[]) u, generate_series(1, %s) i
+                RETURNING id, user_id
+                """,
+                (user_ids, PROJECTS_PER_USER)
+            )
+            projects = await cursor.fetchall()
+            busiest = [project_id for project_id, user_id in projects if user_id == user_ids[0]]
+            others = [project_id for project_id, user_id in projects if user_id != user_ids[0]] or busiest
+            # Half of the risks go to the first user, the rest is spread over the others
+            await cursor.execute(
+                """
+                INSERT INTO risks (project_id, title, description, kind, contingency, fallback)
+                SELECT
+                    CASE WHEN i %% 2 = 0 THEN b[1 + i %% cardinality(b)] ELSE o[1 + i %% cardinality(o)] END,
+                    w[1 + i %% 30] || ' ' || w[1 + (i / 30) %% 30],
+                    'Risk of ' || w[1 + (i / 7) %% 30] || ' ' || w[1 + (i / 11) %% 30] || ' affecting the ' || w[1 + (i / 13) %% 30] || ' work',
+                    CASE WHEN i %% 5 = 0 THEN 'opportunity' ELSE 'threat' END::risk_type,
+                    'Monitor ' || w[1 + (i / 17) %% 30],
+                    'Escalate ' || w[1 + (i / 19) %% 30]
+                FROM (SELECT %s::text[] AS w, %s::int[] AS b, %s::int[] AS o) params, generate_series(1, %s) i
+                """,
+                (WORDS, busiest, others, risks)
+            )
+            await cursor.execute("ANALYZE risks")
+            await cursor.execute("ANALYZE projects")
+    return user_ids
+
+
+async def cleanup(pool: AsyncConnectionPool, user_ids: list[int]):
+    async with pool.connection() as conn:
+        await conn.execute("DELETE FROM users WHERE id = ANY(%s)", (user_ids,))
+
+
+async def measure(repository: ProjectRepository, user_id: int, query: str, repeat: int) -> tuple[list[float], list[float]]:
+    first, second = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        page = await repository.search_risks(user_id, query)
+        first.append((time.perf_counter() - start) * 1000)
+        if page.nextCursor is not None:
+            rank, _, risk_id = page.nextCursor.partition(":")
+            start = time.perf_counter()
+            await repository.search_risks(user_id, query, cursor=(rank, int(risk_id)))
+            second.append((time.perf_counter() - start) * 1000)
+    return first, second
+
+
+def summary(timings: list[float]) -> str:
+    if not timings:
+        return f"{'-':>8} {'-':>8}"
+    p95 = sorted(timings)[int(len(timings) * 0.95) - 1] if len(timings) > 1 else timings[0]
+    return f"{statistics.median(timings):>8.2f} {p95:>8.2f}"
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--risks", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    conninfo = f"host={DB_HOST} port={DB_PORT} dbname={DB_NAME} user={DB_USER} password={DB_PASSWORD}"
+    async with AsyncConnectionPool(conninfo, min_size=1, max_size=2, kwargs={"autocommit": True}, open=False) as pool:
+        start = time.perf_counter()
+        user_ids = await seed(pool, args.users, args.risks)
+        print(f"Seeded {args.risks} risks for {args.users} users in {time.perf_counter() - start:.1f}s")
+        try:
+            repository = ProjectRepository(pool)
+            print(f"{'query':>20} {'p50 ms':>8} {'p95 ms':>8} {'next p50':>8} {'next p95':>8}")
+            for query in QUERIES:
+                first, second = await measure(repository, user_ids[0], query, args.repeat)
+                print(f"{query:>20} {summary(first)} {summary(second)}")
+        finally:
+            await cleanup(pool, user_ids)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,125 @@
+"""Microbenchmark of building the risk models from database rows.
+
+Compares, for risk registers of 10, 100, 1,000 and 10,000 risks, the per-row
+cost of validating every row (the models' constructors), `model_construct` and
+the row factories of models.py, for the database rows and for the conversions
+between workflow steps (scoring and planning inputs, unplanned risks).
+`--profile` also prints where the time goes for the largest register.
+
+Usage: python benchmarks/row_models.py [--repeat N] [--profile]
+"""
+import argparse
+import cProfile
+import pstats
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from generation import planning_inputs, scoring_inputs
+from models import RiskInDB, TrackedManagedRisk, TrackedRisk, TrackedScoredRisk, row_factory
+
+SIZES = [10, 100, 1_000, 10_000]
+
+_risk = row_factory(RiskInDB)
+_tracked_managed_risk = row_factory(TrackedManagedRisk)
+
+
+def make_rows(count: int) -> list[tuple]:
+    return [
+        (
+            i,
+            "threat" if i % 2 else "opportunity",
+            f"Risk number {i}",
+            "Unauthorized access to sensitive data could lead to significant financial and reputational damage.",
+            (i % 10) + 1,
+            ((i * 7) % 10) + 1,
+            None,
+            None,
+        ) for i in range(count)
+    ]
+
+
+def validated_risks(rows: list[tuple]) -> list[RiskInDB]:
+    return [
+        RiskInDB(id=row[0], projectId=1, kind=row[1], title=row[2], description=row[3], impact=row[4], probability=row[5], contingency=row[6], fallback=row[7])
+        for row in rows
+    ]
+
+
+def constructed_risks(rows: list[tuple]) -> list[RiskInDB]:
+    return [
+        RiskInDB.model_construct(id=row[0], projectId=1, kind=row[1], title=row[2], description=row[3], impact=row[4], probability=row[5], contingency=row[6], fallback=row[7])
+        for row in rows
+    ]
+
+
+def factory_risks(rows: list[tuple]) -> list[RiskInDB]:
+    return [
+        _risk(id=row[0], projectId=1, kind=row[1], title=row[2], description=row[3], impact=row[4], probability=row[5], contingency=row[6], fallback=row[7])
+        for row in rows
+    ]
+
+
+def validated_scoring_inputs(risks: list[RiskInDB]) -> list[TrackedRisk]:
+    return [TrackedRisk(id=r.id, kind=r.kind, title=r.title, description=r.description) for r in risks]
+
+
+def validated_planning_inputs(risks: list[RiskInDB]) -> list[TrackedScoredRisk]:
+    return [
+        TrackedScoredRisk(id=r.id, title=r.title, kind=r.kind, description=r.description, impact=r.impact or 1, probability=r.probability or 1)
+        for r in risks
+    ]
+
+
+def dumped_unplanned(risks: list[TrackedScoredRisk]) -> list[TrackedManagedRisk]:
+    return [TrackedManagedRisk(**r.model_dump(), contingency=None, fallback=None) for r in risks]
+
+
+def factory_unplanned(risks: list[TrackedScoredRisk]) -> list[TrackedManagedRisk]:
+    return [_tracked_managed_risk(**r.__dict__, contingency=None, fallback=None) for r in risks]
+
+
+def cases(rows: list[tuple]):
+    risks = factory_risks(rows)
+    scored = validated_planning_inputs(risks)
+    return [
+        ("row -> RiskInDB", "validated", lambda: validated_risks(rows)),
+        ("row -> RiskInDB", "construct", lambda: constructed_risks(rows)),
+        ("row -> RiskInDB", "factory", lambda: factory_risks(rows)),
+        ("scoring inputs", "validated", lambda: validated_scoring_inputs(risks)),
+        ("scoring inputs", "factory", lambda: scoring_inputs(risks)),
+        ("planning inputs", "validated", lambda: validated_planning_inputs(risks)),
+        ("planning inputs", "factory", lambda: planning_inputs(risks, 0)),
+        ("unplanned risks", "dump", lambda: dumped_unplanned(scored)),
+        ("unplanned risks", "factory", lambda: factory_unplanned(scored)),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20, help="Runs per measurement")
+    parser.add_argument("--profile", action="store_true", help="Profile the validated and factory paths of the largest register")
+    args = parser.parse_args()
+
+    rows = make_rows(SIZES[-1])
+    assert [r.model_dump() for r in factory_risks(rows)] == [r.model_dump() for r in validated_risks(rows)]
+
+    print(f"{'risks':>6} {'conversion':>16} {'path':>10} {'time/row':>10}")
+    for size in SIZES:
+        for conversion, path, func in cases(rows[:size]):
+            number = max(1, args.repeat * 1_000 // size)
+            seconds = min(timeit.repeat(func, number=number, repeat=5)) / number
+            print(f"{size:>6} {conversion:>16} {path:>10} {seconds / size * 1e6:>7.2f} us")
+
+    if args.profile:
+        for name, func in (("validated", validated_risks), ("factory", factory_risks)):
+            print(f"\nrow -> RiskInDB, {name}, {len(rows)} rows")
+            profiler = cProfile.Profile()
+            profiler.runcall(func, rows)
+            pstats.Stats(profiler).sort_stats("tottime").print_stats(8)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Microbenchmark of JSON serialization for risk payloads.
+
+Compares the default FastAPI path (`jsonable_encoder` + `JSONResponse`) with
+`PydanticJSONResponse` for lists of 10, 100 and 1,000 risks, reporting the time
+per render and the peak memory allocated while rendering.
+
+Usage: python benchmarks/serialization.py [--repeat N]
+"""
+import argparse
+import sys
+import timeit
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from models import RiskInDB
+from responses import PydanticJSONResponse
+
+SIZES = [10, 100, 1_000]
+
+
+def make_risks(count: int) -> list[RiskInDB]:
+    return [
+        RiskInDB(
+            id=i,
+            projectId=1,
+            kind="threat" if i % 2 else "opportunity",
+            title=f"Risk number {i}",
+            description="Unauthorized access to sensitive data could lead to significant financial and reputational damage. " * 2,
+            impact=(i % 10) + 1,
+            probability=((i * 7) % 10) + 1,
+            contingency="Allocate additional resources and adjust timelines, if necessary. " * 3,
+            fallback="Reassess project scope and seek expert consultation. " * 3,
+        ) for i in range(count)
+    ]
+
+
+def default_render(risks: list[RiskInDB]) -> bytes:
+    return JSONResponse(jsonable_encoder(risks)).body
+
+
+def fast_render(risks: list[RiskInDB]) -> bytes:
+    return PydanticJSONResponse(risks).body
+
+
+def peak_allocation(func, risks: list[RiskInDB]) -> int:
+    tracemalloc.start()
+    func(risks)
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=50, help="Renders per measurement")
+    args = parser.parse_args()
+
+    print(f"{'risks':>6} {'renderer':>10} {'time/render':>14} {'peak alloc':>12} {'bytes':>10}")
+    for size in SIZES:
+        risks = make_risks(size)
+        assert default_render(risks) == fast_render(risks)
+        for name, func in (("default", default_render), ("pydantic", fast_render)):
+            seconds = min(timeit.repeat(lambda: func(risks), number=args.repeat, repeat=5)) / args.repeat
+            peak = peak_allocation(func, risks)
+            print(f"{size:>6} {name:>10} {seconds * 1e6:>11.1f} us {peak / 1024:>9.1f} KiB {len(func(risks)):>10}")
+
+
+if __name__ == "__main__":
+    main()
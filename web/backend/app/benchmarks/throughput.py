@@ -0,0 +1,105 @@
+"""CRUD throughput benchmark for the multi-process serving mode.
+
+Starts `run.py` in production mode with an increasing number of worker processes
+and measures how many read requests per second (project list, project details
+and project risks) the backend can serve. The database settings are read from
+the usual DB_* environment variables and the database must be reachable.
+
+Usage: python benchmarks/throughput.py [--workers 1 2 4] [--duration 10]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import httpx
+
+APP_PATH = Path(__file__).resolve().parent.parent
+PORT = 18080
+
+
+def wait_for_server(base_url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{base_url}/api/openapi.json").status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError("Backend did not start in time")
+
+
+def setup_user(base_url: str) -> tuple[dict, int]:
+    """Register a throwaway user with a project and a few risks, returns the session cookies and the project id"""
+    with httpx.Client(base_url=base_url) as client:
+        client.post("/api/register", json={"username": f"bench_{uuid.uuid4().hex[:12]}", "password": "benchmark"}).raise_for_status()
+        project_id = client.post("/api/projects", json={"title": "Benchmark", "description": "Throughput benchmark project"}).json()["id"]
+        risks = [
+            {"kind": "threat", "title": f"Risk {i}", "description": "Delays due to unforeseen technical challenges."}
+            for i in range(20)
+        ]
+        client.post(f"/api/projects/{project_id}/risks", json=risks).raise_for_status()
+        return dict(client.cookies), project_id
+
+
+async def load(base_url: str, cookies: dict, project_id: int, concurrency: int, duration: float) -> int:
+    paths = ["/api/projects", f"/api/projects/{project_id}", f"/api/projects/{project_id}/risks"]
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, cookies=cookies, limits=limits) as client:
+        deadline = time.monotonic() + duration
+
+        async def user() -> int:
+            done = 0
+            while time.monotonic() < deadline:
+                response = await client.get(paths[done % len(paths)])
+                response.raise_for_status()
+                done += 1
+            return done
+
+        return sum(await asyncio.gather(*[user() for _ in range(concurrency)]))
+
+
+def load_process(args: tuple) -> int:
+    return asyncio.run(load(*args))
+
+
+def measure(workers: int, args) -> float:
+    env = dict(os.environ, MODE="production", BACKEND_PORT=str(PORT), BACKEND_WORKERS=str(workers), WORKER_MAX_REQUESTS="0")
+    server = subprocess.Popen([sys.executable, "run.py"], cwd=APP_PATH, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{PORT}"
+    try:
+        wait_for_server(base_url)
+        cookies, project_id = setup_user(base_url)
+        job = (base_url, cookies, project_id, args.concurrency, args.duration)
+        with multiprocessing.Pool(args.clients) as pool:
+            requests = sum(pool.map(load_process, [job] * args.clients))
+        return requests / args.duration
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="Worker counts to measure")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of load per measurement")
+    parser.add_argument("--clients", type=int, default=4, help="Load generator processes")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent requests per load generator process")
+    args = parser.parse_args()
+
+    print(f"{'workers':>8} {'req/s':>10} {'speedup':>8}")
+    baseline = None
+    for workers in args.workers:
+        throughput = measure(workers, args)
+        baseline = baseline or throughput
+        print(f"{workers:>8} {throughput:>10.1f} {throughput / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
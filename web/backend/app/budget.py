@@ -0,0 +1,22 @@
+import os
+
+# Shared by run.py, which sizes the worker processes before they start, and app.py, which sizes the pools in each of them.
+# Only the standard library is imported here, run.py must not load prometheus_client before it sets PROMETHEUS_MULTIPROC_DIR
+
+# When enabled, the LLM calls are queued in the database and run by whichever backend instance or worker process claims them
+LLM_QUEUE = os.getenv("LLM_QUEUE", "false").lower() in ("1", "true", "yes")
+
+# Total number of connections to each database server shared by all the worker processes.
+# A worker's share covers its pool and its LISTEN connections on the primary, its replica pools are the same size
+DB_POOL_BUDGET = int(os.getenv("DB_POOL_BUDGET", "20"))
+# Held by each worker outside its pool: the cache invalidation listener, the purge claims, and the LLM queue listener
+DB_LISTEN_CONNECTIONS = 2 + LLM_QUEUE
+# Fewest pooled connections a worker is started with
+DB_POOL_MIN_CONNECTIONS = 2
+DB_CONNECTIONS_PER_WORKER = DB_POOL_MIN_CONNECTIONS + DB_LISTEN_CONNECTIONS
+MAX_BACKEND_WORKERS = max(1, DB_POOL_BUDGET // DB_CONNECTIONS_PER_WORKER)
+
+
+def pool_max_size(workers: int) -> int:
+    """Pooled connections of each of the workers, what their share of DB_POOL_BUDGET leaves besides the LISTEN connections"""
+    return DB_POOL_BUDGET // workers - DB_LISTEN_CONNECTIONS
@@ -1,149 +1,421 @@
+import html
 import psycopg
-from typing import Optional
-from models import ProjectInDB, RiskInDB, TrackedScoredRisk, TrackedManagedRisk, UserResponse, UserInDB, Project
+import pydantic_core
+from psycopg_pool import AsyncConnectionPool
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+from metrics import instrument_repository
+from tracing import trace_repository
+from replicas import RoutingPool, read_only
+from invalidation import NOTIFY, notification, publishes
+from models import GeneratedProject, GenerationDraft, LLMUsage, ProjectContext, ProjectInDB, Purge, Risk, RiskInDB, RiskSearchPage, RiskSearchResult, RiskUpdate, SavedRisk, SimilarRisk, TrackedScoredRisk, TrackedManagedRisk, UserResponse, UserInDB, Project, row_factory
 
+# The rows are valid by the schema, and the queries cast the NUMERIC columns to the types of the model fields,
+# so the models are built without validating them again
+_user = row_factory(UserInDB)
+_project = row_factory(ProjectInDB)
+_risk = row_factory(RiskInDB)
+_context = row_factory(ProjectContext)
+_similar_risk = row_factory(SimilarRisk)
+_search_result = row_factory(RiskSearchResult)
+_search_page = row_factory(RiskSearchPage)
+_draft = row_factory(GenerationDraft)
+_llm_usage = row_factory(LLMUsage)
+_purge = row_factory(Purge)
+
+PROJECT_CONTEXT_QUERY = """
+    SELECT p.title, p.description, p.current_step::int, p.risk_score_threshold::float8, u.company_description,
+           coalesce((
+               SELECT json_agg(json_build_array(r.id, r.kind, r.title, r.description, r.impact::int, r.probability::int, r.contingency, r.fallback) ORDER BY r.id)
+               FROM risks r
+               WHERE r.project_id = p.id
+           ), '[]')
+    FROM projects p
+    JOIN users u ON p.user_id = u.id
+    WHERE p.id = %s AND p.user_id = %s AND p.deleted_at IS NULL AND u.deleted_at IS NULL
+"""
+
+SIMILAR_RISKS_QUERY = """
+    WITH target AS (
+        SELECT replace(plainto_tsquery('english', title || ' ' || coalesce(description, ''))::text, '&', '|')::tsquery AS query
+        FROM projects
+        WHERE id = %s AND user_id = %s AND deleted_at IS NULL
+    ), similar_projects AS (
+        SELECT p.id, ts_rank(p.search_vector, target.query, 32) AS score
+        FROM projects p, target
+        WHERE p.user_id = %s AND p.id <> %s AND p.deleted_at IS NULL AND p.search_vector @@ target.query
+          AND EXISTS (SELECT 1 FROM risks r WHERE r.project_id = p.id)
+        ORDER BY score DESC
+        LIMIT %s
+    )
+    SELECT * FROM (
+        SELECT DISTINCT ON (lower(r.title)) r.kind, r.title, r.description, s.id, s.score
+        FROM similar_projects s
+        JOIN risks r ON r.project_id = s.id
+        ORDER BY lower(r.title), s.score DESC
+    ) candidates
+    ORDER BY score DESC, title
+"""
+
+
+def _context_from_row(projectId: int, row) -> Optional[ProjectContext]:
+    if row is None:
+        return None
+    return _context(
+        project=_project(id=projectId, title=row[0], description=row[1], currentStep=row[2], riskScoreThreshold=row[3]),
+        companyDescription=row[4],
+        risks=[
+            _risk(
+                id=risk[0],
+                kind=risk[1],
+                title=risk[2],
+                description=risk[3],
+                impact=risk[4],
+                probability=risk[5],
+                contingency=risk[6],
+                fallback=risk[7],
+                projectId=projectId
+            ) for risk in row[5]
+        ]
+    )
+
+
+def _similar_risks_from_rows(rows) -> list[SimilarRisk]:
+    return [
+        _similar_risk(kind=row[0], title=row[1], description=row[2], sourceProjectId=row[3], similarity=row[4])
+        for row in rows
+    ]
+
+
+# ts_headline marks the matched words with these, they become <b></b> once the rest of the text is escaped
+HIGHLIGHT_START, HIGHLIGHT_STOP = "\x02", "\x03"
+TITLE_HEADLINE_OPTIONS = f'HighlightAll=true, StartSel="{HIGHLIGHT_START}", StopSel="{HIGHLIGHT_STOP}"'
+EXCERPT_HEADLINE_OPTIONS = f'MaxFragments=2, MaxWords=20, MinWords=8, StartSel="{HIGHLIGHT_START}", StopSel="{HIGHLIGHT_STOP}"'
+
+
+def _highlighted(headline: str) -> str:
+    """HTML of a headline, the risks are user text so only the highlighting is markup"""
+    return html.escape(headline).replace(HIGHLIGHT_START, "<b>").replace(HIGHLIGHT_STOP, "</b>")
+
+
+# First key of the advisory locks claiming a purge, the second one is the purge id
+PURGE_LOCK = 4_120_002
+# Deletes of the purge, children first so that deleting the project and user rows cascades to nothing.
+# {scope} selects the projects of the purge, each statement deletes at most %(limit)s rows and adds them to the progress
+PURGE_STATEMENTS = [
+    """
+    DELETE FROM risks WHERE id IN (
+        SELECT r.id FROM risks r JOIN projects p ON r.project_id = p.id
+        WHERE {scope} AND p.deleted_at IS NOT NULL
+        LIMIT %(limit)s FOR UPDATE OF r SKIP LOCKED
+    )
+    """,
+    """
+    DELETE FROM generations WHERE id IN (
+        SELECT g.id FROM generations g JOIN projects p ON g.project_id = p.id
+        WHERE {scope} AND p.deleted_at IS NOT NULL
+        LIMIT %(limit)s FOR UPDATE OF g SKIP LOCKED
+    )
+    """,
+    """
+    DELETE FROM llm_usage WHERE id IN (
+        SELECT l.id FROM llm_usage l JOIN projects p ON l.project_id = p.id
+        WHERE {scope} AND p.deleted_at IS NOT NULL
+        LIMIT %(limit)s FOR UPDATE OF l SKIP LOCKED
+    )
+    """,
+    """
+    DELETE FROM projects WHERE id IN (
+        SELECT p.id FROM projects p
+        WHERE {scope} AND p.deleted_at IS NOT NULL
+        LIMIT %(limit)s FOR UPDATE SKIP LOCKED
+    )
+    """,
+]
+# The account's usage that is not tied to a project, then the account itself
+PURGE_ACCOUNT_STATEMENTS = [
+    """
+    DELETE FROM llm_usage WHERE id IN (
+        SELECT id FROM llm_usage
+        WHERE user_id = %(user)s AND project_id IS NULL
+        LIMIT %(limit)s FOR UPDATE SKIP LOCKED
+    )
+    """,
+    "DELETE FROM users WHERE id = %(user)s AND deleted_at IS NOT NULL",
+]
+
+
+class StaleRisksError(Exception):
+    """Raised when saving risks that are no longer risks of the project, such as risks deleted from another tab"""
+
+
+@instrument_repository
+@trace_repository
 class UserRepository:
-    def __init__(self, connection: psycopg.AsyncConnection):
-        self.conn = connection
+    def __init__(self, pool: AsyncConnectionPool | RoutingPool):
+        self.pool = pool
 
     async def create_user(self, username: str, passwordHash: str) -> Optional[UserInDB]:
         """Create a new user in the database"""
-        try:
-            async with self.conn.transaction():
-                async with self.conn.cursor() as cursor:
+        async with self.pool.connection() as conn:
+            try:
+                async with conn.cursor() as cursor:
                     await cursor.execute(
                         "INSERT INTO users (username, password_hash) VALUES (%s, %s) RETURNING id, username, company_description",
                         (username, passwordHash)
                     )
                     row = await cursor.fetchone()
                     if row:
-                        return UserInDB(id=row[0], username=row[1], passwordHash=passwordHash, companyDescription=row[2])
+                        return _user(id=row[0], username=row[1], passwordHash=passwordHash, companyDescription=row[2])
                     return None
-        except psycopg.IntegrityError:
-            # Username already exists
-            return None
+            except psycopg.IntegrityError:
+                # Username already exists
+                return None
         
+    @publishes("user:{userId}")
     async def delete_user_by_id(self, userId: int) -> Optional[UserInDB]:
-        """Delete a user by ID"""
-        async with self.conn.cursor() as cursor:
-            await cursor.execute(
-                "DELETE FROM users WHERE id = %s RETURNING id, username, password_hash, company_description",
-                (userId,)
-            )
-            row = await cursor.fetchone()
-            if row:
-                return UserInDB(id=row[0], username=row[1], passwordHash=row[2], companyDescription=row[3])
-            return None
+        """Delete a user by ID.
+
+        The account and its projects are only marked as deleted, which hides them
+        right away, ProjectRepository.purge_batch removes the rows later.
+        """
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    f"""
+                    WITH deleted AS (
+                        UPDATE users SET deleted_at = now()
+                        WHERE id = %s AND deleted_at IS NULL
+                        RETURNING id, username, password_hash, company_description
+                    ), deleted_projects AS (
+                        UPDATE projects SET deleted_at = now()
+                        WHERE user_id IN (SELECT id FROM deleted) AND deleted_at IS NULL
+                    ), purge AS (
+                        INSERT INTO purges (user_id) SELECT id FROM deleted
+                    )
+                    SELECT id, username, password_hash, company_description, {NOTIFY} FROM deleted
+                    """,
+                    (userId, *notification())
+                )
+                row = await cursor.fetchone()
+                if row:
+                    return _user(id=row[0], username=row[1], passwordHash=row[2], companyDescription=row[3])
+                return None
 
+    @read_only
     async def get_user_by_username(self, username: str) -> Optional[UserInDB]:
         """Get user by username, returns (id, username, password_hash)"""
-        async with self.conn.cursor() as cursor:
-            await cursor.execute(
-                "SELECT id, username, password_hash, company_description FROM users WHERE username = %s",
-                (username,)
-            )
-            row = await cursor.fetchone()
-            if row:
-                return UserInDB(id=row[0], username=row[1], passwordHash=row[2], companyDescription=row[3])
-            return None
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    "SELECT id, username, password_hash, company_description FROM users WHERE username = %s AND deleted_at IS NULL",
+                    (username,)
+                )
+                row = await cursor.fetchone()
+                if row:
+                    return _user(id=row[0], username=row[1], passwordHash=row[2], companyDescription=row[3])
+                return None
 
+    @read_only
     async def get_user_by_id(self, userId: int) -> Optional[UserInDB]:
         """Get user by ID"""
-        async with self.conn.cursor() as cursor:
-            await cursor.execute(
-                "SELECT id, username, password_hash, company_description FROM users WHERE id = %s",
-                (userId,)
-            )
-            row = await cursor.fetchone()
-            if row:
-                return UserInDB(id=row[0], username=row[1], passwordHash=row[2], companyDescription=row[3])
-            return None
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    "SELECT id, username, password_hash, company_description FROM users WHERE id = %s AND deleted_at IS NULL",
+                    (userId,)
+                )
+                row = await cursor.fetchone()
+                if row:
+                    return _user(id=row[0], username=row[1], passwordHash=row[2], companyDescription=row[3])
+                return None
         
         
+    @read_only
+    async def get_profile_picture(self, userId: int) -> Optional[str]:
+        """Get the stored profile picture file name of a user"""
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    "SELECT profile_picture FROM users WHERE id = %s AND deleted_at IS NULL",
+                    (userId,)
+                )
+                row = await cursor.fetchone()
+                if row:
+                    return row[0]
+                return None
+
+    @publishes("user:{userId}")
+    async def set_profile_picture(self, userId: int, fileName: Optional[str]) -> Optional[str]:
+        """Replace the stored profile picture file name of a user, returns the previous one"""
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    f"""
+                    UPDATE users u
+                    SET profile_picture = %s
+                    FROM (SELECT id, profile_picture FROM users WHERE id = %s AND deleted_at IS NULL FOR UPDATE) old
+                    WHERE u.id = old.id
+                    RETURNING old.profile_picture, {NOTIFY}
+                    """,
+                    (fileName, userId, *notification())
+                )
+                row = await cursor.fetchone()
+                if row:
+                    return row[0]
+                return None
+
+    @read_only
+    async def get_llm_usage(self, userId: int) -> list[LLMUsage]:
+        """Get the total LLM token usage of a user, by operation"""
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    """
+                    SELECT l.operation, SUM(l.calls), SUM(l.prompt_tokens), SUM(l.completion_tokens)
+                    FROM llm_usage l
+                    JOIN users u ON l.user_id = u.id
+                    WHERE l.user_id = %s AND u.deleted_at IS NULL
+                    GROUP BY l.operation
+                    """,
+                    (userId,)
+                )
+                rows = await cursor.fetchall()
+                return [_llm_usage(operation=row[0], calls=row[1], promptTokens=row[2], completionTokens=row[3]) for row in rows]
+
+    @publishes("user:{user_id}")
     async def update_user(self, user_id, username, password_hash, company_description) -> UserInDB:
         """Update user's information"""
-        company_description = company_description or ''
-        async with self.conn.cursor() as cursor:
-            await cursor.execute(
-                """
-                UPDATE users
-                SET username = %s,
-                    password_hash = %s,
-                    company_description = %s
-                WHERE id = %s
-                """,
-                (username, password_hash, company_description, user_id)
-            )
-            return UserInDB(id=user_id, username=username, passwordHash=password_hash, companyDescription=company_description)
+        async with self.pool.connection() as conn:
+            company_description = company_description or ''
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    f"""
+                    UPDATE users
+                    SET username = %s,
+                        password_hash = %s,
+                        company_description = %s
+                    WHERE id = %s AND deleted_at IS NULL
+                    RETURNING {NOTIFY}
+                    """,
+                    (username, password_hash, company_description, user_id, *notification())
+                )
+                return _user(id=user_id, username=username, passwordHash=password_hash, companyDescription=company_description)
         
     
         
+@instrument_repository
+@trace_repository
 class ProjectRepository:
-    def __init__(self, connection: psycopg.AsyncConnection):
-        self.conn = connection
+    def __init__(self, pool: AsyncConnectionPool | RoutingPool):
+        self.pool = pool
 
     async def create_project(self, project: Project, userId: int) -> Optional[ProjectInDB]:
-        try:
-            async with self.conn.transaction():
-                async with self.conn.cursor() as cursor:
+        async with self.pool.connection() as conn:
+            try:
+                # A single statement is atomic in autocommit mode, an explicit transaction would only add the BEGIN and COMMIT round trips
+                async with conn.cursor() as cursor:
                     await cursor.execute(
-                        "INSERT INTO projects (title, description, user_id) VALUES (%s, %s, %s) RETURNING id",
+                        "INSERT INTO projects (title, description, user_id) SELECT %s, %s, id FROM users WHERE id = %s AND deleted_at IS NULL RETURNING id",
                         (project.title, project.description, userId)
                     )
                     projectId = await cursor.fetchone()
                     if projectId:
-                        return ProjectInDB(id=projectId[0], title=project.title, description=project.description, currentStep=0, riskScoreThreshold=0.1)
+                        return _project(id=projectId[0], title=project.title, description=project.description, currentStep=0, riskScoreThreshold=0.1)
                     return None
-        except psycopg.IntegrityError:
-            return None
+            except psycopg.IntegrityError:
+                return None
 
+    async def create_projects(self, projects: list[Project], userId: int) -> list[ProjectInDB]:
+        """Create many projects in one statement, in the order of the list. Empty if the user does not exist"""
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                # The ids are drawn in insertion order, so sorting on them gives back the order of the list
+                await cursor.execute(
+                    """
+                    WITH created AS (
+                        INSERT INTO projects (title, description, user_id)
+                        SELECT p.title, p.description, u.id
+                        FROM users u, unnest(%s::text[], %s::text[]) WITH ORDINALITY AS p(title, description, position)
+                        WHERE u.id = %s AND u.deleted_at IS NULL
+                        ORDER BY p.position
+                        RETURNING id, title, description
+                    )
+                    SELECT id, title, description FROM created ORDER BY id
+                    """,
+                    ([project.title for project in projects], [project.description for project in projects], userId)
+                )
+                rows = await cursor.fetchall()
+                return [_project(id=row[0], title=row[1], description=row[2], currentStep=0, riskScoreThreshold=0.1) for row in rows]
+
+    @publishes("project:{project_id}")
     async def delete_project_by_id(self, project_id: int, user_id: int) -> Optional[ProjectInDB]:
-        async with self.conn.cursor() as cursor:
-            await cursor.execute(
-                "DELETE FROM projects WHERE id = %s AND user_id = %s RETURNING id, title, description, current_step, risk_score_threshold",
-                (project_id, user_id)
-            )
-            row = await cursor.fetchone()
-            if row:
-                return ProjectInDB(id=row[0], title=row[1], description=row[2], currentStep=row[3], riskScoreThreshold=row[4])
-            return None
+        """Mark a project as deleted, its rows are removed later by purge_batch"""
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    f"""
+                    WITH deleted AS (
+                        UPDATE projects SET deleted_at = now()
+                        WHERE id = %s AND user_id = %s AND deleted_at IS NULL
+                        RETURNING id, title, description, current_step::int, risk_score_threshold::float8
+                    ), purge AS (
+                        INSERT INTO purges (user_id, project_id) SELECT %s, id FROM deleted
+                    )
+                    SELECT *, {NOTIFY} FROM deleted
+                    """,
+                    (project_id, user_id, user_id, *notification())
+                )
+                row = await cursor.fetchone()
+                if row:
+                    return _project(id=row[0], title=row[1], description=row[2], currentStep=row[3], riskScoreThreshold=row[4])
+                return None
 
+    @read_only
     async def get_project_by_id(self, projectId: int, userId: int) -> Optional[ProjectInDB]:
-        async with self.conn.cursor() as cursor:
-            await cursor.execute(
-                "SELECT title, description, current_step, risk_score_threshold FROM projects WHERE id = %s AND user_id = %s",
-                (projectId, userId)
-            )
-            row = await cursor.fetchone()
-            if row:
-                return ProjectInDB(id=projectId, title=row[0], description=row[1], currentStep=row[2], riskScoreThreshold=row[3])
-            return None
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    "SELECT title, description, current_step::int, risk_score_threshold::float8 FROM projects WHERE id = %s AND user_id = %s AND deleted_at IS NULL",
+                    (projectId, userId)
+                )
+                row = await cursor.fetchone()
+                if row:
+                    return _project(id=projectId, title=row[0], description=row[1], currentStep=row[2], riskScoreThreshold=row[3])
+                return None
 
+    @read_only
     async def get_projects_by_user_id(self, userId: int) -> list[ProjectInDB]:
-        async with self.conn.cursor() as cursor:
-            await cursor.execute(
-                "SELECT id, title, description, current_step, risk_score_threshold FROM projects WHERE user_id = %s",
-                (userId,)
-            )
-            rows = await cursor.fetchall()
-            return [ProjectInDB(id=row[0], title=row[1], description=row[2], currentStep=row[3], riskScoreThreshold=row[4]) for row in rows]
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    "SELECT id, title, description, current_step::int, risk_score_threshold::float8 FROM projects WHERE user_id = %s AND deleted_at IS NULL",
+                    (userId,)
+                )
+                rows = await cursor.fetchall()
+                return [_project(id=row[0], title=row[1], description=row[2], currentStep=row[3], riskScoreThreshold=row[4]) for row in rows]
 
 
-    async def get_project_risks(self, projectId: int, userId: int) -> list[RiskInDB]:
-        async with self.conn.cursor() as cursor:
-            await cursor.execute(
-                """
-                SELECT r.id, r.kind, r.title, r.description, r.impact, r.probability, r.contingency, r.fallback
-                FROM risks r
-                JOIN projects p ON r.project_id = p.id
-                WHERE p.id = %s AND p.user_id = %s
-                """,
-                (projectId, userId)
-            )
-            rows = await cursor.fetchall()
-            if rows:
+    @read_only
+    async def get_project_risks(self, projectId: int, userId: int) -> Optional[list[RiskInDB]]:
+        """Get the risks of a project, None if the user has no such project"""
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    """
+                    SELECT r.id, r.kind, r.title, r.description, r.impact::int, r.probability::int, r.contingency, r.fallback
+                    FROM projects p
+                    LEFT JOIN risks r ON r.project_id = p.id
+                    WHERE p.id = %s AND p.user_id = %s AND p.deleted_at IS NULL
+                    ORDER BY r.id
+                    """,
+                    (projectId, userId)
+                )
+                rows = await cursor.fetchall()
+                if not rows:
+                    return None
                 return [
-                    RiskInDB(
+                    _risk(
                         id=row[0],
                         kind=row[1],
                         title=row[2],
@@ -153,144 +425,588 @@ class ProjectRepository:
                         contingency=row[6],
                         fallback=row[7],
                         projectId=projectId
-                    ) for row in rows
+                    ) for row in rows if row[0] is not None
                 ]
-            return []
 
-    async def add_project_risks(self, projectId, userId, risks_data) -> Optional[list[RiskInDB]]:
-        try:
-            async with self.conn.transaction():
-                async with self.conn.cursor() as cursor:
-                    # Delete existing risks for the project
+    @read_only
+    async def get_project_context(self, projectId: int, userId: int) -> Optional[ProjectContext]:
+        """Get a project with its risks and its owner's company description in a single query"""
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(PROJECT_CONTEXT_QUERY, (projectId, userId))
+                return _context_from_row(projectId, await cursor.fetchone())
+
+    @read_only
+    async def get_similar_project_risks(self, projectId: int, userId: int, projectLimit: int = 3) -> Optional[list[SimilarRisk]]:
+        """Get the risks of the user's past projects most similar to this one, best matches first.
+
+        Similarity is the full-text rank of each project against any word of this
+        project's title and description, risks with the same title are returned once.
+        None if the user has no such project.
+        """
+        async with self.pool.connection() as conn:
+            async with conn.pipeline():
+                project_cursor = conn.cursor()
+                similar_cursor = conn.cursor()
+                await project_cursor.execute(
+                    "SELECT 1 FROM projects WHERE id = %s AND user_id = %s AND deleted_at IS NULL",
+                    (projectId, userId)
+                )
+                await similar_cursor.execute(SIMILAR_RISKS_QUERY, (projectId, userId, userId, projectId, projectLimit))
+            if await project_cursor.fetchone() is None:
+                return None
+            return _similar_risks_from_rows(await similar_cursor.fetchall())
+
+    @read_only
+    async def get_project_context_with_similar_risks(self, projectId: int, userId: int, projectLimit: int = 3) -> tuple[Optional[ProjectContext], list[SimilarRisk]]:
+        """get_project_context and get_similar_project_risks, pipelined in a single round trip"""
+        async with self.pool.connection() as conn:
+            async with conn.pipeline():
+                context_cursor = conn.cursor()
+                similar_cursor = conn.cursor()
+                await context_cursor.execute(PROJECT_CONTEXT_QUERY, (projectId, userId))
+                await similar_cursor.execute(SIMILAR_RISKS_QUERY, (projectId, userId, userId, projectId, projectLimit))
+            return _context_from_row(projectId, await context_cursor.fetchone()), _similar_risks_from_rows(await similar_cursor.fetchall())
+
+    @read_only
+    async def search_risks(self, userId: int, text: str, kind: Optional[str] = None, limit: int = 20, cursor: Optional[tuple[str, int]] = None) -> RiskSearchPage:
+        """Full-text search of the risks of all the user's projects, best matches first.
+
+        Pages are keyset paginated on (rank, id), `cursor` is the rank and id of the
+        last result of the previous page. Highlighting is only done for the page.
+        """
+        filters = ""
+        params: list = [text, TITLE_HEADLINE_OPTIONS, EXCERPT_HEADLINE_OPTIONS, userId]
+        if kind is not None:
+            filters += " AND r.kind = %s"
+            params.append(kind)
+        if cursor is not None:
+            # The rank is compared as real, its text form round-trips exactly
+            filters += " AND (ts_rank(r.search_vector, query.q), r.id) < (%s::real, %s)"
+            params.extend(cursor)
+        params.append(limit + 1)
+
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    f"""
+                    WITH query AS (SELECT websearch_to_tsquery('english', %s) AS q)
+                    SELECT m.id, m.project_id, m.project_title, m.kind,
+                           ts_headline('english', m.title, query.q, %s),
+                           ts_headline('english', concat_ws(' ', m.description, m.contingency, m.fallback), query.q, %s),
+                           m.rank, m.rank::text
+                    FROM (
+                        SELECT r.id, r.project_id, p.title AS project_title, r.kind, r.title, r.description, r.contingency, r.fallback,
+                               ts_rank(r.search_vector, query.q) AS rank
+                        FROM risks r
+                        JOIN projects p ON r.project_id = p.id, query
+                        WHERE p.user_id = %s AND p.deleted_at IS NULL AND r.search_vector @@ query.q{filters}
+                        ORDER BY rank DESC, r.id DESC
+                        LIMIT %s
+                    ) m, query
+                    ORDER BY m.rank DESC, m.id DESC
+                    """,
+                    params
+                )
+                rows = await cur.fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = f"{rows[-1][7]}:{rows[-1][0]}"
+        return _search_page(
+            results=[
+                _search_result(id=row[0], projectId=row[1], projectTitle=row[2], kind=row[3], title=_highlighted(row[4]), excerpt=_highlighted(row[5]), rank=row[6])
+                for row in rows
+            ],
+            nextCursor=next_cursor
+        )
+
+    @publishes("project:{projectId}")
+    async def save_project_risks(self, projectId: int, userId: int, risks: list[SavedRisk]) -> Optional[list[RiskInDB]]:
+        """Save the risk register of a project, None if the user has no such project.
+
+        Risks with an id are updated if they changed, keeping their scores and plans, risks without an id
+        are inserted, and the saved risks missing from the list are deleted. Raises StaleRisksError and
+        saves nothing if an id is not one of the project's risks.
+        """
+        async with self.pool.connection() as conn:
+            try:
+                async with conn.cursor() as cursor:
+                    # Ownership check, step update, the three kinds of changes and the removal of the drafts in one statement
                     await cursor.execute(
-                        "DELETE FROM risks WHERE project_id = %s",
-                        (projectId,)
+                        f"""
+                        WITH owned AS (
+                            SELECT id FROM projects
+                            WHERE id = %s AND user_id = %s AND deleted_at IS NULL
+                            FOR UPDATE
+                        ), input AS (
+                            SELECT * FROM unnest(%s::int[], %s::text[], %s::text[], %s::text[]) WITH ORDINALITY AS i(id, kind, title, description, position)
+                        ), unknown AS (
+                            SELECT i.id FROM input i
+                            WHERE i.id IS NOT NULL AND NOT EXISTS (
+                                SELECT 1 FROM risks r JOIN owned ON r.project_id = owned.id WHERE r.id = i.id
+                            )
+                        ), project AS (
+                            -- Nothing is written when the register was edited from risks that are gone
+                            SELECT id FROM owned WHERE NOT EXISTS (SELECT 1 FROM unknown)
+                        ), step AS (
+                            UPDATE projects SET current_step = 1
+                            WHERE id IN (SELECT id FROM project) AND current_step < 1
+                        ), deleted AS (
+                            DELETE FROM risks r
+                            USING project
+                            WHERE r.project_id = project.id AND r.id NOT IN (SELECT id FROM input WHERE id IS NOT NULL)
+                            RETURNING r.id
+                        ), updated AS (
+                            UPDATE risks r
+                            SET kind = i.kind::risk_type, title = i.title, description = i.description
+                            FROM project, input i
+                            WHERE r.id = i.id AND r.project_id = project.id
+                              AND (r.kind::text, r.title, r.description) IS DISTINCT FROM (i.kind, i.title, i.description)
+                            RETURNING r.id
+                        ), saved_draft AS (
+                            DELETE FROM generations WHERE project_id IN (SELECT id FROM project) AND step = 'risks'
+                        ), inserted AS (
+                            INSERT INTO risks (project_id, kind, title, description)
+                            SELECT project.id, i.kind::risk_type, i.title, i.description
+                            FROM project, input i
+                            WHERE i.id IS NULL
+                            ORDER BY i.position
+                            RETURNING id, kind, title, description, impact, probability, contingency, fallback
+                        ), saved AS (
+                            -- The statement sees the rows as they were before it, the kept risks take their new values from the input
+                            SELECT r.id, i.kind::risk_type AS kind, i.title, i.description, r.impact, r.probability, r.contingency, r.fallback
+                            FROM project
+                            JOIN risks r ON r.project_id = project.id
+                            JOIN input i ON i.id = r.id
+                            UNION ALL
+                            SELECT * FROM inserted
+                        )
+                        SELECT EXISTS (SELECT 1 FROM unknown), saved.id, saved.kind, saved.title, saved.description, saved.impact::int, saved.probability::int, saved.contingency, saved.fallback,
+                               CASE WHEN EXISTS (SELECT 1 FROM deleted) OR EXISTS (SELECT 1 FROM updated) OR EXISTS (SELECT 1 FROM inserted) THEN {NOTIFY} END
+                        FROM owned
+                        LEFT JOIN saved ON true
+                        ORDER BY saved.id
+                        """,
+                        (
+                            projectId,
+                            userId,
+                            [risk.id for risk in risks],
+                            [risk.kind for risk in risks],
+                            [risk.title for risk in risks],
+                            [risk.description for risk in risks],
+                            *notification()
+                        )
                     )
-                    # Update project's current step
-                    await cursor.execute(
-                        "UPDATE projects SET current_step = %s WHERE id = %s",
-                        (1, projectId)
+                    rows = await cursor.fetchall()
+                    if not rows:
+                        return None
+                    if rows[0][0]:
+                        raise StaleRisksError(f"Risks of project {projectId} changed meanwhile")
+                    return [
+                        _risk(
+                            id=row[1],
+                            projectId=projectId,
+                            kind=row[2],
+                            title=row[3],
+                            description=row[4],
+                            impact=row[5],
+                            probability=row[6],
+                            contingency=row[7],
+                            fallback=row[8]
+                        ) for row in rows if row[1] is not None
+                    ]
+            except psycopg.IntegrityError:
+                return []
+
+    @publishes("project:{projectId}")
+    async def add_project_risk(self, projectId: int, userId: int, risk: Risk) -> Optional[RiskInDB]:
+        """Add a risk to a project, None if the user has no such project"""
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    f"""
+                    INSERT INTO risks (project_id, kind, title, description)
+                    SELECT id, %s, %s, %s FROM projects
+                    WHERE id = %s AND user_id = %s AND deleted_at IS NULL
+                    RETURNING id, {NOTIFY}
+                    """,
+                    (risk.kind, risk.title, risk.description, projectId, userId, *notification())
+                )
+                row = await cursor.fetchone()
+                if row:
+                    return _risk(
+                        id=row[0],
+                        projectId=projectId,
+                        kind=risk.kind,
+                        title=risk.title,
+                        description=risk.description,
+                        impact=None,
+                        probability=None,
+                        contingency=None,
+                        fallback=None
                     )
+                return None
 
-                    # Insert risks
-                    inserted_risks = []
-                    for risk in risks_data:
-                        await cursor.execute(
-                            """
-                            INSERT INTO risks (project_id, kind, title, description)
-                            VALUES (%s, %s, %s, %s)
-                            RETURNING id, kind, title, description
-                            """,
-                            (projectId, risk.kind, risk.title, risk.description)
-                        )
-                        row = await cursor.fetchone()
-                        if row:
-                            inserted_risks.append(
-                                RiskInDB(
-                                    id=row[0],
-                                    projectId=projectId,
-                                    kind=row[1],
-                                    title=row[2],
-                                    description=row[3],
-                                    impact=None,
-                                    probability=None,
-                                    contingency=None,
-                                    fallback=None
-                                )
-                            )
-                        else:
-                            # Rollback if any insertion fails
-                            raise psycopg.IntegrityError("Failed to insert risk")
-                    return inserted_risks
-        except psycopg.IntegrityError:
-            return None
-        
+    @publishes("project:{projectId}")
+    async def update_project_risk(self, projectId: int, userId: int, riskId: int, changes: RiskUpdate) -> Optional[RiskInDB]:
+        """Change the fields of a risk set in `changes`, None if the user has no such risk"""
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                # The changes are sent as a JSON object so the statement is the same whichever fields are set
+                await cursor.execute(
+                    f"""
+                    UPDATE risks r
+                    SET kind = coalesce((c.changes->>'kind')::risk_type, r.kind),
+                        title = coalesce(c.changes->>'title', r.title),
+                        description = coalesce(c.changes->>'description', r.description),
+                        impact = CASE WHEN c.changes ? 'impact' THEN (c.changes->>'impact')::int ELSE r.impact END,
+                        probability = CASE WHEN c.changes ? 'probability' THEN (c.changes->>'probability')::int ELSE r.probability END,
+                        contingency = CASE WHEN c.changes ? 'contingency' THEN c.changes->>'contingency' ELSE r.contingency END,
+                        fallback = CASE WHEN c.changes ? 'fallback' THEN c.changes->>'fallback' ELSE r.fallback END
+                    FROM projects p, (SELECT %s::jsonb AS changes) c
+                    WHERE r.id = %s AND r.project_id = %s AND p.id = r.project_id AND p.user_id = %s AND p.deleted_at IS NULL
+                    RETURNING r.kind, r.title, r.description, r.impact::int, r.probability::int, r.contingency, r.fallback, {NOTIFY}
+                    """,
+                    (changes.model_dump_json(exclude_unset=True), riskId, projectId, userId, *notification())
+                )
+                row = await cursor.fetchone()
+                if row:
+                    return _risk(
+                        id=riskId,
+                        projectId=projectId,
+                        kind=row[0],
+                        title=row[1],
+                        description=row[2],
+                        impact=row[3],
+                        probability=row[4],
+                        contingency=row[5],
+                        fallback=row[6]
+                    )
+                return None
+
+    @publishes("project:{projectId}")
+    async def delete_project_risk(self, projectId: int, userId: int, riskId: int) -> bool:
+        """Delete a risk of a project, False if the user has no such risk"""
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    f"""
+                    DELETE FROM risks r
+                    USING projects p
+                    WHERE r.id = %s AND r.project_id = %s AND p.id = r.project_id AND p.user_id = %s AND p.deleted_at IS NULL
+                    RETURNING {NOTIFY}
+                    """,
+                    (riskId, projectId, userId, *notification())
+                )
+                return cursor.rowcount > 0
+
+    @publishes("project:{projectId}")
     async def add_project_risks_scores(self, projectId: int, userId: int, scored_risks: list[TrackedScoredRisk], riskScoreThreshold: float) -> Optional[list[RiskInDB]]:
-        try:
-            async with self.conn.transaction():
-                async with self.conn.cursor() as cursor:
-                    # Update project's current step
+        """Save the risk scores and threshold of a project, None if the user has no such project"""
+        async with self.pool.connection() as conn:
+            try:
+                async with conn.cursor() as cursor:
                     await cursor.execute(
-                        "UPDATE projects SET current_step = %s WHERE id = %s",
-                        (2, projectId)
+                        f"""
+                        WITH project AS (
+                            UPDATE projects SET current_step = 2, risk_score_threshold = %s
+                            WHERE id = %s AND user_id = %s AND deleted_at IS NULL
+                            RETURNING id
+                        ), saved_draft AS (
+                            DELETE FROM generations WHERE project_id IN (SELECT id FROM project) AND step = 'scores'
+                        ), updated AS (
+                            UPDATE risks r
+                            SET impact = s.impact, probability = s.probability
+                            FROM project, unnest(%s::int[], %s::int[], %s::int[]) WITH ORDINALITY AS s(id, impact, probability, position)
+                            WHERE r.id = s.id AND r.project_id = project.id
+                            RETURNING r.id, r.kind, r.title, r.description, r.impact, r.probability, s.position
+                        )
+                        SELECT project.id, updated.id, updated.kind, updated.title, updated.description, updated.impact::int, updated.probability::int, {NOTIFY}
+                        FROM project
+                        LEFT JOIN updated ON true
+                        ORDER BY updated.position
+                        """,
+                        (
+                            riskScoreThreshold,
+                            projectId,
+                            userId,
+                            [risk.id for risk in scored_risks],
+                            [risk.impact for risk in scored_risks],
+                            [risk.probability for risk in scored_risks],
+                            *notification()
+                        )
                     )
-                    # Update project's risk score threshold
+                    rows = await cursor.fetchall()
+                    if not rows:
+                        return None
+                    return [
+                        _risk(
+                            id=row[1],
+                            projectId=projectId,
+                            kind=row[2],
+                            title=row[3],
+                            description=row[4],
+                            impact=row[5],
+                            probability=row[6],
+                            contingency=None,
+                            fallback=None
+                        ) for row in rows if row[1] is not None
+                    ]
+            except psycopg.IntegrityError:
+                return []
+
+    @publishes("project:{projectId}")
+    async def add_project_risks_plans(self, projectId: int, userId: int, managed_risks: list[TrackedManagedRisk]) -> Optional[list[RiskInDB]]:
+        """Save the mitigation plans of a project, None if the user has no such project"""
+        async with self.pool.connection() as conn:
+            try:
+                async with conn.cursor() as cursor:
                     await cursor.execute(
-                        """
-                        UPDATE projects
-                        SET risk_score_threshold = %s
-                        WHERE id = %s
+                        f"""
+                        WITH project AS (
+                            UPDATE projects SET current_step = 3
+                            WHERE id = %s AND user_id = %s AND deleted_at IS NULL
+                            RETURNING id
+                        ), saved_draft AS (
+                            DELETE FROM generations WHERE project_id IN (SELECT id FROM project) AND step = 'plans'
+                        ), updated AS (
+                            UPDATE risks r
+                            SET contingency = m.contingency, fallback = m.fallback
+                            FROM project, unnest(%s::int[], %s::text[], %s::text[]) WITH ORDINALITY AS m(id, contingency, fallback, position)
+                            WHERE r.id = m.id AND r.project_id = project.id
+                            RETURNING r.id, r.kind, r.title, r.description, r.impact, r.probability, r.contingency, r.fallback, m.position
+                        )
+                        SELECT project.id, updated.id, updated.kind, updated.title, updated.description, updated.impact::int, updated.probability::int, updated.contingency, updated.fallback, {NOTIFY}
+                        FROM project
+                        LEFT JOIN updated ON true
+                        ORDER BY updated.position
                         """,
-                        (riskScoreThreshold, projectId)
-                    )
-                    # Update risks with scores
-                    updated_risks = []
-                    for risk in scored_risks:
-                        await cursor.execute(
-                            """
-                            UPDATE risks
-                            SET impact = %s, probability = %s
-                            WHERE id = %s AND project_id = %s
-                            RETURNING id, kind, title, description, impact, probability
-                            """,
-                            (risk.impact, risk.probability, risk.id, projectId)
+                        (
+                            projectId,
+                            userId,
+                            [risk.id for risk in managed_risks],
+                            [risk.contingency for risk in managed_risks],
+                            [risk.fallback for risk in managed_risks],
+                            *notification()
                         )
-                        row = await cursor.fetchone()
-                        if row:
-                            updated_risks.append(
-                                RiskInDB(
-                                    id=row[0],
-                                    projectId=projectId,
-                                    kind=row[1],
-                                    title=row[2],
-                                    description=row[3],
-                                    impact=row[4],
-                                    probability=row[5],
-                                    contingency=None,
-                                    fallback=None
-                                )
-                            )
-                    return updated_risks
-        except psycopg.IntegrityError:
-            return None
+                    )
+                    rows = await cursor.fetchall()
+                    if not rows:
+                        return None
+                    return [
+                        _risk(
+                            id=row[1],
+                            projectId=projectId,
+                            kind=row[2],
+                            title=row[3],
+                            description=row[4],
+                            impact=row[5],
+                            probability=row[6],
+                            contingency=row[7],
+                            fallback=row[8]
+                        ) for row in rows if row[1] is not None
+                    ]
+            except psycopg.IntegrityError:
+                return []
 
-    async def add_project_risks_plans(self, projectId: int, userId: int, managed_risks: list[TrackedManagedRisk]) -> Optional[list[RiskInDB]]:
+    async def save_generated_projects(self, userId: int, projects: list[GeneratedProject]) -> list[int]:
+        """Save the risks, scores and plans of many projects generated offline, and the tokens they used.
+
+        Only the projects of the user nobody started yet are written, their workflow is then complete.
+        Returns their ids, the others were started in the web app meanwhile or deleted.
+        No cache holds a project that was never saved, so there is nothing to invalidate.
+        """
+        risks = [(project.projectId, risk) for project in projects for risk in project.risks]
+        usage = [(project.projectId, u) for project in projects for u in project.usage]
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    """
+                    WITH project AS (
+                        UPDATE projects SET current_step = 3
+                        WHERE id = ANY(%s::int[]) AND user_id = %s AND deleted_at IS NULL AND current_step = 0
+                        RETURNING id
+                    ), inserted AS (
+                        INSERT INTO risks (project_id, kind, title, description, impact, probability, contingency, fallback)
+                        SELECT r.project_id, r.kind::risk_type, r.title, r.description, r.impact, r.probability, r.contingency, r.fallback
+                        FROM unnest(%s::int[], %s::text[], %s::text[], %s::text[], %s::int[], %s::int[], %s::text[], %s::text[])
+                            WITH ORDINALITY AS r(project_id, kind, title, description, impact, probability, contingency, fallback, position)
+                        WHERE r.project_id IN (SELECT id FROM project)
+                        ORDER BY r.position
+                    ), usage AS (
+                        -- The tokens were spent whether or not the results are kept
+                        INSERT INTO llm_usage (user_id, project_id, operation, calls, prompt_tokens, completion_tokens)
+                        SELECT p.user_id, p.id, u.operation, u.calls, u.prompt_tokens, u.completion_tokens
+                        FROM unnest(%s::int[], %s::text[], %s::int[], %s::int[], %s::int[]) AS u(project_id, operation, calls, prompt_tokens, completion_tokens)
+                        JOIN projects p ON p.id = u.project_id AND p.user_id = %s AND p.deleted_at IS NULL
+                    )
+                    SELECT id FROM project ORDER BY id
+                    """,
+                    (
+                        [project.projectId for project in projects],
+                        userId,
+                        [projectId for projectId, _ in risks],
+                        [risk.kind for _, risk in risks],
+                        [risk.title for _, risk in risks],
+                        [risk.description for _, risk in risks],
+                        [risk.impact for _, risk in risks],
+                        [risk.probability for _, risk in risks],
+                        [risk.contingency for _, risk in risks],
+                        [risk.fallback for _, risk in risks],
+                        [projectId for projectId, _ in usage],
+                        [u.operation for _, u in usage],
+                        [u.calls for _, u in usage],
+                        [u.promptTokens for _, u in usage],
+                        [u.completionTokens for _, u in usage],
+                        userId
+                    )
+                )
+                return [row[0] for row in await cursor.fetchall()]
+
+    @read_only
+    async def get_project_llm_usage(self, projectId: int, userId: int) -> list[LLMUsage]:
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    """
+                    SELECT l.operation, SUM(l.calls), SUM(l.prompt_tokens), SUM(l.completion_tokens)
+                    FROM llm_usage l
+                    JOIN projects p ON l.project_id = p.id
+                    WHERE l.project_id = %s AND l.user_id = %s AND p.deleted_at IS NULL
+                    GROUP BY l.operation
+                    """,
+                    (projectId, userId)
+                )
+                rows = await cursor.fetchall()
+                return [_llm_usage(operation=row[0], calls=row[1], promptTokens=row[2], completionTokens=row[3]) for row in rows]
+
+
+    async def record_generation(self, projectId: int, userId: int, step: str, fingerprint: str, result: list, usage: list[LLMUsage]):
+        """Keep a generation result as a draft until the step is saved, along with the tokens it used"""
+        async with self.pool.connection() as conn:
+            await conn.execute(
+                """
+                WITH generation AS (
+                    INSERT INTO generations (project_id, step, fingerprint, result) VALUES (%s, %s, %s, %s::jsonb)
+                )
+                INSERT INTO llm_usage (user_id, project_id, operation, calls, prompt_tokens, completion_tokens)
+                SELECT %s, %s, u.operation, u.calls, u.prompt_tokens, u.completion_tokens
+                FROM unnest(%s::text[], %s::int[], %s::int[], %s::int[]) AS u(operation, calls, prompt_tokens, completion_tokens)
+                """,
+                (
+                    projectId,
+                    step,
+                    fingerprint,
+                    pydantic_core.to_json(result).decode(),
+                    userId,
+                    projectId,
+                    [u.operation for u in usage],
+                    [u.calls for u in usage],
+                    [u.promptTokens for u in usage],
+                    [u.completionTokens for u in usage]
+                )
+            )
+
+    @read_only
+    async def get_latest_generation(self, projectId: int, userId: int, step: str, fingerprint: str, maxAgeSeconds: float) -> Optional[GenerationDraft]:
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    """
+                    SELECT g.step, g.created_at, g.result
+                    FROM generations g
+                    JOIN projects p ON g.project_id = p.id
+                    WHERE g.project_id = %s AND p.user_id = %s AND p.deleted_at IS NULL AND g.step = %s AND g.fingerprint = %s
+                      AND g.created_at > now() - make_interval(secs => %s)
+                    ORDER BY g.created_at DESC
+                    LIMIT 1
+                    """,
+                    (projectId, userId, step, fingerprint, maxAgeSeconds)
+                )
+                row = await cursor.fetchone()
+                if row:
+                    return _draft(step=row[0], createdAt=row[1], result=row[2])
+                return None
+
+    @asynccontextmanager
+    async def claim_pending_purge(self, conn: psycopg.AsyncConnection) -> AsyncIterator[Optional[Purge]]:
+        """The oldest deletion whose rows are not all purged yet and that no other worker is purging.
+
+        The deletion stays claimed until the block exits, by an advisory lock held on
+        conn. It must be a connection outside the pool, opened by the caller, as a purge
+        would otherwise keep a pooled connection for its whole length. The batches run
+        on the pool as short transactions of their own. Yields None when there is
+        nothing to purge.
+        """
+        async with conn.cursor() as cursor:
+            # The candidates are tried in order and the query stops at the first lock it gets, so it takes at most one
+            await cursor.execute(
+                """
+                SELECT id, user_id, project_id, requested_at, purged_rows
+                FROM (SELECT * FROM purges WHERE finished_at IS NULL ORDER BY id) pending
+                WHERE pg_try_advisory_lock(%s, id)
+                LIMIT 1
+                """,
+                (PURGE_LOCK,)
+            )
+            row = await cursor.fetchone()
+        if row is None:
+            yield None
+            return
         try:
-            async with self.conn.transaction():
-                async with self.conn.cursor() as cursor:
-                    # Update project's current step
+            yield _purge(id=row[0], userId=row[1], projectId=row[2], requestedAt=row[3], purgedRows=row[4])
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock(%s, %s)", (PURGE_LOCK, row[0]))
+
+    async def purge_batch(self, purge: Purge, batchSize: int) -> int:
+        """Delete at most batchSize rows of a deleted project or account, returns the number deleted.
+
+        Every call is a short transaction of its own. Returns 0 and marks the purge
+        as finished once nothing is left. The purge must be claimed by claim_pending_purge.
+        """
+        if purge.projectId is None:
+            scope, statements = "p.user_id = %(user)s", PURGE_STATEMENTS + PURGE_ACCOUNT_STATEMENTS
+        else:
+            scope, statements = "p.id = %(project)s", PURGE_STATEMENTS
+        params = {"user": purge.userId, "project": purge.projectId, "limit": batchSize, "purge": purge.id}
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                for statement in statements:
                     await cursor.execute(
-                        "UPDATE projects SET current_step = %s WHERE id = %s",
-                        (3, projectId)
-                    )
-                    updated_risks = []
-                    for risk in managed_risks:
-                        await cursor.execute(
-                            """
-                            UPDATE risks
-                            SET contingency = %s, fallback = %s
-                            WHERE id = %s AND project_id = %s
-                            RETURNING id, kind, title, description, impact, probability, contingency, fallback
-                            """,
-                            (risk.contingency, risk.fallback, risk.id, projectId)
+                        f"""
+                        WITH deleted AS ({statement.format(scope=scope)} RETURNING 1),
+                        progress AS (
+                            UPDATE purges SET purged_rows = purged_rows + (SELECT count(*) FROM deleted), updated_at = now()
+                            WHERE id = %(purge)s AND EXISTS (SELECT 1 FROM deleted)
                         )
-                        row = await cursor.fetchone()
-                        if row:
-                            updated_risks.append(
-                                RiskInDB(
-                                    id=row[0],
-                                    projectId=projectId,
-                                    kind=row[1],
-                                    title=row[2],
-                                    description=row[3],
-                                    impact=row[4],
-                                    probability=row[5],
-                                    contingency=row[6],
-                                    fallback=row[7]
-                                )
-                            )
-                    return updated_risks
-        except psycopg.IntegrityError:
-            return None
-        
-    
\ No newline at end of file
+                        SELECT count(*) FROM deleted
+                        """,
+                        params
+                    )
+                    deleted = (await cursor.fetchone())[0]
+                    if deleted:
+                        return deleted
+                await cursor.execute("UPDATE purges SET finished_at = now(), updated_at = now() WHERE id = %s", (purge.id,))
+                return 0
+
+    async def delete_expired_generations(self, maxAgeSeconds: float, keepPerStep: int) -> int:
+        """Delete the drafts older than maxAgeSeconds and all but the latest keepPerStep of each project step"""
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    """
+                    DELETE FROM generations
+                    WHERE created_at < now() - make_interval(secs => %s)
+                       OR id IN (
+                           SELECT id FROM (
+                               SELECT id, row_number() OVER (PARTITION BY project_id, step ORDER BY created_at DESC) AS position
+                               FROM generations
+                           ) ranked
+                           WHERE position > %s
+                       )
+                    """,
+                    (maxAgeSeconds, keepPerStep)
+                )
+                return cursor.rowcount
@@ -0,0 +1,244 @@
+import asyncio
+import contextvars
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Optional
+import pydantic_core
+from database import ProjectRepository
+from jobs import PRIORITY_SPECULATIVE, job_priority
+from metrics import record_cache
+from models import ProjectInDB, Risk, RiskInDB, TokenUsage, TrackedManagedRisk, TrackedRisk, TrackedScoredRisk, row_factory
+from tracing import start_span
+
+from llm import LLM # type: ignore
+
+logger = logging.getLogger(__name__)
+
+# When enabled, saving a workflow step starts generating the next one in the background
+SPECULATIVE_GENERATION = os.getenv("SPECULATIVE_GENERATION", "false").lower() in ("1", "true", "yes")
+# Speculative generations run one at a time per worker so they don't compete with user requests
+SPECULATIVE_CONCURRENCY = int(os.getenv("SPECULATIVE_CONCURRENCY", "1"))
+GENERATION_CACHE_SIZE = int(os.getenv("GENERATION_CACHE_SIZE", "256"))
+GENERATION_CACHE_TTL = float(os.getenv("GENERATION_CACHE_TTL", "3600"))
+# Unsaved generation results are kept as drafts for this long, and at most this many per project step
+DRAFT_RETENTION_HOURS = float(os.getenv("DRAFT_RETENTION_HOURS", "168"))
+DRAFT_KEEP_PER_STEP = int(os.getenv("DRAFT_KEEP_PER_STEP", "5"))
+DRAFT_CLEANUP_INTERVAL = float(os.getenv("DRAFT_CLEANUP_INTERVAL", "3600"))
+
+STEP_RISKS = "risks"
+STEP_SCORES = "scores"
+STEP_PLANS = "plans"
+
+# The step inputs are built from risks read from the database or returned by the LLM, which are already valid
+_tracked_risk = row_factory(TrackedRisk)
+_tracked_scored_risk = row_factory(TrackedScoredRisk)
+_tracked_managed_risk = row_factory(TrackedManagedRisk)
+
+
+def fingerprint(*inputs: Any) -> str:
+    """Hash of everything a generation depends on, used to detect stale results"""
+    digest = hashlib.sha256()
+    for value in inputs:
+        digest.update(pydantic_core.to_json(value))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def risks_fingerprint(company_description: str, project: ProjectInDB) -> str:
+    return fingerprint(company_description, project.title, project.description)
+
+
+def scores_fingerprint(company_description: str, project: ProjectInDB, risks: list[TrackedRisk]) -> str:
+    return fingerprint(company_description, project.title, project.description, risks)
+
+
+def plans_fingerprint(company_description: str, project: ProjectInDB, significant_risks: list[TrackedScoredRisk], insignificant_risks: list[TrackedScoredRisk]) -> str:
+    return fingerprint(company_description, project.title, project.description, significant_risks, insignificant_risks)
+
+
+def scoring_inputs(risks: list[RiskInDB]) -> list[TrackedRisk]:
+    return [_tracked_risk(id=r.id, kind=r.kind, title=r.title, description=r.description) for r in risks]
+
+
+def planning_inputs(risks: list[RiskInDB] | list[TrackedScoredRisk], riskScoreThreshold: Optional[float]) -> tuple[list[TrackedScoredRisk], list[TrackedScoredRisk]]:
+    """Split the risks in the ones that need a mitigation plan and the ones below the threshold"""
+    # Only risks with impact*probability > risk_score_threshold*100 get a plan
+    threshold_score = (riskScoreThreshold or 0) * 100
+    significant_risks = []
+    insignificant_risks = []
+    for risk in risks:
+        tracked_risk = _tracked_scored_risk(
+            id=risk.id,
+            title=risk.title,
+            kind=risk.kind,
+            description=risk.description,
+            impact=risk.impact or 1,
+            probability=risk.probability or 1
+        )
+        if tracked_risk.impact * tracked_risk.probability > threshold_score:
+            significant_risks.append(tracked_risk)
+        else:
+            insignificant_risks.append(tracked_risk)
+    return significant_risks, insignificant_risks
+
+
+async def generate_risks(llm: LLM, project_db: ProjectRepository, user_id: int, company_description: str, project: ProjectInDB, seed_risks: Optional[list[Risk]] = None) -> list[Risk]:
+    usage = TokenUsage()
+    risks = await llm.generate_risks(company_description, project, usage=usage, seed_risks=seed_risks)
+    await project_db.record_generation(project.id, user_id, STEP_RISKS, risks_fingerprint(company_description, project), risks, usage.records())
+    return risks
+
+
+async def generate_scores(llm: LLM, project_db: ProjectRepository, user_id: int, company_description: str, project: ProjectInDB, risks: list[TrackedRisk]) -> list[TrackedScoredRisk]:
+    usage = TokenUsage()
+    scored_risks = await llm.generate_risk_scores(company_description, project, risks, usage=usage)
+    await project_db.record_generation(project.id, user_id, STEP_SCORES, scores_fingerprint(company_description, project, risks), scored_risks, usage.records())
+    return scored_risks
+
+
+async def generate_plans(llm: LLM, project_db: ProjectRepository, user_id: int, company_description: str, project: ProjectInDB, significant_risks: list[TrackedScoredRisk], insignificant_risks: list[TrackedScoredRisk]) -> list[TrackedManagedRisk]:
+    usage = TokenUsage()
+    managed_risks = await llm.generate_risk_mitigation_plan(company_description, project, significant_risks, usage=usage)
+    managed_risks += [_tracked_managed_risk(**r.__dict__, contingency=None, fallback=None) for r in insignificant_risks]
+    await project_db.record_generation(project.id, user_id, STEP_PLANS, plans_fingerprint(company_description, project, significant_risks, insignificant_risks), managed_risks, usage.records())
+    return managed_risks
+
+
+async def cleanup_drafts(project_db: ProjectRepository):
+    """Periodically delete expired drafts, runs until cancelled"""
+    while True:
+        try:
+            deleted = await project_db.delete_expired_generations(DRAFT_RETENTION_HOURS * 3600, DRAFT_KEEP_PER_STEP)
+            if deleted:
+                logger.info(f"Deleted {deleted} expired drafts")
+        except Exception as e:
+            logger.warning(f"Draft cleanup failed: {e!r}")
+        await asyncio.sleep(DRAFT_CLEANUP_INTERVAL)
+
+
+@dataclass
+class _Entry:
+    fingerprint: str
+    task: Optional[asyncio.Task] = None
+    started: bool = False
+    created: float = field(default_factory=time.monotonic)
+
+
+class GenerationCache:
+    """Results of speculative generations, by project and workflow step.
+
+    An entry is handed out at most once and only if its input fingerprint still
+    matches, so an explicit regeneration always calls the LLM again. Entries
+    still waiting for their turn are dropped rather than awaited.
+    """
+
+    def __init__(self, max_size: int = GENERATION_CACHE_SIZE, ttl: float = GENERATION_CACHE_TTL, concurrency: int = SPECULATIVE_CONCURRENCY):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.entries: OrderedDict[tuple[int, str], _Entry] = OrderedDict()
+
+    def speculate(self, project_id: int, step: str, key: str, generate: Callable[[], Awaitable[Any]]):
+        """Start generating `step` in the background, unless the same inputs are already being generated"""
+        existing = self.entries.get((project_id, step))
+        if existing is not None and existing.fingerprint == key and not self._expired(existing):
+            return
+        self._discard((project_id, step))
+
+        entry = _Entry(fingerprint=key)
+
+        async def run():
+            async with self.semaphore:
+                entry.started = True
+                with start_span("speculative_generation", **{"project.id": project_id, "generation.step": step}), job_priority(PRIORITY_SPECULATIVE):
+                    return await generate()
+
+        # A fresh context so the generation is traced on its own rather than inside the request that started it
+        entry.task = asyncio.create_task(run(), context=contextvars.Context())
+        entry.task.add_done_callback(self._log_failure)
+        self.entries[(project_id, step)] = entry
+        while len(self.entries) > self.max_size:
+            self._discard(next(iter(self.entries)))
+
+    async def take(self, project_id: int, step: str, key: str) -> Optional[Any]:
+        """Return the speculative result for these inputs, waiting for it if it is being generated"""
+        entry = self.entries.pop((project_id, step), None)
+        if entry is None or entry.fingerprint != key or self._expired(entry) or not entry.started:
+            if entry is not None:
+                entry.task.cancel()
+            record_cache("generation", False)
+            return None
+
+        try:
+            result = await asyncio.shield(entry.task)
+        except asyncio.CancelledError:
+            if not entry.task.cancelled():
+                # The request itself was cancelled, nobody is left to use the result
+                entry.task.cancel()
+                raise
+            result = None
+        except Exception:
+            result = None
+        record_cache("generation", result is not None)
+        return result
+
+    def invalidate(self, project_id: int):
+        """Drop and cancel every speculative generation of a project"""
+        for key in [key for key in self.entries if key[0] == project_id]:
+            self._discard(key)
+
+    def evict(self, key: Optional[str]):
+        """Invalidation bus subscriber, drops the generations of a changed project, or all of them on None"""
+        if key is None:
+            for entry_key in list(self.entries):
+                self._discard(entry_key)
+            return
+        kind, _, entity_id = key.partition(":")
+        if kind == "project":
+            self.invalidate(int(entity_id))
+
+    async def close(self):
+        tasks = [entry.task for entry in self.entries.values()]
+        self.entries.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _discard(self, key: tuple[int, str]):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            entry.task.cancel()
+
+    def _expired(self, entry: _Entry) -> bool:
+        return time.monotonic() - entry.created > self.ttl
+
+    @staticmethod
+    def _log_failure(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Speculative generation failed: {task.exception()!r}")
+
+
+async def speculate_risk_scores(cache: GenerationCache, llm: LLM, project_db: ProjectRepository, user_id: int, project_id: int):
+    """Pre-generate the qualitative analysis of a project whose risks were just saved"""
+    context = await project_db.get_project_context(project_id, user_id)
+    if context is None or not context.risks:
+        return
+    company_description, project = context.companyDescription, context.project
+    risks = scoring_inputs(context.risks)
+    key = scores_fingerprint(company_description, project, risks)
+    cache.speculate(project_id, STEP_SCORES, key, lambda: generate_scores(llm, project_db, user_id, company_description, project, risks))
+
+
+async def speculate_risk_plans(cache: GenerationCache, llm: LLM, project_db: ProjectRepository, user_id: int, project_id: int):
+    """Pre-generate the mitigation plans of a project whose risk scores were just saved"""
+    context = await project_db.get_project_context(project_id, user_id)
+    if context is None or not context.risks:
+        return
+    company_description, project = context.companyDescription, context.project
+    significant_risks, insignificant_risks = planning_inputs(context.risks, project.riskScoreThreshold)
+    key = plans_fingerprint(company_description, project, significant_risks, insignificant_risks)
+    cache.speculate(project_id, STEP_PLANS, key, lambda: generate_plans(llm, project_db, user_id, company_description, project, significant_risks, insignificant_risks))
@@ -0,0 +1,108 @@
+import asyncio
+import functools
+import inspect
+import logging
+import os
+import uuid
+from contextvars import ContextVar
+from typing import Callable, Optional
+import psycopg
+from metrics import record_invalidation
+
+logger = logging.getLogger(__name__)
+
+# Postgres channel on which the workers tell each other which cached entities changed
+INVALIDATION_CHANNEL = os.getenv("INVALIDATION_CHANNEL", "aira_invalidation")
+# Seconds between two attempts to reconnect the listening connection
+INVALIDATION_RECONNECT_SECONDS = float(os.getenv("INVALIDATION_RECONNECT_SECONDS", "1"))
+
+# Tells the notifications of this worker apart, it already evicted the entries when it published them
+_ORIGIN = uuid.uuid4().hex
+
+# Select list entry of a write statement notifying the other workers, with the parameters of notification().
+# Postgres sends identical notifications of a transaction once, when it commits, however many rows select it
+NOTIFY = "pg_notify(%s, %s)"
+
+# Payload of the notifications of the @publishes method being run
+_published: ContextVar[str] = ContextVar("published_keys")
+
+# Called with an entity key such as "project:12", or None when every entry must go
+_subscribers: list[Callable[[Optional[str]], None]] = []
+
+
+def subscribe(callback: Callable[[Optional[str]], None]):
+    _subscribers.append(callback)
+
+
+def unsubscribe(callback: Callable[[Optional[str]], None]):
+    _subscribers.remove(callback)
+
+
+def evict(key: Optional[str], source: str):
+    """Hand a changed entity key to the caches of this worker, None flushes them"""
+    record_invalidation(source)
+    for callback in list(_subscribers):
+        try:
+            callback(key)
+        except Exception as e:
+            logger.warning(f"Cache invalidation of {key} failed: {e!r}")
+
+
+def publishes(*templates: str):
+    """Repository write method decorator invalidating the cached entities it changed.
+
+    The keys are formatted from the method arguments, e.g. "project:{projectId}".
+    Once the write returned the local caches are evicted at once. The other workers
+    are notified by the write statement itself, which selects NOTIFY with the
+    parameters of notification() for the rows it changed, so a write that changed
+    nothing notifies nobody and no other connection or round trip is needed.
+    """
+    def decorator(method):
+        signature = inspect.signature(method)
+
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            arguments = signature.bind(self, *args, **kwargs).arguments
+            keys = [template.format(**arguments) for template in templates]
+            token = _published.set(" ".join([_ORIGIN, *keys]))
+            try:
+                result = await method(self, *args, **kwargs)
+            finally:
+                _published.reset(token)
+            for key in keys:
+                evict(key, "local")
+            return result
+        return wrapper
+    return decorator
+
+
+def notification() -> tuple[str, str]:
+    """Parameters of NOTIFY in a statement of a @publishes method: the channel, and the keys the method publishes"""
+    return INVALIDATION_CHANNEL, _published.get()
+
+
+async def listen(conninfo: str):
+    """Evict the entities changed by the other workers, runs until cancelled.
+
+    Notifications sent while the connection is down are lost, so every cache is
+    flushed once listening again.
+    """
+    connected_before = False
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(conninfo, autocommit=True) as conn:
+                await conn.execute(f"LISTEN {INVALIDATION_CHANNEL}")
+                if connected_before:
+                    logger.info("Invalidation listener reconnected, flushing the caches")
+                    evict(None, "flush")
+                connected_before = True
+                async for notify in conn.notifies():
+                    origin, *keys = notify.payload.split(" ")
+                    if origin == _ORIGIN:
+                        continue
+                    for key in keys:
+                        evict(key, "remote")
+        except psycopg.OperationalError as e:
+            logger.warning(f"Invalidation listener disconnected: {e!r}")
+            connected_before = True
+        await asyncio.sleep(INVALIDATION_RECONNECT_SECONDS)
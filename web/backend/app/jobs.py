@@ -0,0 +1,396 @@
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Optional
+import psycopg
+import pydantic_core
+from psycopg_pool import AsyncConnectionPool
+from budget import LLM_QUEUE
+from metrics import record_llm_job, record_llm_job_claim
+from models import LLMUsage, Project, Risk, TokenUsage, TrackedManagedRisk, TrackedRisk, TrackedScoredRisk, row_factory
+
+from llm import LLM # type: ignore
+
+logger = logging.getLogger(__name__)
+
+# Queued LLM calls run at once by each backend instance, 0 to leave them to the dedicated workers (worker.py)
+LLM_QUEUE_CONCURRENCY = int(os.getenv("LLM_QUEUE_CONCURRENCY", "4"))
+# A claimed call goes back to the queue when its worker stops renewing the lease for this long
+LLM_QUEUE_LEASE_SECONDS = float(os.getenv("LLM_QUEUE_LEASE_SECONDS", "30"))
+# Attempts before a failing call is dead-lettered, the first retry waits LLM_QUEUE_RETRY_DELAY seconds and every next one twice as long
+LLM_QUEUE_MAX_ATTEMPTS = int(os.getenv("LLM_QUEUE_MAX_ATTEMPTS", "3"))
+LLM_QUEUE_RETRY_DELAY = float(os.getenv("LLM_QUEUE_RETRY_DELAY", "5"))
+# Idle workers and waiting requests look at the queue this often in case they missed a notification
+LLM_QUEUE_POLL_SECONDS = float(os.getenv("LLM_QUEUE_POLL_SECONDS", "2"))
+# Results nobody picked up and dead-lettered calls are deleted after this long
+LLM_QUEUE_RETENTION_HOURS = float(os.getenv("LLM_QUEUE_RETENTION_HOURS", "24"))
+
+LLM_QUEUE_CHANNEL = "aira_llm_jobs"
+
+# Calls are claimed by decreasing priority: a user waiting on a page first
+PRIORITY_INTERACTIVE = 10
+PRIORITY_SPECULATIVE = 0
+PRIORITY_BULK = -10
+
+_priority: ContextVar[int] = ContextVar("llm_job_priority", default=PRIORITY_INTERACTIVE)
+
+# The results were validated by the worker when it parsed the LLM response
+_risk = row_factory(Risk)
+_tracked_scored_risk = row_factory(TrackedScoredRisk)
+_tracked_managed_risk = row_factory(TrackedManagedRisk)
+
+
+@contextmanager
+def job_priority(priority: int):
+    """Queue the LLM calls made inside the block with this priority"""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class JobFailed(Exception):
+    """A queued LLM call failed on every attempt"""
+
+
+@dataclass
+class _Job:
+    id: int
+    operation: str
+    payload: dict
+    attempts: int
+
+
+async def _execute(llm: LLM, operation: str, payload: dict) -> tuple[list, list[LLMUsage]]:
+    usage = TokenUsage()
+    company_description = payload["companyDescription"]
+    project = Project.model_validate(payload["project"])
+    if operation == "generate_risks":
+        seed_risks = [Risk.model_validate(r) for r in payload["seedRisks"]] if payload["seedRisks"] is not None else None
+        result = await llm.generate_risks(company_description, project, usage=usage, seed_risks=seed_risks)
+    elif operation == "generate_risk_scores":
+        risks = [TrackedRisk.model_validate(r) for r in payload["risks"]]
+        result = await llm.generate_risk_scores(company_description, project, risks, usage=usage)
+    elif operation == "generate_risk_mitigation_plan":
+        risks = [TrackedScoredRisk.model_validate(r) for r in payload["risks"]]
+        result = await llm.generate_risk_mitigation_plan(company_description, project, risks, usage=usage)
+    else:
+        raise ValueError(f"Unknown LLM operation {operation!r}")
+    return result, usage.records()
+
+
+class LLMQueue:
+    """LLM calls queued in Postgres and claimed with SKIP LOCKED by the workers of any backend instance.
+
+    A worker holds a lease on the call it runs and renews it while waiting for the
+    LLM, so the call of a worker that died is claimed again once the lease ran out.
+    Failed calls are retried after a backoff, then dead-lettered: kept with their
+    error until LLM_QUEUE_RETENTION_HOURS. The result is written back to the row and
+    the requesting instance, woken up by a notification, deletes it as it reads it.
+    """
+
+    def __init__(self, pool: AsyncConnectionPool, conninfo: str):
+        self.pool = pool
+        self.conninfo = conninfo
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.work_available = asyncio.Event()
+        self.waiting: dict[int, asyncio.Event] = {}
+
+    async def run(self, operation: str, payload: dict[str, Any], usage: Optional[TokenUsage] = None) -> list:
+        """Queue an LLM call and wait for its result, as JSON"""
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(
+                """
+                WITH job AS (
+                    INSERT INTO llm_jobs (operation, payload, priority) VALUES (%s, %s::jsonb, %s)
+                    RETURNING id
+                )
+                SELECT id, pg_notify(%s, 'queued') FROM job
+                """,
+                (operation, pydantic_core.to_json(payload).decode(), _priority.get(), LLM_QUEUE_CHANNEL)
+            )
+            job_id = (await cursor.fetchone())[0]
+
+        finished = asyncio.Event()
+        self.waiting[job_id] = finished
+        try:
+            while True:
+                finished.clear()
+                row = await self._take(job_id)
+                if row is None:
+                    raise JobFailed(f"{operation} job {job_id} disappeared from the queue")
+                status, result, job_usage, error = row
+                if status == "done":
+                    if usage is not None:
+                        usage.extend([LLMUsage.model_validate(u) for u in job_usage])
+                    return result
+                if status == "dead":
+                    raise JobFailed(f"{operation} failed {LLM_QUEUE_MAX_ATTEMPTS} times, last error: {error}")
+                try:
+                    await asyncio.wait_for(finished.wait(), LLM_QUEUE_POLL_SECONDS)
+                except TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            # Nobody is left to use the result, a worker already running the call stops at its next heartbeat
+            await self._cancel(job_id)
+            raise
+        finally:
+            del self.waiting[job_id]
+
+    async def serve(self, llm: Optional[LLM], concurrency: int):
+        """Listen to the queue notifications and, given an LLM, run up to `concurrency` calls at once. Runs until cancelled"""
+        tasks = [asyncio.create_task(self._listen()), asyncio.create_task(self._maintain())]
+        if llm is not None:
+            tasks += [asyncio.create_task(self._work(llm)) for _ in range(concurrency)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _take(self, job_id: int) -> Optional[tuple]:
+        """Status of a call, its result and usage if it is done, in which case it is removed from the queue"""
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(
+                """
+                WITH taken AS (
+                    DELETE FROM llm_jobs WHERE id = %s AND status = 'done'
+                    RETURNING status, result, usage, error
+                )
+                SELECT status::text, result, usage, error FROM taken
+                UNION ALL
+                SELECT status::text, NULL, NULL, error FROM llm_jobs WHERE id = %s AND status <> 'done'
+                """,
+                (job_id, job_id)
+            )
+            return await cursor.fetchone()
+
+    async def _cancel(self, job_id: int):
+        try:
+            async with self.pool.connection() as conn:
+                await conn.execute("DELETE FROM llm_jobs WHERE id = %s AND status IN ('queued', 'running')", (job_id,))
+        except psycopg.Error as e:
+            logger.warning(f"Failed to cancel LLM job {job_id}: {e!r}")
+
+    async def _listen(self):
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(self.conninfo, autocommit=True) as conn:
+                    await conn.execute(f"LISTEN {LLM_QUEUE_CHANNEL}")
+                    # Notifications sent while not listening are lost, everyone looks at the queue again
+                    self.work_available.set()
+                    for finished in self.waiting.values():
+                        finished.set()
+                    async for notify in conn.notifies():
+                        if notify.payload == "queued":
+                            self.work_available.set()
+                            continue
+                        finished = self.waiting.get(int(notify.payload.removeprefix("finished ")))
+                        if finished is not None:
+                            finished.set()
+            except psycopg.OperationalError as e:
+                logger.warning(f"LLM queue listener disconnected: {e!r}")
+            await asyncio.sleep(LLM_QUEUE_POLL_SECONDS)
+
+    async def _work(self, llm: LLM):
+        while True:
+            self.work_available.clear()
+            try:
+                claim = asyncio.ensure_future(self._claim())
+                try:
+                    job = await asyncio.shield(claim)
+                except asyncio.CancelledError:
+                    # Shutting down, a call claimed meanwhile goes back to the queue right away
+                    job = await claim
+                    if job is not None:
+                        await self._release(job)
+                    raise
+                if job is not None:
+                    await self._run_job(llm, job)
+                    continue
+            except psycopg.Error as e:
+                # The lease of a claimed call runs out and another worker retries it
+                logger.warning(f"LLM queue worker failed: {e!r}")
+            try:
+                await asyncio.wait_for(self.work_available.wait(), LLM_QUEUE_POLL_SECONDS)
+            except TimeoutError:
+                pass
+
+    async def _claim(self) -> Optional[_Job]:
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(
+                """
+                UPDATE llm_jobs j
+                SET status = 'running', attempts = j.attempts + 1, worker = %s, leased_until = now() + make_interval(secs => %s)
+                FROM (
+                    SELECT id FROM llm_jobs
+                    WHERE status = 'queued' AND run_after <= now()
+                    ORDER BY priority DESC, id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                ) next
+                WHERE j.id = next.id
+                RETURNING j.id, j.operation, j.payload, j.attempts, extract(epoch FROM now() - j.run_after)::float8
+                """,
+                (self.worker_id, LLM_QUEUE_LEASE_SECONDS)
+            )
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+        record_llm_job_claim(row[1], row[4])
+        return _Job(id=row[0], operation=row[1], payload=row[2], attempts=row[3])
+
+    async def _run_job(self, llm: LLM, job: _Job):
+        task = asyncio.create_task(_execute(llm, job.operation, job.payload))
+        try:
+            while not (await asyncio.wait({task}, timeout=LLM_QUEUE_LEASE_SECONDS / 3))[0]:
+                if not await self._heartbeat(job):
+                    # Cancelled by the requester, or the lease ran out and the call is someone else's now
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    record_llm_job(job.operation, "lost")
+                    return
+        except asyncio.CancelledError:
+            # Shutting down, the call goes back to the queue without counting as an attempt
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await self._release(job)
+            raise
+
+        try:
+            result, usage = task.result()
+        except Exception as e:
+            await self._fail(job, e)
+            return
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(
+                """
+                WITH finished AS (
+                    UPDATE llm_jobs
+                    SET status = 'done', result = %s::jsonb, usage = %s::jsonb, error = NULL, leased_until = NULL, finished_at = now()
+                    WHERE id = %s AND worker = %s AND status = 'running'
+                    RETURNING id
+                )
+                SELECT pg_notify(%s, 'finished ' || id) FROM finished
+                """,
+                (pydantic_core.to_json(result).decode(), pydantic_core.to_json(usage).decode(), job.id, self.worker_id, LLM_QUEUE_CHANNEL)
+            )
+            record_llm_job(job.operation, "done" if cursor.rowcount else "lost")
+
+    async def _heartbeat(self, job: _Job) -> bool:
+        """Renew the lease, False if the call is not this worker's anymore"""
+        try:
+            async with self.pool.connection() as conn:
+                cursor = await conn.execute(
+                    "UPDATE llm_jobs SET leased_until = now() + make_interval(secs => %s) WHERE id = %s AND worker = %s AND status = 'running'",
+                    (LLM_QUEUE_LEASE_SECONDS, job.id, self.worker_id)
+                )
+                return cursor.rowcount > 0
+        except psycopg.Error as e:
+            # Keep going, the lease may still be renewed by the next heartbeat
+            logger.warning(f"Failed to renew the lease of LLM job {job.id}: {e!r}")
+            return True
+
+    async def _fail(self, job: _Job, error: Exception):
+        dead = job.attempts >= LLM_QUEUE_MAX_ATTEMPTS
+        logger.warning(f"LLM job {job.id} ({job.operation}) failed on attempt {job.attempts}{', dead-lettered' if dead else ''}: {error!r}")
+        async with self.pool.connection() as conn:
+            await conn.execute(
+                """
+                WITH failed AS (
+                    UPDATE llm_jobs
+                    SET status = %s::llm_job_status, error = %s, worker = NULL, leased_until = NULL,
+                        run_after = now() + make_interval(secs => %s), finished_at = CASE WHEN %s THEN now() END
+                    WHERE id = %s AND worker = %s AND status = 'running'
+                    RETURNING id
+                )
+                SELECT pg_notify(%s, CASE WHEN %s THEN 'finished ' || id ELSE 'queued' END) FROM failed
+                """,
+                (
+                    "dead" if dead else "queued",
+                    repr(error),
+                    LLM_QUEUE_RETRY_DELAY * 2 ** (job.attempts - 1),
+                    dead,
+                    job.id,
+                    self.worker_id,
+                    LLM_QUEUE_CHANNEL,
+                    dead
+                )
+            )
+        record_llm_job(job.operation, "dead" if dead else "retried")
+
+    async def _release(self, job: _Job):
+        try:
+            async with self.pool.connection() as conn:
+                await conn.execute(
+                    """
+                    WITH released AS (
+                        UPDATE llm_jobs SET status = 'queued', attempts = attempts - 1, worker = NULL, leased_until = NULL
+                        WHERE id = %s AND worker = %s AND status = 'running'
+                        RETURNING id
+                    )
+                    SELECT pg_notify(%s, 'queued') FROM released
+                    """,
+                    (job.id, self.worker_id, LLM_QUEUE_CHANNEL)
+                )
+        except psycopg.Error as e:
+            logger.warning(f"Failed to release LLM job {job.id}, it is retried once its lease runs out: {e!r}")
+
+    async def _maintain(self):
+        """Requeue or dead-letter the calls whose worker stopped renewing the lease, and delete the old finished calls"""
+        while True:
+            try:
+                async with self.pool.connection() as conn:
+                    cursor = await conn.execute(
+                        """
+                        WITH expired AS (
+                            UPDATE llm_jobs
+                            SET status = CASE WHEN attempts >= %s THEN 'dead' ELSE 'queued' END::llm_job_status,
+                                error = 'Lease expired', worker = NULL, leased_until = NULL,
+                                finished_at = CASE WHEN attempts >= %s THEN now() END
+                            WHERE id IN (
+                                SELECT id FROM llm_jobs
+                                WHERE status = 'running' AND leased_until < now()
+                                FOR UPDATE SKIP LOCKED
+                            )
+                            RETURNING id, status
+                        ), removed AS (
+                            DELETE FROM llm_jobs WHERE finished_at < now() - make_interval(secs => %s)
+                        )
+                        SELECT id, status::text, pg_notify(%s, CASE WHEN status = 'dead' THEN 'finished ' || id ELSE 'queued' END)
+                        FROM expired
+                        """,
+                        (LLM_QUEUE_MAX_ATTEMPTS, LLM_QUEUE_MAX_ATTEMPTS, LLM_QUEUE_RETENTION_HOURS * 3600, LLM_QUEUE_CHANNEL)
+                    )
+                    expired = await cursor.fetchall()
+                if expired:
+                    logger.warning(f"Took back {len(expired)} LLM jobs whose worker stopped: {', '.join(f'{id} ({status})' for id, status, _ in expired)}")
+            except psycopg.Error as e:
+                logger.warning(f"LLM queue maintenance failed: {e!r}")
+            await asyncio.sleep(LLM_QUEUE_LEASE_SECONDS / 2)
+
+
+class QueuedLLM:
+    """Stands in for LLM in the backend, its generation calls go through the queue"""
+
+    def __init__(self, queue: LLMQueue):
+        self.queue = queue
+
+    async def generate_risks(self, company_description: str, project: Project, usage: Optional[TokenUsage] = None, seed_risks: Optional[list[Risk]] = None) -> list[Risk]:
+        result = await self.queue.run("generate_risks", {"companyDescription": company_description, "project": project, "seedRisks": seed_risks}, usage)
+        return [_risk(**r) for r in result]
+
+    async def generate_risk_scores(self, company_description: str, project: Project, risks: list[TrackedRisk], usage: Optional[TokenUsage] = None) -> list[TrackedScoredRisk]:
+        result = await self.queue.run("generate_risk_scores", {"companyDescription": company_description, "project": project, "risks": risks}, usage)
+        return [_tracked_scored_risk(**r) for r in result]
+
+    async def generate_risk_mitigation_plan(self, company_description: str, project: Project, risks: list[TrackedScoredRisk], usage: Optional[TokenUsage] = None) -> list[TrackedManagedRisk]:
+        result = await self.queue.run("generate_risk_mitigation_plan", {"companyDescription": company_description, "project": project, "risks": risks}, usage)
+        return [_tracked_managed_risk(**r) for r in result]
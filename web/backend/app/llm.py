@@ -1,14 +1,30 @@
 import asyncio
+import time
 import openai
 
-from models import ContingencyAndFallback, Project, Risks, TrackedManagedRisk, TrackedRisk, TrackedScoredRisk, generate_risk_score_model
-from prompts import GENERATE_RISK_MITIGATION_PLAN_OPPORTUNITY, GENERATE_RISK_MITIGATION_PLAN_THREAT, GENERATE_RISK_SCORES, GENERATE_RISKS
+from typing import Optional
+from models import ContingencyAndFallback, Project, Risk, Risks, TokenUsage, TrackedManagedRisk, TrackedRisk, TrackedScoredRisk, generate_risk_score_model, row_factory
+from prompts import GENERATE_RISK_MITIGATION_PLAN, GENERATE_RISK_SCORES, GENERATE_RISKS, RISK_MITIGATION_STRATEGIES_OPPORTUNITY, RISK_MITIGATION_STRATEGIES_THREAT
+from metrics import LLM_REQUEST_DURATION, record_llm_usage
+from tracing import start_span
+
+_tracked_scored_risk = row_factory(TrackedScoredRisk)
+_tracked_managed_risk = row_factory(TrackedManagedRisk)
+
+class LLMOutputTruncated(Exception):
+    """Raised when an answer reached its output token cap before it was complete"""
 
 class LLM:
-    def __init__(self, url: str, model: str, api_key: str = ""):
+    def __init__(self, url: str, model: str, api_key: str = "", max_completion_tokens: Optional[dict[str, int]] = None, max_field_chars: int = 2000, completion_tokens_per_risk: Optional[dict[str, int]] = None):
+        """`max_completion_tokens` caps the output of each operation (by method name), plus
+        `completion_tokens_per_risk` for every risk answered in a single call,
+        `max_field_chars` caps the length of every free-text field put in a prompt"""
         self.url = url
         self.api_key = api_key
         self.model = model
+        self.max_completion_tokens = max_completion_tokens or {}
+        self.completion_tokens_per_risk = completion_tokens_per_risk or {}
+        self.max_field_chars = max_field_chars
         self.client = openai.AsyncClient(base_url=self.url, api_key=self.api_key)
 
     async def load_model(self):
@@ -22,13 +38,58 @@ class LLM:
         )
         return
 
-    @staticmethod
-    def _get_company_string(company_description: str) -> str:
-        return f"Company Description: \"{company_description}\"\n" if company_description else ""
+    async def _parse(self, operation: str, usage: Optional[TokenUsage] = None, risks: int = 0, **kwargs):
+        """Run a structured completion, recording its latency and token usage under `operation`.
 
-    async def generate_risks(self, company_description: str, project: Project):
-        response = await self.client.chat.completions.parse(
-            model=self.model,
+        `risks` is the number of risks the answer holds, the output cap grows with it.
+        """
+        max_completion_tokens = self.max_completion_tokens.get(operation)
+        if max_completion_tokens:
+            kwargs["max_completion_tokens"] = max_completion_tokens + self.completion_tokens_per_risk.get(operation, 0) * risks
+        with start_span(f"LLM {operation}", **{"llm.operation": operation, "llm.model": self.model}) as span:
+            start = time.perf_counter()
+            try:
+                response = await self.client.chat.completions.parse(model=self.model, **kwargs)
+            except openai.LengthFinishReasonError as e:
+                # The tokens of the cut off answer are spent all the same
+                self._record_usage(operation, span, usage, e.completion.usage)
+                raise LLMOutputTruncated(f"{operation} answer cut off at {kwargs.get('max_completion_tokens')} tokens") from e
+            finally:
+                LLM_REQUEST_DURATION.labels(operation=operation).observe(time.perf_counter() - start)
+            self._record_usage(operation, span, usage, response.usage)
+            return response
+
+    def _record_usage(self, operation: str, span, usage: Optional[TokenUsage], response_usage):
+        record_llm_usage(operation, response_usage)
+        if response_usage is not None:
+            span.set_attribute("llm.prompt_tokens", response_usage.prompt_tokens)
+            span.set_attribute("llm.completion_tokens", response_usage.completion_tokens)
+            if usage is not None:
+                usage.add(operation, response_usage.prompt_tokens or 0, response_usage.completion_tokens or 0)
+
+    def _truncate(self, text: str) -> str:
+        """Cut an oversize prompt field at a word boundary so it fits in `max_field_chars`"""
+        if not text or len(text) <= self.max_field_chars:
+            return text
+        cut = text[:self.max_field_chars].rsplit(" ", 1)[0]
+        return f"{cut}..."
+
+    def _get_project_string(self, project: Project) -> str:
+        return f"Project Title: \"{project.title}\"\nProject Description: \"{self._truncate(project.description)}\"\n"
+
+    def _get_company_string(self, company_description: str) -> str:
+        return f"Company Description: \"{self._truncate(company_description)}\"\n" if company_description else ""
+
+    async def generate_risks(self, company_description: str, project: Project, usage: Optional[TokenUsage] = None, seed_risks: Optional[list[Risk]] = None):
+        seed_str = ""
+        if seed_risks:
+            seed_str = "Risks identified for similar past projects, reuse the relevant ones and add any missing risk:\n"
+            for risk in seed_risks:
+                seed_str += f"- Kind: {risk.kind}, Title: \"{risk.title}\", Description: \"{self._truncate(risk.description)}\"\n"
+
+        response = await self._parse(
+            "generate_risks",
+            usage,
             messages=[
                 {
                     "role": "system",
@@ -36,7 +97,7 @@ class LLM:
                 },
                 {
                     "role": "user",
-                    "content": f"Project Title: \"{project.title}\"\nProject Description: \"{project.description}\"\n{self._get_company_string(company_description)}"
+                    "content": f"{self._get_project_string(project)}{self._get_company_string(company_description)}{seed_str}"
                 },
             ],
             response_format=Risks
@@ -44,13 +105,15 @@ class LLM:
 
         return response.choices[0].message.parsed.root
 
-    async def generate_risk_scores(self, company_description: str, project: Project, risks: list[TrackedRisk]):
+    async def generate_risk_scores(self, company_description: str, project: Project, risks: list[TrackedRisk], usage: Optional[TokenUsage] = None):
         risk_str = ""
         for risk in risks:
-            risk_str += f"- ID: {risk.id}, Title: \"{risk.title}\", Description: \"{risk.description}\"\n"
+            risk_str += f"- ID: {risk.id}, Title: \"{risk.title}\", Description: \"{self._truncate(risk.description)}\"\n"
 
-        response = await self.client.chat.completions.parse(
-            model=self.model,
+        response = await self._parse(
+            "generate_risk_scores",
+            usage,
+            risks=len(risks),
             messages=[
                 {
                     "role": "system",
@@ -58,46 +121,59 @@ class LLM:
                 },
                 {
                     "role": "user",
-                    "content": f"Project Title: \"{project.title}\"\nProject Description: \"{project.description}\"\n{self._get_company_string(company_description)}Risks: \n{risk_str}"
+                    "content": f"{self._get_project_string(project)}{self._get_company_string(company_description)}Risks: \n{risk_str}"
                 },
             ],
             response_format=generate_risk_score_model(risks)
         )
 
-        scores = response.choices[0].message.parsed.model_dump()
+        scores = response.choices[0].message.parsed
         ret = []
         for risk in risks:
-            ts_risk = TrackedScoredRisk(
-                **risk.model_dump(),
-                **scores[f"risk_{risk.id}"]
+            # Both parts are already validated, the scores when the response was parsed
+            score = getattr(scores, f"risk_{risk.id}")
+            ts_risk = _tracked_scored_risk(
+                **risk.__dict__,
+                impact=score.impact,
+                probability=score.probability
             )
             ret.append(ts_risk)
         return ret
 
-    async def generate_risk_mitigation_plan(self, company_description: str, project: Project, risks: list[TrackedScoredRisk]):
+    def _get_mitigation_plan_messages(self, company_description: str, project: Project, risk: TrackedScoredRisk) -> list[dict]:
+        """Build a mitigation prompt as a prefix shared by every risk of the project plus a per-risk suffix"""
+        shared_prefix = f"{GENERATE_RISK_MITIGATION_PLAN}\n{self._get_project_string(project)}{self._get_company_string(company_description)}"
+        strategies = RISK_MITIGATION_STRATEGIES_OPPORTUNITY if risk.kind == "opportunity" else RISK_MITIGATION_STRATEGIES_THREAT
+        return [
+            {
+                "role": "system",
+                "content": shared_prefix
+            },
+            {
+                "role": "user",
+                "content": f"{strategies}\n{risk.kind.capitalize()} Title: \"{risk.title}\"\n{risk.kind.capitalize()} Description: \"{self._truncate(risk.description)}\"\nImpact Score: {risk.impact}\nProbability Score: {risk.probability}"
+            }
+        ]
+
+    async def generate_risk_mitigation_plan(self, company_description: str, project: Project, risks: list[TrackedScoredRisk], usage: Optional[TokenUsage] = None):
+        # Dispatch the risks grouped by kind, so consecutive prompts also share the strategies
+        dispatch_order = sorted(range(len(risks)), key=lambda i: risks[i].kind)
         responses = await asyncio.gather(*[
-            self.client.chat.completions.parse(
-                model=self.model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": GENERATE_RISK_MITIGATION_PLAN_OPPORTUNITY if risk.kind == "opportunity" else GENERATE_RISK_MITIGATION_PLAN_THREAT
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Project Title: \"{project.title}\"\nProject Description: \"{project.description}\"\n{self._get_company_string(company_description)}{risk.kind.capitalize()} Title: \"{risk.title}\"\n{risk.kind.capitalize()} Description: \"{risk.description}\"\nImpact Score: {risk.impact}\nProbability Score: {risk.probability}"
-                    }
-                ],
+            self._parse(
+                "generate_risk_mitigation_plan",
+                usage,
+                messages=self._get_mitigation_plan_messages(company_description, project, risks[i]),
                 response_format=ContingencyAndFallback
-            ) for risk in risks
+            ) for i in dispatch_order
         ])
+        plans = {i: response.choices[0].message.parsed for i, response in zip(dispatch_order, responses)}
 
         ret = []
-        for risk, response in zip(risks, responses):
-            plan = response.choices[0].message.parsed
-            tm_risk = TrackedManagedRisk(
-                **risk.model_dump(),
-                **plan.model_dump()
+        for i, risk in enumerate(risks):
+            tm_risk = _tracked_managed_risk(
+                **risk.__dict__,
+                contingency=plans[i].contingency,
+                fallback=plans[i].fallback
             )
             ret.append(tm_risk)
-        return ret
\ No newline at end of file
+        return ret
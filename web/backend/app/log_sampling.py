@@ -0,0 +1,15 @@
+import logging
+import random
+
+
+class SamplingFilter(logging.Filter):
+    """Let through only a `rate` fraction of DEBUG records, other levels are never dropped"""
+
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+        return random.random() < self.rate
@@ -0,0 +1,213 @@
+import asyncio
+import functools
+import inspect
+import os
+import time
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Set by run.py when serving with several worker processes
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+# Seconds between two event loop lag probes, the pool gauges are refreshed at the same pace
+EVENT_LOOP_LAG_INTERVAL = 0.5
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route",
+    ["method", "route", "status"]
+)
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds",
+    "Database latency by repository method",
+    ["repository", "method"]
+)
+DB_POOL_CONNECTIONS = Gauge(
+    "db_pool_connections",
+    "Database pool connections by state",
+    ["state"],
+    multiprocess_mode="livesum"
+)
+DB_POOL_WAITING = Gauge(
+    "db_pool_requests_waiting",
+    "Requests waiting for a database connection",
+    multiprocess_mode="livesum"
+)
+DB_READ_ROUTES = Counter(
+    "db_read_routes_total",
+    "Read-only repository calls by the database they were sent to",
+    ["target"]
+)
+LLM_REQUEST_DURATION = Histogram(
+    "llm_request_duration_seconds",
+    "LLM call latency by operation",
+    ["operation"],
+    buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+)
+LLM_TOKENS = Counter(
+    "llm_tokens_total",
+    "LLM tokens by operation and direction",
+    ["operation", "direction"]
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total",
+    "Cache lookups by cache and result",
+    ["cache", "result"]
+)
+RATE_LIMIT_DECISIONS = Counter(
+    "rate_limit_decisions_total",
+    "Rate limited requests by route class and result",
+    ["route_class", "result"]
+)
+PURGED_ROWS = Counter(
+    "purged_rows_total",
+    "Rows of deleted accounts and projects removed by the background purge"
+)
+CACHE_INVALIDATIONS = Counter(
+    "cache_invalidations_total",
+    "Cache evictions by source: a write of this worker, a notification from another one, or a flush after a reconnect",
+    ["source"]
+)
+LLM_JOBS = Counter(
+    "llm_jobs_total",
+    "Queued LLM calls run by this process, by outcome",
+    ["operation", "outcome"]
+)
+LLM_JOB_QUEUE_DURATION = Histogram(
+    "llm_job_queue_seconds",
+    "Time from queueing an LLM call to a worker claiming it",
+    ["operation"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+EVENT_LOOP_LAG = Gauge(
+    "event_loop_lag_seconds",
+    "Delay of the last event loop lag probe",
+    multiprocess_mode="livemax"
+)
+
+
+class MetricsMiddleware:
+    """Record the latency of every HTTP request, labelled by route template"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            HTTP_REQUEST_DURATION.labels(
+                method=scope["method"],
+                route=route.path if route is not None else "unmatched",
+                status=str(status)
+            ).observe(time.perf_counter() - start)
+
+
+def instrument_repository(cls):
+    """Class decorator timing every public coroutine method of a repository"""
+    for name, method in list(vars(cls).items()):
+        if name.startswith("_") or not inspect.iscoroutinefunction(method):
+            continue
+        setattr(cls, name, _timed(DB_QUERY_DURATION.labels(repository=cls.__name__, method=name), method))
+    return cls
+
+
+def _timed(histogram, method):
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+    return wrapper
+
+
+def record_db_route(target: str):
+    """Count a read sent to a replica, to the primary, or to the primary after a replica failed"""
+    DB_READ_ROUTES.labels(target=target).inc()
+
+
+def record_llm_usage(operation: str, usage):
+    """Count the tokens reported in the `usage` of an LLM response"""
+    if usage is None:
+        return
+    LLM_TOKENS.labels(operation=operation, direction="prompt").inc(usage.prompt_tokens or 0)
+    LLM_TOKENS.labels(operation=operation, direction="completion").inc(usage.completion_tokens or 0)
+
+
+def record_cache(cache: str, hit: bool):
+    CACHE_REQUESTS.labels(cache=cache, result="hit" if hit else "miss").inc()
+
+
+def record_rate_limit(route_class: str, result: str):
+    RATE_LIMIT_DECISIONS.labels(route_class=route_class, result=result).inc()
+
+
+def record_purge(rows: int):
+    PURGED_ROWS.inc(rows)
+
+
+def record_invalidation(source: str):
+    CACHE_INVALIDATIONS.labels(source=source).inc()
+
+
+def record_llm_job_claim(operation: str, queued_seconds: float):
+    LLM_JOB_QUEUE_DURATION.labels(operation=operation).observe(queued_seconds)
+
+
+def record_llm_job(operation: str, outcome: str):
+    """Count a queued LLM call run by this process: done, retried, dead, or lost when its lease ran out"""
+    LLM_JOBS.labels(operation=operation, outcome=outcome).inc()
+
+
+def _record_pool(pool):
+    stats = pool.get_stats()
+    DB_POOL_CONNECTIONS.labels(state="open").set(stats.get("pool_size", 0))
+    DB_POOL_CONNECTIONS.labels(state="idle").set(stats.get("pool_available", 0))
+    DB_POOL_CONNECTIONS.labels(state="max").set(pool.max_size)
+    DB_POOL_WAITING.set(stats.get("requests_waiting", 0))
+
+
+async def monitor_worker(pool):
+    """Measure how late the event loop wakes up a sleeping task and refresh the pool gauges, runs until cancelled.
+
+    Every worker runs it, so the summed pool gauges are live whichever worker serves the scrape.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        _record_pool(pool)
+        start = loop.time()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.set(max(0.0, loop.time() - start - EVENT_LOOP_LAG_INTERVAL))
+
+
+def mark_worker_dead():
+    """Drop the live gauges of this worker as it exits, recycled workers would otherwise count forever"""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """Render all metrics in the Prometheus text format"""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,138 @@
+import logging
+from psycopg_pool import AsyncConnectionPool
+
+logger = logging.getLogger(__name__)
+
+# Any key will do as long as nothing else takes this advisory lock
+MIGRATION_LOCK = 4_120_001
+
+# Recorded in the schema_version table once MIGRATION is applied, raise it along with any change of MIGRATION
+SCHEMA_VERSION = 1
+
+# web/db/init-db.sql only runs on an empty data volume, this brings an existing database to the same schema.
+# Every statement is a no-op once applied, so a database left halfway can run it again. Keep it in step with init-db.sql
+MIGRATION = """
+ALTER TABLE users ADD COLUMN IF NOT EXISTS profile_picture TEXT;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ;
+-- Replaced by the partial index, so that the username of a deleted account can be registered again
+ALTER TABLE users DROP CONSTRAINT IF EXISTS users_username_key;
+CREATE UNIQUE INDEX IF NOT EXISTS users_username_idx ON users (username) WHERE deleted_at IS NULL;
+
+ALTER TABLE projects ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ;
+ALTER TABLE projects ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+    to_tsvector('english', title || ' ' || coalesce(description, ''))
+) STORED;
+CREATE INDEX IF NOT EXISTS projects_search_vector_idx ON projects USING GIN (search_vector);
+
+ALTER TABLE risks ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+    setweight(to_tsvector('english', title), 'A') ||
+    setweight(to_tsvector('english', description), 'B') ||
+    setweight(to_tsvector('english', coalesce(contingency, '') || ' ' || coalesce(fallback, '')), 'C')
+) STORED;
+CREATE INDEX IF NOT EXISTS risks_project_id_idx ON risks (project_id);
+CREATE INDEX IF NOT EXISTS projects_user_id_idx ON projects (user_id);
+CREATE INDEX IF NOT EXISTS risks_search_vector_idx ON risks USING GIN (search_vector);
+
+CREATE TABLE IF NOT EXISTS llm_usage (
+    id SERIAL PRIMARY KEY,
+    user_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    project_id INT REFERENCES projects(id) ON DELETE CASCADE,
+    operation VARCHAR(64) NOT NULL,
+    calls INT NOT NULL,
+    prompt_tokens INT NOT NULL,
+    completion_tokens INT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS llm_usage_user_id_idx ON llm_usage (user_id);
+CREATE INDEX IF NOT EXISTS llm_usage_project_id_idx ON llm_usage (project_id);
+
+CREATE TABLE IF NOT EXISTS generations (
+    id SERIAL PRIMARY KEY,
+    project_id INT NOT NULL REFERENCES projects(id) ON DELETE CASCADE,
+    step VARCHAR(16) NOT NULL,
+    fingerprint CHAR(64) NOT NULL,
+    result JSONB NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS generations_project_step_idx ON generations (project_id, step, created_at DESC);
+CREATE INDEX IF NOT EXISTS generations_created_at_idx ON generations (created_at);
+
+CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_buckets (
+    key TEXT PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS purges (
+    id SERIAL PRIMARY KEY,
+    user_id INT NOT NULL,
+    project_id INT,
+    requested_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    purged_rows BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ
+);
+CREATE INDEX IF NOT EXISTS purges_pending_idx ON purges (id) WHERE finished_at IS NULL;
+
+DO $$
+BEGIN
+    CREATE TYPE llm_job_status AS ENUM ('queued', 'running', 'done', 'dead');
+EXCEPTION WHEN duplicate_object THEN
+    NULL;
+END
+$$;
+
+CREATE TABLE IF NOT EXISTS llm_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    operation VARCHAR(64) NOT NULL,
+    payload JSONB NOT NULL,
+    priority INT NOT NULL DEFAULT 0,
+    status llm_job_status NOT NULL DEFAULT 'queued',
+    attempts INT NOT NULL DEFAULT 0,
+    run_after TIMESTAMPTZ NOT NULL DEFAULT now(),
+    worker TEXT,
+    leased_until TIMESTAMPTZ,
+    result JSONB,
+    usage JSONB,
+    error TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    finished_at TIMESTAMPTZ
+);
+CREATE INDEX IF NOT EXISTS llm_jobs_queued_idx ON llm_jobs (priority DESC, id) WHERE status = 'queued';
+CREATE INDEX IF NOT EXISTS llm_jobs_leased_idx ON llm_jobs (leased_until) WHERE status = 'running';
+CREATE INDEX IF NOT EXISTS llm_jobs_finished_idx ON llm_jobs (finished_at) WHERE finished_at IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INT PRIMARY KEY,
+    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+"""
+
+
+async def _schema_version(conn) -> int:
+    # Databases from before the versioning have no schema_version table at all
+    cursor = await conn.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+    if not (await cursor.fetchone())[0]:
+        return 0
+    cursor = await conn.execute("SELECT coalesce(max(version), 0) FROM schema_version")
+    return (await cursor.fetchone())[0]
+
+
+async def migrate(pool: AsyncConnectionPool):
+    """Bring the schema of the database up to date, in one transaction.
+
+    Every worker of every instance runs it as it starts. An up to date database is
+    only read, the ALTER TABLE statements would lock the hot tables even with
+    nothing to change. Otherwise the lock makes the workers go one at a time and
+    all but the first find the new version recorded.
+    """
+    async with pool.connection() as conn:
+        if await _schema_version(conn) >= SCHEMA_VERSION:
+            return
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK,))
+            if await _schema_version(conn) >= SCHEMA_VERSION:
+                return
+            await conn.execute(MIGRATION, prepare=False)
+            await conn.execute("INSERT INTO schema_version (version) VALUES (%s) ON CONFLICT DO NOTHING", (SCHEMA_VERSION,))
+    logger.info(f"Database schema migrated to version {SCHEMA_VERSION}.")
@@ -1,15 +1,19 @@
-from models import Project, Risk, Risks, TrackedManagedRisk, TrackedRisk, TrackedScoredRisk, generate_risk_score_model
+from typing import Optional
+from models import Project, Risk, Risks, TokenUsage, TrackedManagedRisk, TrackedRisk, TrackedScoredRisk, generate_risk_score_model
 from prompts import GENERATE_RISK_SCORES, GENERATE_RISKS
 import random
 
+class LLMOutputTruncated(Exception):
+    pass
+
 class LLM:
-    def __init__(self, url: str, model: str, api_key: str = ""):
+    def __init__(self, url: str, model: str, api_key: str = "", max_completion_tokens: Optional[dict[str, int]] = None, max_field_chars: int = 2000, completion_tokens_per_risk: Optional[dict[str, int]] = None):
         pass
 
     async def load_model(self):
         pass
 
-    async def generate_risks(self, company_description: str, project: Project):
+    async def generate_risks(self, company_description: str, project: Project, usage: Optional[TokenUsage] = None, seed_risks: Optional[list[Risk]] = None):
         return [
             Risk(
                 title="Technological Advancement",
@@ -38,7 +42,7 @@ class LLM:
             )
         ]
 
-    async def generate_risk_scores(self, company_description: str, project: Project, risks: list[TrackedRisk]):
+    async def generate_risk_scores(self, company_description: str, project: Project, risks: list[TrackedRisk], usage: Optional[TokenUsage] = None):
         return [
             TrackedScoredRisk(
                 id=risk.id,
@@ -50,7 +54,7 @@ class LLM:
             ) for risk in risks
         ]
     
-    async def generate_risk_mitigation_plan(self, company_description: str, project: Project, risks: list[TrackedScoredRisk]):
+    async def generate_risk_mitigation_plan(self, company_description: str, project: Project, risks: list[TrackedScoredRisk], usage: Optional[TokenUsage] = None):
         risks_with_plans: list[TrackedManagedRisk] = []
         for risk in risks:
             risks_with_plans.append(
@@ -0,0 +1,184 @@
+"""OpenAI-compatible mock model server with simulated prefix caching.
+
+Serves /v1/chat/completions (plain and streaming) and answers structured-output
+requests with a made-up instance of the requested JSON schema. Timing follows
+an Ollama-like server: a fixed number of parallel slots, each keeping the KV
+cache of the last prompt it processed. A request goes to the free slot sharing
+the longest prefix with it, and only the tokens after that prefix pay the
+prefill cost. Words stand in for tokens.
+
+Usage: python mockups/llm_server.py [--port 11434] [--parallel 4]
+"""
+import argparse
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def tokenize(messages: list[dict]) -> list[str]:
+    text = "".join(f"<{m['role']}>{m.get('content') or ''}" for m in messages)
+    return TOKEN_PATTERN.findall(text)
+
+
+def common_prefix(a: list[str], b: list[str]) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class Slots:
+    """Parallel inference slots, each caching the tokens of its last prompt"""
+
+    def __init__(self, count: int):
+        self.cached: list[list[str]] = [[] for _ in range(count)]
+        self.free = set(range(count))
+        self.condition = threading.Condition()
+
+    def acquire(self, tokens: list[str]) -> tuple[int, int]:
+        """Wait for a free slot, returns the slot and the number of cached prompt tokens"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.free)
+            slot = max(self.free, key=lambda s: common_prefix(self.cached[s], tokens))
+            self.free.remove(slot)
+            return slot, common_prefix(self.cached[slot], tokens)
+
+    def release(self, slot: int, tokens: list[str]):
+        with self.condition:
+            self.cached[slot] = tokens
+            self.free.add(slot)
+            self.condition.notify()
+
+
+def fake_instance(schema: dict, defs: dict):
+    """Build a value matching a (pydantic generated) JSON schema"""
+    if "$ref" in schema:
+        return fake_instance(defs[schema["$ref"].split("/")[-1]], defs)
+    if "anyOf" in schema:
+        return fake_instance(next(s for s in schema["anyOf"] if s.get("type") != "null"), defs)
+    if "enum" in schema:
+        return schema["enum"][0]
+    kind = schema.get("type")
+    if kind == "object":
+        return {name: fake_instance(prop, defs) for name, prop in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [fake_instance(schema.get("items", {}), defs) for _ in range(3)]
+    if kind == "integer":
+        return max(schema.get("minimum", 1), min(schema.get("maximum", 10), 5))
+    if kind == "number":
+        return 0.5
+    if kind == "boolean":
+        return True
+    return "Allocate additional resources and adjust timelines, if necessary."
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    slots: Slots
+    prefill_ms: float
+    decode_ms: float
+
+    def do_POST(self):
+        if not self.path.endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        tokens = tokenize(body["messages"])
+
+        response_format = body.get("response_format") or {}
+        schema = response_format.get("json_schema", {}).get("schema")
+        content = json.dumps(fake_instance(schema, schema.get("$defs", {}))) if schema else "Model loaded."
+        completion_tokens = len(TOKEN_PATTERN.findall(content))
+
+        slot, cached = self.slots.acquire(tokens)
+        try:
+            time.sleep((len(tokens) - cached) * self.prefill_ms / 1000)
+            if body.get("stream"):
+                self._stream(body, content, len(tokens), cached, completion_tokens)
+            else:
+                time.sleep(completion_tokens * self.decode_ms / 1000)
+                self._send_json(self._completion(body, content, len(tokens), cached, completion_tokens))
+        finally:
+            self.slots.release(slot, tokens)
+
+    @staticmethod
+    def _usage(prompt_tokens: int, cached: int, completion_tokens: int) -> dict:
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached},
+        }
+
+    def _completion(self, body: dict, content: str, prompt_tokens: int, cached: int, completion_tokens: int) -> dict:
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": self._usage(prompt_tokens, cached, completion_tokens),
+        }
+
+    def _send_json(self, payload: dict):
+        data = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, body: dict, content: str, prompt_tokens: int, cached: int, completion_tokens: int):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+        pieces = re.findall(r"\S+\s*", content) or [content]
+        for i, piece in enumerate(pieces):
+            last = i == len(pieces) - 1
+            chunk = {
+                "id": chunk_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model", "mock"),
+                "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": "stop" if last else None}],
+            }
+            if last:
+                chunk["usage"] = self._usage(prompt_tokens, cached, completion_tokens)
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+            time.sleep(len(TOKEN_PATTERN.findall(piece)) * self.decode_ms / 1000)
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int, parallel: int, prefill_ms: float, decode_ms: float) -> ThreadingHTTPServer:
+    handler = type("Handler", (MockLLMHandler,), {"slots": Slots(parallel), "prefill_ms": prefill_ms, "decode_ms": decode_ms})
+    server = ThreadingHTTPServer(("0.0.0.0", port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--parallel", type=int, default=4, help="Parallel slots, like OLLAMA_NUM_PARALLEL")
+    parser.add_argument("--prefill-ms", type=float, default=0.5, help="Prefill time per uncached prompt token")
+    parser.add_argument("--decode-ms", type=float, default=5, help="Generation time per output token")
+    args = parser.parse_args()
+    print(f"Mock LLM server on port {args.port} with {args.parallel} slots")
+    serve(args.port, args.parallel, args.prefill_ms, args.decode_ms).serve_forever()
@@ -0,0 +1,55 @@
+"""Local stand-in for an OpenTelemetry collector.
+
+Accepts OTLP/HTTP JSON exports on /v1/traces and prints every received span as
+an indented tree, so the backend can be run with TRACING_EXPORTERS=otlp without
+a real collector.
+
+Usage: python mockups/otlp_collector.py [--port 4318]
+"""
+import argparse
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def print_spans(spans: list[dict]):
+    by_id = {span["spanId"]: span for span in spans}
+    for span in sorted(spans, key=lambda s: int(s["startTimeUnixNano"])):
+        depth = 0
+        parent = span.get("parentSpanId")
+        while parent in by_id:
+            parent = by_id[parent].get("parentSpanId")
+            depth += 1
+        duration_ms = (int(span["endTimeUnixNano"]) - int(span["startTimeUnixNano"])) / 1e6
+        attributes = {a["key"]: next(iter(a["value"].values())) for a in span.get("attributes", [])}
+        print(f"{span['traceId'][:8]} {'  ' * depth}{span['name']} {duration_ms:.1f}ms {attributes}")
+
+
+class CollectorHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != "/v1/traces":
+            self.send_response(404)
+            self.end_headers()
+            return
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        spans = [
+            span
+            for resource_spans in payload.get("resourceSpans", [])
+            for scope_spans in resource_spans.get("scopeSpans", [])
+            for span in scope_spans.get("spans", [])
+        ]
+        print_spans(spans)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=4318)
+    args = parser.parse_args()
+    print(f"Collecting OTLP traces on port {args.port}")
+    ThreadingHTTPServer(("0.0.0.0", args.port), CollectorHandler).serve_forever()
@@ -1,5 +1,6 @@
-from pydantic import BaseModel, Field, RootModel, create_model
-from typing import Optional, Literal
+from datetime import datetime
+from pydantic import BaseModel, Field, RootModel, create_model, model_validator
+from typing import Any, Callable, Optional, Literal, TypeVar
 
 class UserResponse(BaseModel):
     id: int
@@ -48,12 +49,30 @@ class Risk(BaseModel):
         description="Detailed description of what the risk entails and the context that causes it"
     )
 
+class SimilarRisk(Risk):
+    sourceProjectId: int
+    similarity: float
+
 class Risks(RootModel):
     root: list[Risk]
 
 class TrackedRisk(Risk):
     id: int
 
+class SavedRisk(Risk):
+    # Risks already saved keep their id, so saving the register only writes the risks that changed
+    id: Optional[int] = None
+
+class RiskUpdate(BaseModel):
+    # Only the fields set in the request are changed
+    kind: Optional[Literal['threat', 'opportunity']] = None
+    title: Optional[str] = None
+    description: Optional[str] = None
+    impact: Optional[int] = Field(default=None, ge=1, le=10)
+    probability: Optional[int] = Field(default=None, ge=1, le=10)
+    contingency: Optional[str] = None
+    fallback: Optional[str] = None
+
 class ImpactAndProbability(BaseModel):
     impact: int = Field(
         description="Numerical risk score proportional to the monetary impact of the risk",
@@ -86,6 +105,54 @@ class ContingencyAndFallback(BaseModel):
 class TrackedManagedRisk(TrackedScoredRisk, ContingencyAndFallback):
     ...
 
+class MonetaryRange(BaseModel):
+    # Money lost by a threat or gained by an opportunity when it occurs, used instead of its impact score
+    riskId: int
+    low: float = Field(ge=0)
+    high: float = Field(ge=0)
+    # The middle of the range when not given
+    mostLikely: Optional[float] = Field(default=None, ge=0)
+
+    @model_validator(mode="after")
+    def check_order(self):
+        if self.low > self.high or (self.mostLikely is not None and not self.low <= self.mostLikely <= self.high):
+            raise ValueError("expected low <= mostLikely <= high")
+        return self
+
+class QuantitativeAnalysisRequest(BaseModel):
+    iterations: int = Field(default=100_000, ge=1_000, le=1_000_000)
+    # Money per impact score point of the risks without a range, 1 gives the results in score points
+    impactUnit: float = Field(default=1.0, gt=0)
+    ranges: list[MonetaryRange] = []
+
+class RiskSensitivity(BaseModel):
+    id: int
+    kind: Literal['threat', 'opportunity']
+    title: str
+    # Expected value of the risk, negative for threats
+    emv: float
+    # Project EMV with this risk at its 10th and 90th percentile and the others at their expected value
+    low: float
+    high: float
+    # Correlation of the risk with the simulated project outcome
+    correlation: float
+
+class QuantitativeAnalysis(BaseModel):
+    iterations: int
+    # The outcome is what the opportunities gain minus what the threats lose
+    emv: float
+    p10: float
+    p50: float
+    p90: float
+    lossProbability: float
+    # Losses of the threats alone
+    exposureP50: float
+    exposureP90: float
+    # Largest swing first
+    tornado: list[RiskSensitivity]
+    # Risks not scored yet, left out of the simulation
+    unscoredRisks: int
+
 class RiskInDB(BaseModel):
     id: int
     projectId: int
@@ -97,6 +164,98 @@ class RiskInDB(BaseModel):
     contingency: Optional[str]
     fallback: Optional[str]
 
+class ProjectContext(BaseModel):
+    project: ProjectInDB
+    companyDescription: str
+    risks: list[RiskInDB]
+
+class RiskSearchResult(BaseModel):
+    id: int
+    projectId: int
+    projectTitle: str
+    kind: Literal['threat', 'opportunity']
+    # HTML escaped, with the matched words wrapped in <b></b>
+    title: str
+    excerpt: str
+    rank: float
+
+class RiskSearchPage(BaseModel):
+    results: list[RiskSearchResult]
+    # Pass as `cursor` to get the next page, None on the last page
+    nextCursor: Optional[str]
+
+class GenerationDraft(BaseModel):
+    step: str
+    createdAt: datetime
+    # Same shape as the response of the step's gen endpoint
+    result: list[dict[str, Any]]
+
+class Purge(BaseModel):
+    id: int
+    userId: int
+    # None when the whole account is purged
+    projectId: Optional[int]
+    requestedAt: datetime
+    purgedRows: int
+
+class LLMUsage(BaseModel):
+    operation: str
+    calls: int = 0
+    promptTokens: int = 0
+    completionTokens: int = 0
+
+class GeneratedProject(BaseModel):
+    # Whole workflow of a project generated offline, the risk ids only tie the LLM answers together
+    projectId: int
+    risks: list[TrackedManagedRisk]
+    usage: list[LLMUsage]
+
+class TokenUsage:
+    """Collects the token usage of the LLM calls made for a single request, by operation"""
+
+    def __init__(self):
+        self.operations: dict[str, LLMUsage] = {}
+
+    def add(self, operation: str, prompt_tokens: int, completion_tokens: int):
+        usage = self.operations.setdefault(operation, LLMUsage(operation=operation))
+        usage.calls += 1
+        usage.promptTokens += prompt_tokens
+        usage.completionTokens += completion_tokens
+
+    def extend(self, records: list[LLMUsage]):
+        """Add usage collected elsewhere, such as by the worker that ran a queued LLM call"""
+        for record in records:
+            usage = self.operations.setdefault(record.operation, LLMUsage(operation=record.operation))
+            usage.calls += record.calls
+            usage.promptTokens += record.promptTokens
+            usage.completionTokens += record.completionTokens
+
+    def records(self) -> list[LLMUsage]:
+        return list(self.operations.values())
+
+M = TypeVar("M", bound=BaseModel)
+
+def row_factory(model: type[M]) -> Callable[..., M]:
+    """Build instances of `model` from trusted values, such as database rows, without validating them.
+
+    Every field must be passed as a keyword argument, already of its declared type:
+    nothing is checked, converted or defaulted. `model_construct` skips validation
+    too, but resolves defaults and aliases in Python, which is slower than validating.
+    """
+    fields_set = set(model.model_fields)
+    new = model.__new__
+    set_attribute = object.__setattr__
+
+    def build(**values: Any) -> M:
+        instance = new(model)
+        set_attribute(instance, "__dict__", values)
+        # Every field is set, so the instances can share the set
+        set_attribute(instance, "__pydantic_fields_set__", fields_set)
+        set_attribute(instance, "__pydantic_extra__", None)
+        set_attribute(instance, "__pydantic_private__", None)
+        return instance
+    return build
+
 def generate_risk_score_model(risks: list[TrackedRisk]):    
     fields = {
         f"risk_{risk.id}": (ImpactAndProbability, 
@@ -0,0 +1,266 @@
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import time
+from typing import Optional
+from psycopg_pool import AsyncConnectionPool
+from pydantic import ValidationError
+
+from app import DB_CONNECTION_KWARGS, create_llm, primary_conninfo
+from database import ProjectRepository, UserRepository
+from generation import planning_inputs
+from jobs import LLM_QUEUE, PRIORITY_BULK, LLMQueue, QueuedLLM, job_priority
+from models import GeneratedProject, Project, ProjectInDB, TokenUsage, TrackedManagedRisk, TrackedRisk, row_factory
+
+from llm import LLM # type: ignore
+
+logger = logging.getLogger(__name__)
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Projects generated at once, each one runs its three LLM calls one after the other
+ONBOARD_CONCURRENCY = int(os.getenv("ONBOARD_CONCURRENCY", "8"))
+# Generated projects saved together in a single statement
+ONBOARD_BATCH_SIZE = int(os.getenv("ONBOARD_BATCH_SIZE", "20"))
+
+# The risks are built from LLM answers, which were validated as they were parsed
+_tracked_risk = row_factory(TrackedRisk)
+_tracked_managed_risk = row_factory(TrackedManagedRisk)
+_generated_project = row_factory(GeneratedProject)
+
+
+def read_import_file(path: str) -> list[Project]:
+    """Projects of a JSON list of objects, or of a CSV file, with title and description fields"""
+    with open(path, newline="") as f:
+        entries = list(csv.DictReader(f)) if path.endswith(".csv") else json.load(f)
+    projects = []
+    for position, entry in enumerate(entries, 1):
+        try:
+            projects.append(Project.model_validate(entry))
+        except ValidationError as e:
+            raise SystemExit(f"{path}, entry {position}: {e}")
+    return projects
+
+
+async def generate_project(llm: LLM, company_description: str, project: ProjectInDB, usage: TokenUsage) -> list[TrackedManagedRisk]:
+    """Discovery, scoring and planning of a project, as the web app does them step by step"""
+    risks = await llm.generate_risks(company_description, project, usage=usage)
+    # The ids only tie the answers of the next steps to the risks, the database gives the real ones
+    tracked_risks = [_tracked_risk(id=i, kind=r.kind, title=r.title, description=r.description) for i, r in enumerate(risks, 1)]
+    scored_risks = await llm.generate_risk_scores(company_description, project, tracked_risks, usage=usage)
+    significant_risks, insignificant_risks = planning_inputs(scored_risks, project.riskScoreThreshold)
+    managed_risks = await llm.generate_risk_mitigation_plan(company_description, project, significant_risks, usage=usage) if significant_risks else []
+    managed_risks += [_tracked_managed_risk(**r.__dict__, contingency=None, fallback=None) for r in insignificant_risks]
+    return sorted(managed_risks, key=lambda r: r.id)
+
+
+class Checkpoint:
+    """Progress of an onboarding, appended to a file as JSON lines so that running it again resumes it.
+
+    The first line tells which user and import file it belongs to. Then come the
+    projects created from the import file entries, so they are not created twice,
+    and the outcome of each project. Failed projects are tried again on resume.
+    """
+
+    def __init__(self, path: str, username: str, import_file: Optional[str]):
+        self.imported: dict[int, int] = {}
+        self.done: set[int] = set()
+        header = {"user": username, "import": import_file}
+        records = []
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # The last line of a run that was killed while writing it
+                        pass
+        if records and records[0] != header:
+            raise SystemExit(f"{path} is the checkpoint of another onboarding ({records[0]}), remove it or pass another --checkpoint")
+        for record in records[1:]:
+            if "entry" in record:
+                self.imported[record["entry"]] = record["projectId"]
+            elif record["status"] == "done":
+                self.done.add(record["projectId"])
+        self.file = open(path, "a")
+        if not records:
+            self._write(header)
+
+    def created(self, entry: int, projectId: int):
+        self.imported[entry] = projectId
+        self._write({"entry": entry, "projectId": projectId})
+
+    def finished(self, projectId: int, status: str, error: Optional[str] = None):
+        if status == "done":
+            self.done.add(projectId)
+        self._write({"projectId": projectId, "status": status, "error": error})
+
+    def close(self):
+        self.file.close()
+
+    def _write(self, record: dict):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+
+class Onboarding:
+    """Runs the workflow of many projects with a bounded number of workers and saves them in batches"""
+
+    def __init__(self, llm: LLM, project_db: ProjectRepository, userId: int, company_description: str, checkpoint: Checkpoint, batch_size: int):
+        self.llm = llm
+        self.project_db = project_db
+        self.userId = userId
+        self.company_description = company_description
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.pending: list[GeneratedProject] = []
+        self.save_lock = asyncio.Lock()
+        self.usage = TokenUsage()
+        self.saved = 0
+        self.skipped = 0
+        self.failures: dict[int, str] = {}
+
+    async def run(self, projects: list[ProjectInDB], concurrency: int):
+        queue: asyncio.Queue[ProjectInDB] = asyncio.Queue()
+        for project in projects:
+            queue.put_nowait(project)
+        workers = [asyncio.create_task(self._work(queue)) for _ in range(min(concurrency, len(projects)))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            # Also when interrupted, the projects already generated are paid for
+            await self._save()
+
+    async def _work(self, queue: asyncio.Queue[ProjectInDB]):
+        while not queue.empty():
+            project = queue.get_nowait()
+            usage = TokenUsage()
+            try:
+                risks = await generate_project(self.llm, self.company_description, project, usage)
+            except Exception as e:
+                logger.warning(f"Generating project {project.id} failed: {e!r}")
+                self.failures[project.id] = repr(e)
+                self.checkpoint.finished(project.id, "failed", repr(e))
+                continue
+            finally:
+                self.usage.extend(usage.records())
+            self.pending.append(_generated_project(projectId=project.id, risks=risks, usage=usage.records()))
+            if len(self.pending) >= self.batch_size:
+                await self._save()
+
+    async def _save(self):
+        async with self.save_lock:
+            batch, self.pending = self.pending, []
+            if not batch:
+                return
+            try:
+                saved = set(await self.project_db.save_generated_projects(self.userId, batch))
+            except BaseException:
+                # Saved with the next batch, or by the final save once the workers stopped
+                self.pending = batch + self.pending
+                raise
+            for project in batch:
+                if project.projectId in saved:
+                    self.checkpoint.finished(project.projectId, "done")
+                else:
+                    logger.warning(f"Project {project.projectId} was started in the web app or deleted meanwhile, its results are dropped")
+                    self.checkpoint.finished(project.projectId, "skipped")
+            self.saved += len(saved)
+            self.skipped += len(batch) - len(saved)
+            logger.info(f"Saved {len(saved)} projects, {self.saved} so far")
+
+
+def print_report(onboarding: Onboarding, elapsed: float, resumed: int, not_started: int):
+    hours = elapsed / 3600
+    print(f"Projects: {onboarding.saved} saved, {len(onboarding.failures)} failed, {onboarding.skipped + not_started} skipped as started in the web app, deleted or not found, {resumed} saved by a previous run")
+    print(f"Time: {elapsed:.0f}s, {onboarding.saved / hours if hours else 0:.0f} projects/hour")
+    usage = onboarding.usage.records()
+    print(
+        f"LLM: {sum(u.calls for u in usage)} calls, {sum(u.promptTokens for u in usage)} prompt tokens, "
+        f"{sum(u.completionTokens for u in usage)} completion tokens"
+    )
+    for u in usage:
+        print(f"  {u.operation}: {u.calls} calls, {u.promptTokens} prompt tokens, {u.completionTokens} completion tokens")
+    if onboarding.failures:
+        print("Failed, tried again when resuming:")
+        for projectId, error in onboarding.failures.items():
+            print(f"  project {projectId}: {error}")
+
+
+async def main():
+    """Run discovery, scoring and planning over many projects of a user, to onboard an existing portfolio"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("project_ids", nargs="*", type=int, help="Projects of the user to onboard")
+    parser.add_argument("--user", required=True, help="Username owning the projects")
+    parser.add_argument("--import", dest="import_file", help="JSON list or CSV file of projects with title and description to create first")
+    parser.add_argument("--checkpoint", default="onboard.checkpoint", help="Progress file, an interrupted onboarding is resumed by running it again with the same file")
+    parser.add_argument("--concurrency", type=int, default=ONBOARD_CONCURRENCY, help="Projects generated at once")
+    parser.add_argument("--batch-size", type=int, default=ONBOARD_BATCH_SIZE, help="Generated projects saved together")
+    args = parser.parse_args()
+    if not args.project_ids and not args.import_file:
+        parser.error("give project ids or an --import file")
+
+    # The LLM calls hold no connection, a few are enough for the saves
+    async with AsyncConnectionPool(primary_conninfo(), min_size=1, max_size=4, kwargs=DB_CONNECTION_KWARGS, open=False) as pool:
+        user = await UserRepository(pool).get_user_by_username(args.user)
+        if user is None:
+            raise SystemExit(f"No user {args.user}")
+        project_db = ProjectRepository(pool)
+        checkpoint = Checkpoint(args.checkpoint, args.user, args.import_file)
+
+        project_ids = list(args.project_ids)
+        if args.import_file:
+            entries = read_import_file(args.import_file)
+            missing = [entry for entry in range(len(entries)) if entry not in checkpoint.imported]
+            if missing:
+                created = await project_db.create_projects([entries[entry] for entry in missing], user.id)
+                for entry, project in zip(missing, created):
+                    checkpoint.created(entry, project.id)
+                logger.info(f"Created {len(created)} projects from {args.import_file}")
+            project_ids += [checkpoint.imported[entry] for entry in range(len(entries))]
+
+        projects = {project.id: project for project in await project_db.get_projects_by_user_id(user.id)}
+        todo = []
+        resumed = not_started = 0
+        for projectId in dict.fromkeys(project_ids):
+            if projectId in checkpoint.done:
+                resumed += 1
+            elif projectId not in projects or projects[projectId].currentStep > 0:
+                # Only projects nobody started are onboarded, the others are left as they are
+                not_started += 1
+            else:
+                todo.append(projects[projectId])
+        logger.info(f"Onboarding {len(todo)} projects of {args.user}, {args.concurrency} at once")
+
+        llm = create_llm()
+        listener = None
+        if LLM_QUEUE:
+            # Run by the backend instances and worker processes, after the calls of the web app users
+            queue = LLMQueue(pool, primary_conninfo())
+            listener = asyncio.create_task(queue.serve(None, 0))
+            llm = QueuedLLM(queue)
+
+        onboarding = Onboarding(llm, project_db, user.id, user.companyDescription, checkpoint, args.batch_size)
+        start = time.perf_counter()
+        try:
+            with job_priority(PRIORITY_BULK):
+                await onboarding.run(todo, args.concurrency)
+        finally:
+            if listener is not None:
+                listener.cancel()
+                await asyncio.gather(listener, return_exceptions=True)
+            checkpoint.close()
+            print_report(onboarding, time.perf_counter() - start, resumed, not_started)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=LOG_LEVEL, format="%(levelname)-8s %(name)s: %(message)s")
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
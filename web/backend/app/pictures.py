@@ -0,0 +1,46 @@
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import BinaryIO
+from fastapi.concurrency import run_in_threadpool
+from PIL import Image, UnidentifiedImageError
+
+# Profile pictures are stored as bounded-size WebP thumbnails, named after their content hash
+PICTURE_MAX_SIZE = int(os.getenv("PICTURE_MAX_SIZE", "256"))
+PICTURE_QUALITY = 85
+
+SUPPORTED_CONTENT_TYPES = {'image/jpeg', 'image/jpg', 'image/png', 'image/webp', 'image/gif'}
+
+
+class InvalidPictureError(Exception):
+    pass
+
+
+def _make_thumbnail(source: BinaryIO, directory: Path, user_id: int) -> str:
+    """Decode the uploaded image, shrink it and store it, returns the stored file name"""
+    try:
+        with Image.open(source) as image:
+            image.thumbnail((PICTURE_MAX_SIZE, PICTURE_MAX_SIZE))
+            thumbnail = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise InvalidPictureError(str(e)) from e
+
+    directory.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=directory, suffix=".tmp", delete=False) as tmp:
+        thumbnail.save(tmp, format="WEBP", quality=PICTURE_QUALITY)
+    tmp_path = Path(tmp.name)
+    digest = hashlib.sha256(tmp_path.read_bytes()).hexdigest()[:16]
+    file_name = f"user_{user_id}_{digest}.webp"
+    os.replace(tmp_path, directory / file_name)
+    return file_name
+
+
+async def store_picture(source: BinaryIO, directory: Path, user_id: int) -> str:
+    """Create the thumbnail of an uploaded picture in a worker thread, returns the stored file name"""
+    return await run_in_threadpool(_make_thumbnail, source, directory, user_id)
+
+
+async def remove_picture(directory: Path, file_name: str):
+    """Delete a stored picture in a worker thread"""
+    await run_in_threadpool((directory / file_name).unlink, missing_ok=True)
@@ -21,19 +21,16 @@ occurring.
 Respond in JSON format with each risk's impact and probability scores.
 """
 
-GENERATE_RISK_MITIGATION_PLAN_OPPORTUNITY = """\
-Given the title and description of a project, along with a specific opportunity including its title,
-description, impact score (1 means negligible, 10 means very profitable), and probability score
-(1 means very unlikely, 10 means very likely), generate a contingency plan and/or a fallback plan
-to manage the opportunity.
-The contingency plan should outline the steps to be taken before the opportunity occurs.
-The fallback plan should outline the steps to be taken if the opportunity materializes.
-The contingency or fallback plans should follow one of these 5 strategies:
-1. Exploit: Take actions to ensure the opportunity is realized.
-2. Escalate: If the opportunity is beyond the project scope/control, escalate it to higher management.
-3. Share: Collaborate with a third party to increase the chance of the opportunity occurring.
-4. Enhance: Increase the probability and/or impact of the opportunity.
-5. Accept: Acknowledge the opportunity but take no proactive action (leave the plan empty).
+# The mitigation prompts are split into a part shared by every risk of a project
+# (GENERATE_RISK_MITIGATION_PLAN followed by the project context) and a per-risk
+# suffix, so model servers can reuse the cached prefix across the parallel calls.
+GENERATE_RISK_MITIGATION_PLAN = """\
+Given the title and description of a project, along with a specific risk including its kind
+(threat or opportunity), title, description, impact score, and probability score (1 means very
+unlikely, 10 means very likely), generate a contingency plan and/or a fallback plan to manage the risk.
+The contingency plan should outline the steps to be taken before the risk occurs.
+The fallback plan should outline the steps to be taken if the risk materializes.
+The contingency or fallback plans should follow one of the 5 strategies listed with the risk.
 
 If you don't use "Accept", make sure to provide at least one of the plans.
 A plan should be explained with one or more plain text conversational sentences.
@@ -42,23 +39,22 @@ Do not mention directly what strategy you are using.
 Respond in JSON format with the contingency and/or fallback plan.
 """
 
-GENERATE_RISK_MITIGATION_PLAN_THREAT = """\
-Given the title and description of a project, along with a specific threat including its title,
-description, impact score (1 means negligible, 10 means catastrophic), and probability score
-(1 means very unlikely, 10 means very likely), generate a contingency plan and/or a fallback plan
-to manage the threat.
-The contingency plan should outline the steps to be taken before the threat occurs.
-The fallback plan should outline the steps to be taken if the threat materializes.
-The contingency or fallback plans should follow one of these 5 strategies:
+RISK_MITIGATION_STRATEGIES_OPPORTUNITY = """\
+The risk is an opportunity, its impact score goes from 1 (negligible) to 10 (very profitable).
+The plans should follow one of these 5 strategies:
+1. Exploit: Take actions to ensure the opportunity is realized.
+2. Escalate: If the opportunity is beyond the project scope/control, escalate it to higher management.
+3. Share: Collaborate with a third party to increase the chance of the opportunity occurring.
+4. Enhance: Increase the probability and/or impact of the opportunity.
+5. Accept: Acknowledge the opportunity but take no proactive action (leave the plan empty).
+"""
+
+RISK_MITIGATION_STRATEGIES_THREAT = """\
+The risk is a threat, its impact score goes from 1 (negligible) to 10 (catastrophic).
+The plans should follow one of these 5 strategies:
 1. Avoid: Change the project plan to eliminate the threat or protect the project objectives from its impact.
 2. Escalate: If the threat is beyond the project scope/control, escalate it to higher management.
 3. Transfer: Shift the impact of the threat to a third party (e.g., through insurance or outsourcing).
 4. Mitigate: Reduce the probability and/or impact of the threat.
 5. Accept: Acknowledge the threat but take no proactive action (leave the plan empty).
-
-If you don't use "Accept", make sure to provide at least one of the plans.
-A plan should be explained with one or more plain text conversational sentences.
-Avoid titles, markdown formatting, html, or bullet points.
-Do not mention directly what strategy you are using.
-Respond in JSON format with the contingency and/or fallback plan.
 """
@@ -0,0 +1,44 @@
+import asyncio
+import logging
+import os
+import time
+import psycopg
+from database import ProjectRepository
+from metrics import record_purge
+
+logger = logging.getLogger(__name__)
+
+# Rows deleted per transaction, small batches keep the locks short and the WAL spread out
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", "1000"))
+# Pause between two batches, leaves room to the requests
+PURGE_BATCH_PAUSE = float(os.getenv("PURGE_BATCH_PAUSE", "0.05"))
+# Seconds between two checks for new deletions when there is nothing to purge
+PURGE_INTERVAL = float(os.getenv("PURGE_INTERVAL", "10"))
+
+
+async def purge_deleted(project_db: ProjectRepository, conninfo: str):
+    """Purge the rows of the deleted accounts and projects in small batches, runs until cancelled.
+
+    The claims are held on a connection of its own, opened again when it is lost.
+    """
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(conninfo, autocommit=True) as claims:
+                while True:
+                    # Every worker of every instance runs this loop, each deletion is purged by the one that claims it
+                    async with project_db.claim_pending_purge(claims) as purge:
+                        if purge is not None:
+                            what = f"account {purge.userId}" if purge.projectId is None else f"project {purge.projectId}"
+                            start = time.monotonic()
+                            purged = purge.purgedRows
+                            while deleted := await project_db.purge_batch(purge, PURGE_BATCH_SIZE):
+                                purged += deleted
+                                record_purge(deleted)
+                                logger.debug(f"Purging {what}: {purged} rows deleted")
+                                await asyncio.sleep(PURGE_BATCH_PAUSE)
+                            logger.info(f"Purged {what}: {purged} rows in {time.monotonic() - start:.1f}s")
+                    if purge is None:
+                        await asyncio.sleep(PURGE_INTERVAL)
+        except Exception as e:
+            logger.warning(f"Purge failed: {e!r}")
+            await asyncio.sleep(PURGE_INTERVAL)
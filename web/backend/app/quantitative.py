@@ -0,0 +1,182 @@
+import asyncio
+import os
+from collections import OrderedDict
+from typing import Optional
+import numpy as np
+from generation import fingerprint
+from metrics import record_cache
+from models import QuantitativeAnalysis, QuantitativeAnalysisRequest, RiskInDB, RiskSensitivity, row_factory
+
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "256"))
+# Bytes of draws a simulation holds at once, the iterations are simulated in chunks that fit
+ANALYSIS_MEMORY_BUDGET = int(os.getenv("ANALYSIS_MEMORY_BUDGET", str(32 * 1024 * 1024)))
+# Simulations run at once by each worker, the others wait for their turn
+ANALYSIS_CONCURRENCY = int(os.getenv("ANALYSIS_CONCURRENCY", "2"))
+# Memory of a chunk per iteration and risk: two float32 draws, the float32 amounts and the occurrence flags
+_CHUNK_BYTES_PER_DRAW = 13
+
+# Built from the computed floats, and risks read from the database
+_analysis = row_factory(QuantitativeAnalysis)
+_sensitivity = row_factory(RiskSensitivity)
+
+
+def _triangular_quantile(q, low, mode, high):
+    """Inverse CDF of triangular distributions, elementwise. A range of a single value gives that value"""
+    width = high - low
+    # Share of the distribution below the mode
+    below = np.divide(mode - low, width, out=np.zeros_like(width), where=width > 0)
+    return np.where(
+        q < below,
+        low + np.sqrt(q * width * (mode - low)),
+        high - np.sqrt((1 - q) * width * (high - mode))
+    )
+
+
+def _risk_quantile(q: float, probability, low, mode, high):
+    """Quantile of the loss or gain of each risk: nothing if it does not occur, triangular if it does"""
+    occurring = np.clip((q - (1 - probability)) / np.maximum(probability, 1e-12), 0, 1)
+    return np.where(q <= 1 - probability, 0.0, _triangular_quantile(occurring, low, mode, high))
+
+
+def simulate(risks: list[RiskInDB], request: QuantitativeAnalysisRequest, seed: int, unscored: int = 0) -> QuantitativeAnalysis:
+    """Monte Carlo simulation of the outcome of a project over its scored risks.
+
+    Each risk occurs with its probability score out of 10. It then loses (threats) or
+    gains (opportunities) an amount drawn from a triangular distribution: its monetary
+    range when given, else one impact score point either side of its impact, times
+    `impactUnit`. The draws of all the risks and iterations of a chunk are made at
+    once as matrices, so the cost is in NumPy rather than in Python loops.
+    """
+    ranges = {r.riskId: r for r in request.ranges}
+    unit = request.impactUnit
+    bounds = []
+    for risk in risks:
+        r = ranges.get(risk.id)
+        if r is not None:
+            bounds.append((r.low, r.mostLikely if r.mostLikely is not None else (r.low + r.high) / 2, r.high))
+        else:
+            bounds.append(((risk.impact - 1) * unit, risk.impact * unit, (risk.impact + 1) * unit))
+    low, mode, high = np.array(bounds, dtype=np.float64).reshape(-1, 3).T
+    probability = np.array([risk.probability / 10 for risk in risks])
+    sign = np.array([-1.0 if risk.kind == "threat" else 1.0 for risk in risks])
+
+    emv = sign * probability * (low + mode + high) / 3
+    total_emv = float(emv.sum())
+
+    rng = np.random.default_rng(seed)
+    n = request.iterations
+    outcomes = np.empty(n)
+    losses = np.empty(n)
+    # Running sums for the correlation of each risk with the outcome
+    sum_x = np.zeros(len(risks))
+    sum_x2 = np.zeros(len(risks))
+    sum_xt = np.zeros(len(risks))
+    # Signed, so that the draws of the threats come out negative
+    start32, slope_min, slope_max = ((sign * a).astype(np.float32) for a in (low, high - mode, mode - low))
+    probability32 = probability.astype(np.float32)
+    inverse_probability = (1 / probability).astype(np.float32)
+    threats = (sign < 0).astype(np.float32)
+    chunk = max(1, ANALYSIS_MEMORY_BUDGET // (_CHUNK_BYTES_PER_DRAW * len(risks)))
+    for start in range(0, n, chunk):
+        size = min(chunk, n - start)
+        # Triangular draws as low + (high - mode) min(u, v) + (mode - low) max(u, v), without square roots or branches.
+        # A risk occurs when w < probability, and then w / probability is a uniform draw of its own for u
+        w = rng.random((size, len(risks)), dtype=np.float32)
+        v = rng.random((size, len(risks)), dtype=np.float32)
+        occurs = w < probability32
+        w *= inverse_probability
+        x = np.minimum(w, v)
+        np.maximum(w, v, out=v)
+        x *= slope_min
+        v *= slope_max
+        x += v
+        x += start32
+        x *= occurs
+        t = x @ np.ones(len(risks), dtype=np.float32)
+        outcomes[start:start + size] = t
+        losses[start:start + size] = -(x @ threats)
+        sum_x += np.ones(size, dtype=np.float32) @ x
+        sum_x2 += np.einsum("ij,ij->j", x, x)
+        sum_xt += t @ x
+
+    mean_x = sum_x / n
+    mean_t = outcomes.mean()
+    covariance = sum_xt / n - mean_x * mean_t
+    deviation = np.sqrt(np.maximum(sum_x2 / n - mean_x ** 2, 0) * outcomes.var())
+    correlation = np.divide(covariance, deviation, out=np.zeros_like(covariance), where=deviation > 0)
+
+    # The 10th percentile of a threat is its 90th percentile loss
+    q10 = sign * _risk_quantile(0.1, probability, low, mode, high)
+    q90 = sign * _risk_quantile(0.9, probability, low, mode, high)
+    swing_low = total_emv - emv + np.minimum(q10, q90)
+    swing_high = total_emv - emv + np.maximum(q10, q90)
+
+    p10, p50, p90 = np.percentile(outcomes, [10, 50, 90])
+    exposure_p50, exposure_p90 = np.percentile(losses, [50, 90])
+    tornado = [
+        _sensitivity(id=risk.id, kind=risk.kind, title=risk.title, emv=float(emv[i]), low=float(swing_low[i]), high=float(swing_high[i]), correlation=float(correlation[i]))
+        for i, risk in enumerate(risks)
+    ]
+    tornado.sort(key=lambda s: s.high - s.low, reverse=True)
+    return _analysis(
+        iterations=n,
+        emv=total_emv,
+        p10=float(p10),
+        p50=float(p50),
+        p90=float(p90),
+        lossProbability=float((outcomes < 0).mean()),
+        exposureP50=float(exposure_p50),
+        exposureP90=float(exposure_p90),
+        tornado=tornado,
+        unscoredRisks=unscored
+    )
+
+
+class AnalysisCache:
+    """Latest quantitative analysis of each project, along with the version of the risks and settings it was computed from"""
+
+    def __init__(self, max_size: int = ANALYSIS_CACHE_SIZE, concurrency: int = ANALYSIS_CONCURRENCY):
+        self.max_size = max_size
+        # Bounds the threads and memory taken by the simulations not found in the cache
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.entries: OrderedDict[int, tuple[str, QuantitativeAnalysis]] = OrderedDict()
+
+    def get(self, project_id: int, key: str) -> Optional[QuantitativeAnalysis]:
+        entry = self.entries.get(project_id)
+        hit = entry is not None and entry[0] == key
+        record_cache("analysis", hit)
+        if not hit:
+            return None
+        self.entries.move_to_end(project_id)
+        return entry[1]
+
+    def put(self, project_id: int, key: str, analysis: QuantitativeAnalysis):
+        self.entries[project_id] = (key, analysis)
+        self.entries.move_to_end(project_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def evict(self, key: Optional[str]):
+        """Invalidation bus subscriber, a changed project is computed again anyway, this only frees the memory early"""
+        if key is None:
+            self.entries.clear()
+            return
+        kind, _, entity_id = key.partition(":")
+        if kind == "project":
+            self.entries.pop(int(entity_id), None)
+
+
+async def analyze(cache: AnalysisCache, project_id: int, risks: list[RiskInDB], request: QuantitativeAnalysisRequest) -> Optional[QuantitativeAnalysis]:
+    """Quantitative analysis of a project's risks, None if none of them is scored yet"""
+    scored = [risk for risk in risks if risk.impact is not None and risk.probability is not None]
+    if not scored:
+        return None
+    # The same risks and settings give the same result, draws included
+    key = fingerprint([(risk.id, risk.kind, risk.title, risk.impact, risk.probability) for risk in scored], request)
+    analysis = cache.get(project_id, key)
+    if analysis is None:
+        # NumPy releases the GIL in the large operations, the event loop keeps serving meanwhile
+        async with cache.semaphore:
+            analysis = await asyncio.to_thread(simulate, scored, request, int(key[:16], 16), len(risks) - len(scored))
+        cache.put(project_id, key, analysis)
+    return analysis
@@ -0,0 +1,189 @@
+import math
+import os
+import time
+from dataclasses import dataclass
+from typing import Optional
+from fastapi import HTTPException, Request
+from psycopg_pool import AsyncConnectionPool
+from metrics import record_rate_limit
+
+# "memory" keeps the buckets in each worker process, "postgres" shares them between workers, "off" disables rate limiting
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "10000"))
+
+
+@dataclass(frozen=True)
+class Limit:
+    rate: float  # tokens per second
+    burst: int
+
+    @classmethod
+    def per_minute(cls, requests: float, burst: int) -> "Limit":
+        return cls(rate=requests / 60, burst=burst)
+
+
+@dataclass(frozen=True)
+class RouteClassLimits:
+    user: Limit
+    total: Limit
+
+
+# Limits by route class, for every user and for all users together
+RATE_LIMITS = {
+    "generation": RouteClassLimits(
+        user=Limit.per_minute(
+            float(os.getenv("RATE_LIMIT_GENERATION_PER_MINUTE", "6")),
+            int(os.getenv("RATE_LIMIT_GENERATION_BURST", "3"))
+        ),
+        total=Limit.per_minute(
+            float(os.getenv("RATE_LIMIT_GENERATION_GLOBAL_PER_MINUTE", "60")),
+            int(os.getenv("RATE_LIMIT_GENERATION_GLOBAL_BURST", "20"))
+        )
+    ),
+    "analysis": RouteClassLimits(
+        user=Limit.per_minute(
+            float(os.getenv("RATE_LIMIT_ANALYSIS_PER_MINUTE", "20")),
+            int(os.getenv("RATE_LIMIT_ANALYSIS_BURST", "5"))
+        ),
+        total=Limit.per_minute(
+            float(os.getenv("RATE_LIMIT_ANALYSIS_GLOBAL_PER_MINUTE", "200")),
+            int(os.getenv("RATE_LIMIT_ANALYSIS_GLOBAL_BURST", "40"))
+        )
+    ),
+}
+
+
+@dataclass
+class _Bucket:
+    tokens: float
+    updated: float
+    full_at: float
+
+
+class MemoryRateLimiter:
+    """Token buckets kept in the memory of this worker process"""
+
+    def __init__(self, max_buckets: int = RATE_LIMIT_MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self.buckets: dict[str, _Bucket] = {}
+
+    async def acquire(self, buckets: list[tuple[str, Limit]]) -> Optional[tuple[int, float]]:
+        """Take a token from every bucket or from none of them.
+
+        Returns None on success, or the index of an empty bucket and the seconds until it has a token.
+        """
+        now = time.monotonic()
+        levels = []
+        for key, limit in buckets:
+            bucket = self.buckets.get(key)
+            levels.append(limit.burst if bucket is None else min(limit.burst, bucket.tokens + (now - bucket.updated) * limit.rate))
+        denied = None
+        for index, ((_, limit), tokens) in enumerate(zip(buckets, levels)):
+            if tokens < 1:
+                denied = (index, (1 - tokens) / limit.rate)
+                break
+        for (key, limit), tokens in zip(buckets, levels):
+            if denied is None:
+                tokens -= 1
+            self.buckets[key] = _Bucket(tokens, now, now + (limit.burst - tokens) / limit.rate)
+        if len(self.buckets) > self.max_buckets:
+            self._prune(now)
+        return denied
+
+    def _prune(self, now: float):
+        # A full bucket is the same as a missing one
+        for key in [key for key, bucket in self.buckets.items() if bucket.full_at <= now]:
+            del self.buckets[key]
+
+
+class PostgresRateLimiter:
+    """Token buckets in the database, consistent across worker processes and backend instances"""
+
+    def __init__(self, pool: AsyncConnectionPool):
+        self.pool = pool
+
+    async def acquire(self, buckets: list[tuple[str, Limit]]) -> Optional[tuple[int, float]]:
+        """Take a token from every bucket or from none of them, see MemoryRateLimiter.acquire"""
+        params = [{"key": key, "burst": limit.burst, "rate": limit.rate} for key, limit in buckets]
+        async with self.pool.connection() as conn:
+            # The buckets are updated in a single round trip, each statement refills and takes a
+            # token and the row lock serializes concurrent requests
+            async with conn.pipeline():
+                cursors = [conn.cursor() for _ in buckets]
+                for cursor, bucket_params in zip(cursors, params):
+                    await cursor.execute(
+                        """
+                        INSERT INTO rate_limit_buckets AS b (key, tokens, updated_at)
+                        VALUES (%(key)s, %(burst)s - 1, now())
+                        ON CONFLICT (key) DO UPDATE
+                        SET tokens = least(%(burst)s, b.tokens + extract(epoch FROM now() - b.updated_at) * %(rate)s) - 1,
+                            updated_at = now()
+                        WHERE least(%(burst)s, b.tokens + extract(epoch FROM now() - b.updated_at) * %(rate)s) >= 1
+                        RETURNING tokens
+                        """,
+                        bucket_params
+                    )
+            granted = [await cursor.fetchone() is not None for cursor in cursors]
+            if all(granted):
+                return None
+
+            # The request is rejected, so it must not count against the buckets that had a token
+            index = granted.index(False)
+            async with conn.pipeline():
+                for bucket_params, taken in zip(params, granted):
+                    if taken:
+                        await conn.execute(
+                            "UPDATE rate_limit_buckets SET tokens = least(%(burst)s, tokens + 1) WHERE key = %(key)s",
+                            bucket_params
+                        )
+                cursor = await conn.execute(
+                    """
+                    SELECT least(%(burst)s, tokens + extract(epoch FROM now() - updated_at) * %(rate)s)
+                    FROM rate_limit_buckets
+                    WHERE key = %(key)s
+                    """,
+                    params[index]
+                )
+            row = await cursor.fetchone()
+            limit = buckets[index][1]
+            tokens = float(row[0]) if row else limit.burst
+            return index, max(0.0, (1 - tokens) / limit.rate)
+
+
+def create_rate_limiter(pool: AsyncConnectionPool):
+    if RATE_LIMIT_BACKEND == "off":
+        return None
+    if RATE_LIMIT_BACKEND == "postgres":
+        return PostgresRateLimiter(pool)
+    return MemoryRateLimiter()
+
+
+async def check_rate_limit(limiter, route_class: str, user_id: int):
+    """Take a token from the user's and the global bucket of the route class, raises a 429 error if either is empty"""
+    limits = RATE_LIMITS[route_class]
+    denied = await limiter.acquire([
+        (f"{route_class}:user:{user_id}", limits.user),
+        (f"{route_class}:global", limits.total)
+    ])
+    if denied is None:
+        record_rate_limit(route_class, "allowed")
+        return
+    index, retry_after = denied
+    record_rate_limit(route_class, "limited_user" if index == 0 else "limited_global")
+    raise HTTPException(
+        status_code=429,
+        detail="Too many requests",
+        headers={"Retry-After": str(math.ceil(retry_after))}
+    )
+
+
+def rate_limit(route_class: str):
+    """Dependency limiting the rate of the route for the logged in user"""
+    async def dependency(request: Request):
+        limiter = request.app.state.rate_limiter
+        user_id = request.session.get("user_id")
+        # Requests without a session are rejected by the route itself
+        if limiter is None or user_id is None:
+            return
+        await check_rate_limit(limiter, route_class, user_id)
+    return dependency
@@ -0,0 +1,155 @@
+import functools
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Optional
+import psycopg
+from psycopg_pool import AsyncConnectionPool
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from metrics import record_db_route
+
+logger = logging.getLogger(__name__)
+
+# Comma separated host:port of the read replicas, empty to read everything from the primary
+DB_REPLICA_HOSTS = [host.strip() for host in os.getenv("DB_REPLICA_HOSTS", "").split(",") if host.strip()]
+# After a write, a client reads from the primary for this long so it sees its own writes despite the replication lag
+DB_REPLICA_STICKY_SECONDS = float(os.getenv("DB_REPLICA_STICKY_SECONDS", "5"))
+# Seconds to wait for a replica connection before falling back to the primary
+DB_REPLICA_TIMEOUT = float(os.getenv("DB_REPLICA_TIMEOUT", "1"))
+# A replica that failed is not used again for this long
+DB_REPLICA_RETRY_SECONDS = float(os.getenv("DB_REPLICA_RETRY_SECONDS", "30"))
+
+# Session key holding the time until which the client reads from the primary
+SESSION_PRIMARY_UNTIL = "primary_until"
+
+
+@dataclass
+class _Route:
+    use_replica: bool = True
+    replica: Optional[int] = None
+
+
+@dataclass
+class _RequestWrites:
+    read_primary: bool = False
+    wrote: bool = False
+
+
+_route: ContextVar[Optional[_Route]] = ContextVar("db_route", default=None)
+_request_writes: ContextVar[Optional[_RequestWrites]] = ContextVar("db_request_writes", default=None)
+
+
+def read_only(method):
+    """Repository method decorator letting a RoutingPool serve the method from a replica.
+
+    If the replica fails, the method is run again on the primary, so it must only read.
+    """
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        route = _Route()
+        token = _route.set(route)
+        try:
+            return await method(self, *args, **kwargs)
+        except psycopg.OperationalError as e:
+            if route.replica is None:
+                raise
+            self.pool.replica_failed(route.replica, e)
+            route.use_replica = False
+            route.replica = None
+            return await method(self, *args, **kwargs)
+        finally:
+            _route.reset(token)
+    return wrapper
+
+
+class RoutingPool:
+    """Hands out primary connections, or replica connections for the read-only repository methods.
+
+    Reads stay on the primary while the client is sticky after a write of its
+    own (see ReadYourWritesMiddleware), and when no replica is available.
+    """
+
+    def __init__(self, primary: AsyncConnectionPool, replicas: Optional[list[AsyncConnectionPool]] = None, timeout: float = DB_REPLICA_TIMEOUT, retry_seconds: float = DB_REPLICA_RETRY_SECONDS):
+        self.primary = primary
+        self.replicas = replicas or []
+        self.timeout = timeout
+        self.retry_seconds = retry_seconds
+        self.down_until = [0.0] * len(self.replicas)
+        self.next_replica = 0
+
+    @asynccontextmanager
+    async def connection(self, timeout: Optional[float] = None):
+        route = _route.get()
+        writes = _request_writes.get()
+        if route is None:
+            # Only the read-only methods set a route, anything else may write
+            if writes is not None:
+                writes.wrote = True
+            async with self.primary.connection(timeout) as conn:
+                yield conn
+            return
+
+        replica = None
+        if route.use_replica and not (writes is not None and (writes.read_primary or writes.wrote)):
+            replica = self._pick_replica()
+        if replica is None:
+            record_db_route("primary" if route.use_replica else "fallback")
+            async with self.primary.connection(timeout) as conn:
+                yield conn
+            return
+
+        route.replica = replica
+        record_db_route("replica")
+        async with self.replicas[replica].connection(self.timeout if timeout is None else timeout) as conn:
+            yield conn
+
+    def replica_failed(self, replica: int, error: Exception):
+        logger.warning(f"Read replica {replica} failed, reading from the primary for {self.retry_seconds}s: {error!r}")
+        self.down_until[replica] = time.monotonic() + self.retry_seconds
+
+    def _pick_replica(self) -> Optional[int]:
+        now = time.monotonic()
+        for _ in range(len(self.replicas)):
+            replica = self.next_replica
+            self.next_replica = (self.next_replica + 1) % len(self.replicas)
+            if self.down_until[replica] <= now:
+                return replica
+        return None
+
+
+class ReadYourWritesMiddleware:
+    """Keep the reads of a client on the primary for a while after it wrote.
+
+    The deadline is kept in the session, so it holds whichever backend instance
+    serves the next request. Must run inside SessionMiddleware.
+    """
+
+    def __init__(self, app: ASGIApp, sticky_seconds: float = DB_REPLICA_STICKY_SECONDS):
+        self.app = app
+        self.sticky_seconds = sticky_seconds
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        session = scope.get("session")
+        now = time.time()
+        primary_until = session.get(SESSION_PRIMARY_UNTIL, 0) if session is not None else 0
+        if primary_until and primary_until <= now:
+            del session[SESSION_PRIMARY_UNTIL]
+        writes = _RequestWrites(read_primary=primary_until > now)
+
+        async def send_with_session(message: Message):
+            if message["type"] == "http.response.start" and writes.wrote and session is not None:
+                session[SESSION_PRIMARY_UNTIL] = time.time() + self.sticky_seconds
+            await send(message)
+
+        token = _request_writes.set(writes)
+        try:
+            await self.app(scope, receive, send_with_session)
+        finally:
+            _request_writes.reset(token)
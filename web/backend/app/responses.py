@@ -0,0 +1,19 @@
+from typing import Any
+from fastapi.responses import JSONResponse
+from pydantic_core import to_json
+
+
+class PydanticJSONResponse(JSONResponse):
+    """JSON response that serializes Pydantic models straight to bytes.
+
+    The default FastAPI path converts every model to a dict with `jsonable_encoder`
+    and then encodes it with the standard `json` module. This response hands the
+    content (models, lists and dicts of models) directly to pydantic-core, which
+    walks it in Rust and returns the encoded bytes in a single pass.
+
+    Routes returning this class bypass `response_model` validation, so it should
+    only wrap data that is already made of the declared models.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return to_json(content)
@@ -1,11 +1,27 @@
 import uvicorn
 import logging
 import os
+import shutil
+import tempfile
 import colorlog
 
+from budget import DB_CONNECTIONS_PER_WORKER, DB_POOL_BUDGET, MAX_BACKEND_WORKERS
+from log_sampling import SamplingFilter
+
 
 PORT = int(os.getenv("BACKEND_PORT", "8080"))
 MODE = os.getenv("MODE", "development")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Fraction of DEBUG records that are actually emitted, to keep hot-path logging cheap
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.1"))
+
+# Production serving settings, ignored in development where a single reloading process is used
+# One per CPU by default, as far as the DB connection budget allows
+BACKEND_WORKERS = int(os.getenv("BACKEND_WORKERS") or min(os.cpu_count() or 1, MAX_BACKEND_WORKERS))
+# Each worker is gracefully replaced after serving about this many requests (0 disables recycling)
+WORKER_MAX_REQUESTS = int(os.getenv("WORKER_MAX_REQUESTS", "10000"))
+WORKER_MAX_REQUESTS_JITTER = int(os.getenv("WORKER_MAX_REQUESTS_JITTER", "1000"))
+WORKER_GRACEFUL_TIMEOUT = int(os.getenv("WORKER_GRACEFUL_TIMEOUT", "30"))
 
 if __name__ == "__main__":
     # Create custom logging config for uvicorn
@@ -25,15 +41,22 @@ if __name__ == "__main__":
                 }
             },
         },
+        "filters": {
+            "sampling": {
+                "()": SamplingFilter,
+                "rate": LOG_DEBUG_SAMPLE_RATE,
+            },
+        },
         "handlers": {
             "default": {
                 "formatter": "colored",
                 "class": "logging.StreamHandler",
                 "stream": "ext://sys.stdout",
+                "filters": ["sampling"],
             },
         },
         "root": {
-            "level": "INFO",
+            "level": LOG_LEVEL,
             "handlers": ["default"],
         },
         "loggers": {
@@ -58,11 +81,34 @@ if __name__ == "__main__":
         },
     }
     
-    uvicorn.run(
-        "app:app", 
-        host="0.0.0.0", 
-        port=PORT, 
-        reload=(MODE == "development"),
-        reload_delay=1,
-        log_config=log_config
-    )
+    if MODE == "production":
+        if BACKEND_WORKERS > MAX_BACKEND_WORKERS:
+            raise SystemExit(
+                f"BACKEND_WORKERS={BACKEND_WORKERS} needs {BACKEND_WORKERS * DB_CONNECTIONS_PER_WORKER} DB connections "
+                f"but DB_POOL_BUDGET is {DB_POOL_BUDGET}, lower the workers to {MAX_BACKEND_WORKERS} or raise the budget"
+            )
+        # Workers read this to size their share of the DB connection budget
+        os.environ["BACKEND_WORKERS"] = str(BACKEND_WORKERS)
+        # Workers share their metrics through this directory, it must start empty
+        metrics_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "aira-metrics"))
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir)
+        uvicorn.run(
+            "app:app",
+            host="0.0.0.0",
+            port=PORT,
+            workers=BACKEND_WORKERS,
+            limit_max_requests=WORKER_MAX_REQUESTS or None,
+            limit_max_requests_jitter=WORKER_MAX_REQUESTS_JITTER if WORKER_MAX_REQUESTS else 0,
+            timeout_graceful_shutdown=WORKER_GRACEFUL_TIMEOUT,
+            log_config=log_config
+        )
+    else:
+        uvicorn.run(
+            "app:app", 
+            host="0.0.0.0", 
+            port=PORT, 
+            reload=(MODE == "development"),
+            reload_delay=1,
+            log_config=log_config
+        )
@@ -0,0 +1,290 @@
+import asyncio
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Optional
+import httpx
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+# Comma separated list of exporters: "console", "file" and/or "otlp"
+TRACING_EXPORTERS = [name.strip() for name in os.getenv("TRACING_EXPORTERS", "").split(",") if name.strip()]
+TRACING_FILE = os.getenv("TRACING_FILE", "/tmp/aira-traces.jsonl")
+# Base URL of an OTLP/HTTP collector, spans are posted as JSON to {OTLP_ENDPOINT}/v1/traces
+OTLP_ENDPOINT = os.getenv("OTLP_ENDPOINT", "http://localhost:4318")
+SERVICE_NAME = os.getenv("TRACING_SERVICE_NAME", "aira-backend")
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    start_ns: int
+    end_ns: Optional[int] = None
+    attributes: dict[str, Any] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "start": self.start_ns,
+            "end": self.end_ns,
+            "durationMs": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class _Trace:
+    """Spans of one trace recorded by this process, exported when its local root span ends"""
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: list[Span] = []
+
+
+_current_trace: contextvars.ContextVar[Optional[_Trace]] = contextvars.ContextVar("current_trace", default=None)
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+@contextmanager
+def start_span(name: str, trace_id: Optional[str] = None, parent_id: Optional[str] = None, **attributes):
+    """Record a span around the enclosed block, nested under the current span if there is one.
+
+    `trace_id` and `parent_id` continue a trace started by another service, they
+    are ignored when a span is already active.
+    """
+    trace = _current_trace.get()
+    parent = _current_span.get()
+    is_root = trace is None
+    if is_root:
+        trace = _Trace(trace_id or secrets.token_hex(16))
+    else:
+        parent_id = parent.span_id if parent is not None else parent_id
+
+    span = Span(
+        name=name,
+        trace_id=trace.trace_id,
+        span_id=secrets.token_hex(8),
+        parent_id=parent_id,
+        start_ns=time.time_ns(),
+        attributes=attributes
+    )
+    trace.spans.append(span)
+    trace_token = _current_trace.set(trace) if is_root else None
+    span_token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        span.end_ns = time.time_ns()
+        _current_span.reset(span_token)
+        if trace_token is not None:
+            _current_trace.reset(trace_token)
+            _export(trace.spans)
+
+
+def traced(name: str):
+    """Decorator recording a span around every call of a coroutine function"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with start_span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def trace_repository(cls):
+    """Class decorator recording a span around every public coroutine method of a repository"""
+    for name, method in list(vars(cls).items()):
+        if name.startswith("_") or not inspect.iscoroutinefunction(method):
+            continue
+        setattr(cls, name, traced(f"{cls.__name__}.{name}")(method))
+    return cls
+
+
+class ConsoleExporter:
+    def export(self, spans: list[Span]):
+        for span in spans:
+            indent = "  " * _depth(span, spans)
+            logger.info(f"trace={span.trace_id} {indent}{span.name} {span.duration_ms:.1f}ms {span.attributes}")
+
+
+class FileExporter:
+    """Append finished traces to a JSON-lines file, one span per line"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, spans: list[Span]):
+        lines = "".join(json.dumps(span.to_dict(), default=str) + "\n" for span in spans)
+        with self.lock, open(self.path, "a") as f:
+            f.write(lines)
+
+
+class OTLPExporter:
+    """Send spans to an OpenTelemetry collector using OTLP/HTTP with the JSON encoding"""
+
+    def __init__(self, endpoint: str):
+        self.url = f"{endpoint.rstrip('/')}/v1/traces"
+        self.client = httpx.Client(timeout=5)
+
+    @staticmethod
+    def _attribute(key: str, value: Any) -> dict:
+        if isinstance(value, bool):
+            return {"key": key, "value": {"boolValue": value}}
+        if isinstance(value, int):
+            return {"key": key, "value": {"intValue": str(value)}}
+        if isinstance(value, float):
+            return {"key": key, "value": {"doubleValue": value}}
+        return {"key": key, "value": {"stringValue": str(value)}}
+
+    def _encode(self, span: Span) -> dict:
+        encoded = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 2 if span.parent_id is None else 1,  # SERVER for local roots, INTERNAL otherwise
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [self._attribute(key, value) for key, value in span.attributes.items()],
+            "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+        }
+        if span.parent_id:
+            encoded["parentSpanId"] = span.parent_id
+        return encoded
+
+    def export(self, spans: list[Span]):
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [self._attribute("service.name", SERVICE_NAME)]},
+                "scopeSpans": [{
+                    "scope": {"name": __name__},
+                    "spans": [self._encode(span) for span in spans],
+                }],
+            }]
+        }
+        try:
+            self.client.post(self.url, json=payload).raise_for_status()
+        except httpx.HTTPError as e:
+            logger.warning(f"Failed to export {len(spans)} spans to {self.url}: {e}")
+
+
+def _depth(span: Span, spans: list[Span]) -> int:
+    by_id = {s.span_id: s for s in spans}
+    depth = 0
+    while span.parent_id in by_id:
+        span = by_id[span.parent_id]
+        depth += 1
+    return depth
+
+
+def _create_exporters() -> list:
+    exporters = []
+    for name in TRACING_EXPORTERS:
+        if name == "console":
+            exporters.append(ConsoleExporter())
+        elif name == "file":
+            exporters.append(FileExporter(TRACING_FILE))
+        elif name == "otlp":
+            exporters.append(OTLPExporter(OTLP_ENDPOINT))
+        else:
+            logger.warning(f"Unknown tracing exporter: {name}")
+    return exporters
+
+
+EXPORTERS = _create_exporters()
+
+
+def _export_now(spans: list[Span]):
+    for exporter in EXPORTERS:
+        exporter.export(spans)
+
+
+def _export(spans: list[Span]):
+    """Hand a finished trace to the exporters without blocking the event loop"""
+    if not EXPORTERS:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        _export_now(spans)
+        return
+    loop.run_in_executor(None, _export_now, spans)
+
+
+def _parse_traceparent(value: str) -> tuple[Optional[str], Optional[str]]:
+    """Extract trace and parent span ids from a W3C traceparent header"""
+    parts = value.split("-")
+    if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+        return parts[1], parts[2]
+    return None, None
+
+
+class TracingMiddleware:
+    """Record a root span per HTTP request and return its trace id in the response headers.
+
+    An incoming W3C `traceparent` header is honoured, so the request joins the
+    caller's trace.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace_id, parent_id = None, None
+        for key, value in scope["headers"]:
+            if key == b"traceparent":
+                trace_id, parent_id = _parse_traceparent(value.decode("latin-1"))
+
+        with start_span(f"{scope['method']} {scope['path']}", trace_id=trace_id, parent_id=parent_id, **{"http.method": scope["method"]}) as span:
+
+            async def send_with_trace(message: Message):
+                if message["type"] == "http.response.start":
+                    span.set_attribute("http.status_code", message["status"])
+                    headers = MutableHeaders(scope=message)
+                    headers["X-Trace-Id"] = span.trace_id
+                    headers["traceparent"] = f"00-{span.trace_id}-{span.span_id}-01"
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_trace)
+            finally:
+                route = scope.get("route")
+                if route is not None:
+                    span.name = f"{scope['method']} {route.path}"
+                    span.set_attribute("http.route", route.path)
@@ -0,0 +1,33 @@
+import asyncio
+import logging
+import os
+from psycopg_pool import AsyncConnectionPool
+
+from app import DB_CONNECTION_KWARGS, create_llm, primary_conninfo
+from jobs import LLMQueue
+from migrations import migrate
+
+logger = logging.getLogger(__name__)
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Queued LLM calls run at once by this worker process
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "8"))
+
+
+async def main():
+    """Run queued LLM calls without serving HTTP, to scale the LLM throughput apart from the backend instances"""
+    # Claims, heartbeats and results of the concurrent calls, plus a spare connection
+    async with AsyncConnectionPool(primary_conninfo(), min_size=1, max_size=WORKER_CONCURRENCY + 1, kwargs=DB_CONNECTION_KWARGS, open=False) as pool:
+        # A worker may start before any backend instance, on a database created by an older version
+        await migrate(pool)
+        queue = LLMQueue(pool, primary_conninfo())
+        logger.info(f"LLM worker {queue.worker_id} running {WORKER_CONCURRENCY} calls at once.")
+        await queue.serve(create_llm(), WORKER_CONCURRENCY)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=LOG_LEVEL, format="%(levelname)-8s %(name)s: %(message)s")
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -1,11 +1,20 @@
+-- Schema of a new database. Databases created by an older version are brought up to date by
+-- web/backend/app/migrations.py when the backend starts, so add any change there as well
+
 -- Users table
 CREATE TABLE IF NOT EXISTS users (
     id SERIAL PRIMARY KEY,
-    username VARCHAR(100) NOT NULL UNIQUE,
+    username VARCHAR(100) NOT NULL,
     password_hash TEXT NOT NULL,
-    company_description TEXT DEFAULT ''
+    company_description TEXT DEFAULT '',
+    profile_picture TEXT,
+    -- Deleted accounts are hidden at once and purged in the background
+    deleted_at TIMESTAMPTZ
 );
 
+-- Usernames are unique among the accounts that are not deleted
+CREATE UNIQUE INDEX IF NOT EXISTS users_username_idx ON users (username) WHERE deleted_at IS NULL;
+
 -- Projects table
 CREATE TABLE IF NOT EXISTS projects (
     id SERIAL PRIMARY KEY,
@@ -13,9 +22,17 @@ CREATE TABLE IF NOT EXISTS projects (
     title VARCHAR(150) NOT NULL,
     description TEXT,
     current_step NUMERIC DEFAULT 0,
-    risk_score_threshold NUMERIC DEFAULT 0.1
+    risk_score_threshold NUMERIC DEFAULT 0.1,
+    -- Deleted projects are hidden at once and purged in the background
+    deleted_at TIMESTAMPTZ,
+    search_vector tsvector GENERATED ALWAYS AS (
+        to_tsvector('english', title || ' ' || coalesce(description, ''))
+    ) STORED
 );
 
+-- Used to find past projects similar to a new one
+CREATE INDEX IF NOT EXISTS projects_search_vector_idx ON projects USING GIN (search_vector);
+
 -- Risks table
 CREATE TYPE risk_type AS ENUM ('threat', 'opportunity');
 
@@ -28,5 +45,98 @@ CREATE TABLE IF NOT EXISTS risks (
     probability NUMERIC,
     impact NUMERIC,
     contingency TEXT,
-    fallback TEXT
+    fallback TEXT,
+    search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', title), 'A') ||
+        setweight(to_tsvector('english', description), 'B') ||
+        setweight(to_tsvector('english', coalesce(contingency, '') || ' ' || coalesce(fallback, '')), 'C')
+    ) STORED
+);
+
+CREATE INDEX IF NOT EXISTS risks_project_id_idx ON risks (project_id);
+CREATE INDEX IF NOT EXISTS projects_user_id_idx ON projects (user_id);
+-- Used by the risk search
+CREATE INDEX IF NOT EXISTS risks_search_vector_idx ON risks USING GIN (search_vector);
+
+-- LLM token usage, one row per generation request and operation
+CREATE TABLE IF NOT EXISTS llm_usage (
+    id SERIAL PRIMARY KEY,
+    user_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    project_id INT REFERENCES projects(id) ON DELETE CASCADE,
+    operation VARCHAR(64) NOT NULL,
+    calls INT NOT NULL,
+    prompt_tokens INT NOT NULL,
+    completion_tokens INT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS llm_usage_user_id_idx ON llm_usage (user_id);
+CREATE INDEX IF NOT EXISTS llm_usage_project_id_idx ON llm_usage (project_id);
+
+
+-- Generated but not yet saved results, by project and workflow step
+CREATE TABLE IF NOT EXISTS generations (
+    id SERIAL PRIMARY KEY,
+    project_id INT NOT NULL REFERENCES projects(id) ON DELETE CASCADE,
+    step VARCHAR(16) NOT NULL,
+    fingerprint CHAR(64) NOT NULL,
+    result JSONB NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS generations_project_step_idx ON generations (project_id, step, created_at DESC);
+CREATE INDEX IF NOT EXISTS generations_created_at_idx ON generations (created_at);
+
+-- Token buckets of the rate limiter when RATE_LIMIT_BACKEND=postgres, losing them on a crash is harmless
+CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_buckets (
+    key TEXT PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL
+);
+
+-- Deleted accounts (project_id NULL) and projects waiting to be purged, with the purge progress
+CREATE TABLE IF NOT EXISTS purges (
+    id SERIAL PRIMARY KEY,
+    user_id INT NOT NULL,
+    project_id INT,
+    requested_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    purged_rows BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS purges_pending_idx ON purges (id) WHERE finished_at IS NULL;
+
+-- LLM calls queued by the backend instances when LLM_QUEUE is enabled, run by whichever instance or worker claims them
+CREATE TYPE llm_job_status AS ENUM ('queued', 'running', 'done', 'dead');
+
+CREATE TABLE IF NOT EXISTS llm_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    operation VARCHAR(64) NOT NULL,
+    payload JSONB NOT NULL,
+    -- Claimed highest first, interactive requests go before speculative and bulk generations
+    priority INT NOT NULL DEFAULT 0,
+    status llm_job_status NOT NULL DEFAULT 'queued',
+    attempts INT NOT NULL DEFAULT 0,
+    -- Failed attempts are retried after a backoff
+    run_after TIMESTAMPTZ NOT NULL DEFAULT now(),
+    -- A running job whose lease is not renewed by its worker's heartbeat is given to another worker
+    worker TEXT,
+    leased_until TIMESTAMPTZ,
+    result JSONB,
+    usage JSONB,
+    error TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    finished_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS llm_jobs_queued_idx ON llm_jobs (priority DESC, id) WHERE status = 'queued';
+CREATE INDEX IF NOT EXISTS llm_jobs_leased_idx ON llm_jobs (leased_until) WHERE status = 'running';
+CREATE INDEX IF NOT EXISTS llm_jobs_finished_idx ON llm_jobs (finished_at) WHERE finished_at IS NOT NULL;
+
+-- The version of web/backend/app/migrations.py this schema matches, so that a fresh database skips the migration
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INT PRIMARY KEY,
+    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
 );
+INSERT INTO schema_version (version) VALUES (1);
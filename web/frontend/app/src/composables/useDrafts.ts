@@ -0,0 +1,24 @@
+export type DraftStep = 'risks' | 'scores' | 'plans';
+
+/**
+ * Fetch the unsaved result of a generation step, e.g. after a page reload,
+ * and only call the generation endpoint when there is no valid draft.
+ * Resolves to a response with the same body as the generation endpoint.
+ */
+export async function fetchDraftOrGenerate(projectId: number, step: DraftStep, generateUrl: string): Promise<Response> {
+    const draftResponse = await fetch(`/api/projects/${projectId}/drafts/${step}`, {
+        method: 'GET',
+        credentials: 'include'
+    });
+    if (draftResponse.ok) {
+        const draft = await draftResponse.json();
+        return new Response(JSON.stringify(draft.result), {
+            status: 200,
+            headers: { 'Content-Type': 'application/json' }
+        });
+    }
+    return fetch(generateUrl, {
+        method: 'GET',
+        credentials: 'include'
+    });
+}
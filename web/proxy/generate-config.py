@@ -7,8 +7,46 @@ BACKEND_PORT = os.getenv("BACKEND_PORT", "8080")
 FRONTEND_HOST = os.getenv("FRONTEND_HOST", "localhost")
 FRONTEND_PORT = os.getenv("FRONTEND_PORT", "8081")
 
+COMPRESSION_MINIMUM_SIZE = os.getenv("COMPRESSION_MINIMUM_SIZE", "1024")
+
+# Backend data volume, mounted read-only in the proxy to serve profile pictures
+BACKEND_FILE_PATH = os.getenv("BACKEND_FILE_PATH", "/data")
+
+# Comma separated list of host:port backend instances, defaults to the single BACKEND_HOST:BACKEND_PORT
+BACKEND_INSTANCES = [
+    instance.strip()
+    for instance in (os.getenv("BACKEND_INSTANCES") or f"{BACKEND_HOST}:{BACKEND_PORT}").split(",")
+    if instance.strip()
+]
+BACKEND_KEEPALIVE = os.getenv("BACKEND_KEEPALIVE", "32")
+# Passive health checks: an instance is skipped for FAIL_TIMEOUT after MAX_FAILS failed attempts
+BACKEND_MAX_FAILS = os.getenv("BACKEND_MAX_FAILS", "3")
+BACKEND_FAIL_TIMEOUT = os.getenv("BACKEND_FAIL_TIMEOUT", "10s")
+
+backend_servers = "\n".join(
+    f"    server {instance} max_fails={BACKEND_MAX_FAILS} fail_timeout={BACKEND_FAIL_TIMEOUT};"
+    for instance in BACKEND_INSTANCES
+)
+
 
 config_template = f"""
+upstream backend {{
+    least_conn;
+{backend_servers}
+
+    # Idle connections kept open to the backend instances
+    keepalive {BACKEND_KEEPALIVE};
+    keepalive_requests 1000;
+    keepalive_timeout 60s;
+}}
+
+# Only forward "Connection: upgrade" when the client asked for it, so that
+# regular requests can reuse the keepalive connections
+map $http_upgrade $connection_upgrade {{
+    default upgrade;
+    '' '';
+}}
+
 server {{
     listen 80;
     server_name _;
@@ -16,55 +54,89 @@ server {{
     # Increase client body size for larger requests
     client_max_body_size 10M;
 
-    location /api/ {{
-        proxy_pass http://{BACKEND_HOST}:{BACKEND_PORT};
-        proxy_set_header Host $host;
-        proxy_set_header X-Real-IP $remote_addr;
-        proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
-        proxy_set_header X-Forwarded-Proto $scheme;
-        
-        # Cookie handling
-        proxy_set_header Cookie $http_cookie;
-        proxy_pass_header Set-Cookie;
-        
+    # Compress responses that the upstream did not already encode.
+    # text/event-stream is deliberately not listed so SSE is never held back
+    # by the compressor, streaming routes can also send "X-Accel-Buffering: no".
+    gzip on;
+    gzip_vary on;
+    gzip_proxied any;
+    gzip_comp_level 5;
+    gzip_min_length {COMPRESSION_MINIMUM_SIZE};
+    gzip_types application/json application/javascript text/css text/plain image/svg+xml;
+
+    # Settings shared by every backend location
+    proxy_http_version 1.1;
+    proxy_set_header Host $host;
+    proxy_set_header X-Real-IP $remote_addr;
+    proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+    proxy_set_header X-Forwarded-Proto $scheme;
+    proxy_set_header Upgrade $http_upgrade;
+    proxy_set_header Connection $connection_upgrade;
+
+    # Cookie handling
+    proxy_set_header Cookie $http_cookie;
+    proxy_pass_header Set-Cookie;
+
+    # Profile pictures, only reachable through X-Accel-Redirect from the backend.
+    # File names are content hashes, so the ETag of a file never changes and
+    # clients can always revalidate /api/me/picture with a cheap 304.
+    location /protected/pictures/ {{
+        internal;
+        alias {BACKEND_FILE_PATH}/pictures/;
+        etag on;
+        add_header Cache-Control "private, no-cache" always;
+        add_header X-Content-Type-Options nosniff always;
+    }}
+
+    # Metrics are scraped from the backend instances directly, never exposed publicly
+    location = /api/metrics {{
+        return 404;
+    }}
+
+    # LLM generation routes, they can run for a very long time
+    location ~ ^/api/projects/[0-9]+/gen/ {{
+        proxy_pass http://backend;
+
+        # Hand the result to the client as soon as it is ready
+        proxy_buffering off;
+        # Never replay a generation on another instance, it would run the LLM twice
+        proxy_next_upstream off;
+
         # Timeout settings
-        proxy_connect_timeout 60s;
+        proxy_connect_timeout 5s;
         proxy_send_timeout 60s;
         proxy_read_timeout 1d; # To allow for low-power servers
     }}
+
+    # Fast CRUD routes
+    location /api/ {{
+        proxy_pass http://backend;
+
+        # Buffer responses so slow clients don't hold backend connections
+        proxy_buffering on;
+        proxy_buffer_size 16k;
+        proxy_buffers 16 16k;
+        proxy_next_upstream error timeout http_502 http_503;
+        proxy_next_upstream_tries 2;
+
+        # Timeout settings
+        proxy_connect_timeout 5s;
+        proxy_send_timeout 60s;
+        proxy_read_timeout 60s;
+    }}
     
     # Handle /api without trailing slash
     location /api {{
-        proxy_pass http://{BACKEND_HOST}:{BACKEND_PORT};
-        proxy_set_header Host $host;
-        proxy_set_header X-Real-IP $remote_addr;
-        proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
-        proxy_set_header X-Forwarded-Proto $scheme;
-        
-        # Cookie handling
-        proxy_set_header Cookie $http_cookie;
-        proxy_pass_header Set-Cookie;
-        
-        proxy_http_version 1.1;
-        proxy_set_header Upgrade $http_upgrade;
-        proxy_set_header Connection "upgrade";
-        
+        proxy_pass http://backend;
+
         # Timeout settings
-        proxy_connect_timeout 60s;
+        proxy_connect_timeout 5s;
         proxy_send_timeout 60s;
         proxy_read_timeout 60s;
     }}
 
     location / {{
         proxy_pass http://{FRONTEND_HOST}:{FRONTEND_PORT};
-        proxy_set_header Host $host;
-        proxy_set_header X-Real-IP $remote_addr;
-        proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
-        proxy_set_header X-Forwarded-Proto $scheme;
-        
-        proxy_http_version 1.1;
-        proxy_set_header Upgrade $http_upgrade;
-        proxy_set_header Connection "upgrade";
 
         # Timeout settings
         proxy_connect_timeout 60s;